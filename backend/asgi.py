@@ -2,6 +2,9 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Game event streams (``game/<pk>/events``) are served here as Server-Sent
+Events, all the other requests are passed to Django
+(with async read views, see ticTacToe.async_views).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -12,5 +15,11 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# read endpoints are served by ticTacToe.async_views
+os.environ.setdefault('ASYNC_VIEWS', 'True')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from ticTacToe.events import GameEventsApplication  # noqa: E402
+
+application = GameEventsApplication(django_application)
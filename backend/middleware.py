@@ -0,0 +1,59 @@
+import asyncio
+from abc import abstractmethod, ABC
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class SyncAndAsyncMiddleware(ABC):
+    """
+    Middleware which runs in the stack it is put in, so it does not
+    switch the ASGI stack to sync (a single sync middleware makes django
+    run every async view in one thread).
+
+    handle is called in the sync stack and async_handle is awaited
+    in the async one.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # seen as a coroutine function by django
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.async_handle(request)
+        return self.handle(request)
+
+    @abstractmethod
+    def handle(self, request):
+        return None
+
+    @abstractmethod
+    async def async_handle(self, request):
+        return None
+
+
+class AsyncWhiteNoiseMiddleware(SyncAndAsyncMiddleware, WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware which serves static files in both stacks.
+    """
+
+    def __init__(self, get_response=None, settings=settings):
+        WhiteNoiseMiddleware.__init__(self, get_response, settings)
+        SyncAndAsyncMiddleware.__init__(self, get_response)
+
+    def handle(self, request):
+        return WhiteNoiseMiddleware.__call__(self, request)
+
+    async def async_handle(self, request):
+        # static files are looked up in memory (on disk with DEBUG)
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
@@ -45,7 +45,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # first to see the whole request, not used unless PROFILING is set
+    'ticTacToe.profiling.ProfilingMiddleware',
+    'backend.middleware.AsyncWhiteNoiseMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -145,3 +147,90 @@ STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_DIRS = (os.path.join(BASE_DIR, 'static'),)
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+# Game events pub/sub used by the ASGI event stream (see backend/asgi.py)
+# and long polls of historySuffix, shared by all the workers on Postgres
+TIC_TAC_TOE_EVENT_BROKER = os.getenv(
+    'EVENT_BROKER',
+    'ticTacToe.events.PostgresEventBroker' if db_name == 'postgresql'
+    else 'ticTacToe.events.LocalEventBroker'
+)
+
+# Rendered piece images, bounded LRU in every worker
+# and an optional directory shared by all workers of the host
+TIC_TAC_TOE_IMAGE_CACHE_BYTES = int(
+    os.getenv('IMAGE_CACHE_BYTES', 32 * 1024 * 1024)
+)
+TIC_TAC_TOE_IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR')
+TIC_TAC_TOE_IMAGE_CACHE_DIR_BYTES = int(
+    os.getenv('IMAGE_CACHE_DIR_BYTES', 512 * 1024 * 1024)
+)
+# 0 (fast, big) - 9 (slow, small), see PIL PNG compress_level
+TIC_TAC_TOE_IMAGE_PNG_COMPRESS_LEVEL = int(
+    os.getenv('IMAGE_PNG_COMPRESS_LEVEL', 6)
+)
+
+# Per-view request metrics (served by ticTacToe/metrics)
+# and cProfile dumps of sampled requests slower than the threshold
+TIC_TAC_TOE_PROFILING = (os.getenv('PROFILING') == 'True')
+TIC_TAC_TOE_PROFILING_SAMPLE_RATE = float(
+    os.getenv('PROFILING_SAMPLE_RATE', 0.01)
+)
+TIC_TAC_TOE_PROFILING_THRESHOLD_MS = float(
+    os.getenv('PROFILING_THRESHOLD_MS', 500)
+)
+TIC_TAC_TOE_PROFILING_DIR = os.getenv('PROFILING_DIR',
+                                      os.path.join(BASE_DIR, 'profiles'))
+# the metrics are served to staff users, to requests with
+# "Authorization: Bearer <METRICS_TOKEN>" and to the comma separated
+# addresses (REMOTE_ADDR, the one of a proxy if there is one)
+TIC_TAC_TOE_METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+TIC_TAC_TOE_METRICS_ALLOWED_IPS = [
+    ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '').split(',')
+    if ip.strip()
+]
+
+# Async read views, switched on by backend/asgi.py,
+# every read thread may hold a database connection
+TIC_TAC_TOE_ASYNC_VIEWS = (os.getenv('ASYNC_VIEWS') == 'True')
+TIC_TAC_TOE_ASYNC_READ_THREADS = int(os.getenv('ASYNC_READ_THREADS', 16))
+TIC_TAC_TOE_IMAGE_THREADS = int(
+    os.getenv('IMAGE_THREADS', os.cpu_count() or 1)
+)
+
+# Decoded states of unfinished games read by the game views
+# (see ticTacToe.game_cache), the local cache of every process gets
+# the invalidations of the others through TIC_TAC_TOE_EVENT_BROKER
+# (only through the Postgres one), the shared one keeps the states
+# in a shared django cache (TIC_TAC_TOE_GAME_CACHE_ALIAS of CACHES)
+TIC_TAC_TOE_GAME_CACHE = os.getenv(
+    'GAME_CACHE', 'ticTacToe.game_cache.LocalGameStateCache'
+)
+TIC_TAC_TOE_GAME_CACHE_ALIAS = os.getenv('GAME_CACHE_ALIAS', 'default')
+TIC_TAC_TOE_GAME_CACHE_MAX_GAMES = int(
+    os.getenv('GAME_CACHE_MAX_GAMES', 1000)
+)
+# seconds, bounds staleness if an invalidation is missed
+TIC_TAC_TOE_GAME_CACHE_TIMEOUT = int(os.getenv('GAME_CACHE_TIMEOUT', 300))
+
+# Replays of games (see ticTacToe.replay) start from the latest
+# board snapshot, one is saved every that many turns
+TIC_TAC_TOE_REPLAY_SNAPSHOT_INTERVAL = int(
+    os.getenv('REPLAY_SNAPSHOT_INTERVAL', 100)
+)
+
+# The field and the line runs of a running game are saved every that
+# many turns, the turns after them are added when the game is loaded
+# (see ticTacToe.service.load_field)
+TIC_TAC_TOE_FIELD_SAVE_INTERVAL = int(os.getenv('FIELD_SAVE_INTERVAL', 20))
+
+# Server side players (see ticTacToe.bot), their turns are searched
+# in that many worker processes of every web worker
+# (0 searches in the thread which saved the previous turn)
+# a search is leased in the game row (shared by all the processes),
+# polls of the game search again for a turn whose lease has expired
+TIC_TAC_TOE_BOT_PROCESSES = int(os.getenv('BOT_PROCESSES', 1))
+# seconds of search per turn
+TIC_TAC_TOE_BOT_TIME_LIMIT = float(os.getenv('BOT_TIME_LIMIT', 1))
+# positions in the transposition table of a search, about 200 bytes each
+TIC_TAC_TOE_BOT_TABLE_SIZE = int(os.getenv('BOT_TABLE_SIZE', 100000))
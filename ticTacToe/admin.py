@@ -3,3 +3,4 @@ from django.contrib import admin
 from . import models
 
 admin.site.register(models.Game)
+admin.site.register(models.Turn)
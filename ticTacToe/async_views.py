@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponseNotModified
+
+from . import events, profiling, threads
+from .forms import HistorySuffixForm
+from .views import (
+    GameDetailView, HistorySuffixView, GamePlayersView, GameStartedView,
+    StartedGamesView, WaitingGamesView, MyGamesView, CircleCrossPictureView,
+    GameBoardPictureView, GameSummaryView, GameBoardView, GameBoardDeltaView,
+    GameThreatsView, game_etag, game_not_modified, patch_game_cache_headers,
+    polled_game_state
+)
+
+# the ORM is sync only, reads are run in their own threads instead of
+# the single thread of sync_to_async so a slow one does not hold
+# the others, images are rendered apart so they do not hold the reads
+read_executor = ThreadPoolExecutor(settings.TIC_TAC_TOE_ASYNC_READ_THREADS,
+                                   thread_name_prefix='tic-tac-toe-read')
+image_executor = ThreadPoolExecutor(settings.TIC_TAC_TOE_IMAGE_THREADS,
+                                    thread_name_prefix='tic-tac-toe-image')
+
+
+def run_profiled(function, *args, **kwargs):
+    # the queries and the samples of the thread count for the request
+    if profiling.current_profile.get() is not None:
+        profiling.track_sql(connection)
+    return profiling.run_sampled(function, *args, **kwargs)
+
+
+async def run_in(executor, function, *args, **kwargs):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, partial(context.run, threads.run_in_request_thread,
+                          run_profiled, function, *args, **kwargs)
+    )
+
+
+def rendered(view):
+    def render(request, **kwargs):
+        response = view(request, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+    return render
+
+
+def async_view(view_class, executor=read_executor, conditional=False,
+               **initkwargs):
+    """
+    Async version of a sync read view, the view is run in the executor
+    and the event loop is free while it waits for the database.
+
+    Revalidations of conditional views (see conditional_on_game_version)
+    are answered after the version lookup without running the view.
+    """
+    view = rendered(view_class.as_view(**initkwargs))
+
+    async def async_wrapper(request, **kwargs):
+        if conditional and 'If-None-Match' in request.headers:
+            pk = kwargs['pk']
+            state = await run_in(executor, polled_game_state, pk)
+            if state is not None:
+                etag = game_etag(pk, state)
+                if game_not_modified(request, etag):
+                    response = HttpResponseNotModified()
+                    patch_game_cache_headers(response, etag, state)
+                    return response
+        return await run_in(executor, view, request, **kwargs)
+
+    async_wrapper.view_class = view_class
+    return async_wrapper
+
+
+game_detail = async_view(GameDetailView, conditional=True)
+game_summary = async_view(GameSummaryView, conditional=True)
+history_suffix_view = async_view(HistorySuffixView, conditional=True,
+                                 long_poll=False)
+game_players = async_view(GamePlayersView, conditional=True)
+game_started = async_view(GameStartedView)
+game_board = async_view(GameBoardView)
+game_board_delta = async_view(GameBoardDeltaView)
+game_threats = async_view(GameThreatsView, conditional=True)
+started_games = async_view(StartedGamesView)
+waiting_games = async_view(WaitingGamesView)
+my_games = async_view(MyGamesView)
+circle_cross_picture = async_view(CircleCrossPictureView, image_executor)
+game_board_picture = async_view(GameBoardPictureView, image_executor)
+
+
+async def history_suffix(request, pk):
+    # long polls wait in the event loop, not in a read thread
+    form = HistorySuffixForm(request.GET)
+    if form.is_valid() and (wait := form.cleaned_data['wait']):
+        await events.async_wait_for_turn(
+            pk, form.cleaned_data['start_index'], wait
+        )
+    return await history_suffix_view(request, pk=pk)
+
+
+history_suffix.view_class = HistorySuffixView
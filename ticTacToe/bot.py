@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache, partial
+from itertools import count
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from . import engine, events, profiling, service, threads
+from .game_cache import get_game_states
+from .models import Game
+from .serializers import TurnSerializer, WinDataSerializer
+
+logger = logging.getLogger(__name__)
+
+# threads which wait for the searches and save the turns,
+# so a request never waits for a search
+turn_executor = ThreadPoolExecutor(
+    max(settings.TIC_TAC_TOE_BOT_PROCESSES, 1),
+    thread_name_prefix='tic-tac-toe-bot'
+)
+
+
+@lru_cache(maxsize=None)
+def get_search_pool():
+    # spawned, forked processes would inherit the threads
+    # and the database connections of the web worker
+    return ProcessPoolExecutor(
+        settings.TIC_TAC_TOE_BOT_PROCESSES,
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+
+def get_bot_user(game):
+    # bot users can not log in, '#' is not valid in usernames
+    # of the users who sign up
+    joined = set(game.players.values_list('id', flat=True))
+    for number in count(1):
+        user, _ = User.objects.get_or_create(
+            username=f'Bot #{number}', defaults={'is_active': False}
+        )
+        if user.id not in joined:
+            return user
+
+
+def make_turn(game, data):
+    """
+    Saves a turn of the current player of the game locked for update,
+    publishes it and lets a bot make the next turn if it is a bot's one.
+    Returns the win data of the game.
+    """
+    serializer = TurnSerializer(game, data)
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+
+    with profiling.timed('serializer'):
+        win_data = WinDataSerializer(game).data
+    get_game_states().invalidate_on_commit(game.id)
+    events.publish(game.id, 'turn', index=game.turns_count - 1,
+                   **serializer.validated_data)
+    if game.finished:
+        events.publish(game.id, 'win', win_data=win_data)
+    schedule(game)
+    return win_data
+
+
+def schedule(game):
+    # the turn is searched for after the transaction is committed
+    if game.current_bot is not None:
+        transaction.on_commit(partial(submit, game.id, game.turns_count))
+
+
+def resume(game_id, state):
+    """
+    Searches for the turn of the bot of a read game (see
+    game_cache.game_state) again if the search scheduled after
+    the previous turn has been lost with its worker or has failed.
+    """
+    if state.get('bot') is not None:
+        submit(game_id, state['turns_count'])
+
+
+def lease(game_id, turns_count, seconds):
+    """
+    Takes the search for the turn turns_count of the game for seconds,
+    False if a worker of any process has taken it and its lease
+    has not expired (a conditional update of the game row).
+    """
+    now = timezone.now()
+    return Game.objects.filter(id=game_id) \
+        .exclude(bot_lease_turn=turns_count, bot_lease_until__gt=now) \
+        .update(bot_lease_turn=turns_count,
+                bot_lease_until=now + timedelta(seconds=seconds)) == 1
+
+
+def submit(game_id, turns_count):
+    # a turn is searched for once at a time, the lease outlives
+    # a search (see search), so a lost one is taken over after it
+    if not lease(game_id, turns_count,
+                 settings.TIC_TAC_TOE_BOT_TIME_LIMIT + 90):
+        return
+    if settings.TIC_TAC_TOE_BOT_PROCESSES:
+        turn_executor.submit(threads.run_in_request_thread, play_logged,
+                             game_id, turns_count)
+    else:
+        play_logged(game_id, turns_count)
+
+
+def play_logged(game_id, turns_count):
+    # the lease of a made turn is not released, the next turn
+    # has a lease of its own
+    try:
+        play(game_id, turns_count)
+    except Exception:
+        logger.exception('Bot turn %d of game %d failed',
+                         turns_count, game_id)
+        # searched for again by a read of the game after a while
+        Game.objects.filter(id=game_id, bot_lease_turn=turns_count) \
+            .update(bot_lease_until=timezone.now() + timedelta(
+                seconds=settings.TIC_TAC_TOE_BOT_TIME_LIMIT
+            ))
+
+
+def search(game):
+    players_count = len(game.order)
+    service.load_field(game)
+    time_limit = settings.TIC_TAC_TOE_BOT_TIME_LIMIT
+    args = (game.width, game.height, game.win_threshold, game.field,
+            game.turns_count % players_count, players_count,
+            time_limit, settings.TIC_TAC_TOE_BOT_TABLE_SIZE)
+    if not settings.TIC_TAC_TOE_BOT_PROCESSES:
+        return engine.choose_move(*args)
+    # the time limit does not count the time the search is queued for
+    return get_search_pool().submit(engine.choose_move, *args) \
+        .result(timeout=time_limit + 60)
+
+
+def play(game_id, turns_count):
+    """
+    Makes the turn turns_count of the game if it is a bot's turn
+    and the turn has not been made yet.
+    """
+    game = Game.objects.filter(id=game_id).first()
+    if game is None or game.turns_count != turns_count \
+            or game.current_bot is None:
+        return
+    i, j = search(game)
+
+    with transaction.atomic():
+        game = Game.objects.select_for_update().filter(id=game_id).first()
+        if game is None or game.turns_count != turns_count \
+                or game.current_bot is None:
+            return
+        make_turn(game, {'i': i, 'j': j})
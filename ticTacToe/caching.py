@@ -0,0 +1,156 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class BytesLRUCache:
+    """
+    In-process LRU cache of bytes values bounded by their total size.
+
+    An optional shared tier (e.g. DirectoryBytesCache) is read on misses
+    and written on sets, so a value computed by one worker is reused
+    by the others.
+    """
+
+    def __init__(self, max_bytes, shared=None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.shared is not None \
+                and (value := self.shared.get(key)) is not None:
+            with self._lock:
+                self.shared_hits += 1
+            self._put(key, value)
+            return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._put(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def get_or_set(self, key, compute):
+        if (value := self.get(key)) is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def _put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if (old := self._values.pop(key, None)) is not None:
+                self._size -= len(old)
+            self._values[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._values.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._values),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class DirectoryBytesCache:
+    """
+    Cache of bytes values in files of a local directory,
+    shared by all the processes of the host.
+
+    Files are written atomically, the least recently used ones
+    (by modification time, which is touched on reads) are removed
+    when the directory grows over max_bytes.
+    The size is checked every check_every writes of this process.
+    """
+
+    def __init__(self, directory, max_bytes, check_every=100):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self._lock = threading.Lock()
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = f.read()
+            os.utime(self.path(key))
+            return value
+        except OSError:
+            return None
+
+    def set(self, key, value):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            return
+
+        with self._lock:
+            self._writes += 1
+            check = self._writes % self.check_every == 0
+        if check:
+            self.shrink()
+
+    def shrink(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if not entry.name.startswith('.tmp-'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry[1] for entry in entries)
+        if size <= self.max_bytes:
+            return
+        # some room so it is not shrunk on every check
+        for _, file_size, path in sorted(entries):
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
@@ -0,0 +1,280 @@
+"""
+Move search of the server side players (see bot).
+
+Nothing is imported from django, so the search runs in worker
+processes which do not set django up.
+"""
+import heapq
+import time
+
+# a line of win_threshold cells of one player in one of the directions
+# wins, as in service.check_win
+LINE_DIRECTIONS = ((1, 1), (1, 0), (1, -1), (0, 1))
+
+EMPTY = -1
+# cells around the board
+BORDER = -2
+
+# value of a cell which completes a line (see Search.cell_value),
+# more than any other cell is worth
+LINE_VALUE = 1 << 24
+# value of a won position, less the sooner it is won
+WIN_VALUE = 1 << 50
+
+EXACT, LOWER, UPPER = range(3)
+MASK64 = (1 << 64) - 1
+
+
+def zobrist_key(cell, player):
+    # splitmix64 of the (cell, player) pair instead of a table
+    # of random keys, which would take cells * players of them
+    z = ((cell << 16 | player) + 1) * 0x9E3779B97F4A7C15 & MASK64
+    z = (z ^ z >> 30) * 0xBF58476D1CE4E5B9 & MASK64
+    z = (z ^ z >> 27) * 0x94D049BB133111EB & MASK64
+    return z ^ z >> 31
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Search:
+    """
+    Paranoid alpha-beta search (all the other players play against
+    the searching one) with iterative deepening and a transposition
+    table of at most table_size positions keyed by Zobrist hashes.
+
+    Only the branching best cells next to busy ones are searched,
+    a position is valued by the cells played on the way to it,
+    a cell is worth the lines it makes and the ones it blocks.
+    """
+
+    def __init__(self, width, height, win_threshold, field, player,
+                 players_count, deadline, table_size, branching):
+        self.win_threshold = win_threshold
+        self.player = player
+        self.players_count = players_count
+        self.deadline = deadline
+        self.table_size = table_size
+        self.branching = branching
+        self.table = {}
+        self.nodes = 0
+        # the best cell of the last search from the root
+        self.root_cell = None
+
+        # one border column is both the right border of a row
+        # and the left one of the next row, so a step along a direction
+        # is a constant offset which stops at the border
+        self.stride = width + 1
+        self.board = [BORDER] * ((height + 2) * self.stride + 2)
+        for i, row in enumerate(field):
+            start = self.cell(i, 0)
+            self.board[start:start + width] = row
+        self.steps = [step_i * self.stride + step_j
+                      for step_i, step_j in LINE_DIRECTIONS]
+        self.neighbours = self.steps + [-step for step in self.steps]
+
+        # empty cells next to busy ones, the candidates for a turn
+        self.near = [0] * len(self.board)
+        self.frontier = set()
+        self.empty_count = 0
+        self.key = 0
+        for cell, value in enumerate(self.board):
+            if value == EMPTY:
+                self.empty_count += 1
+            elif value != BORDER:
+                self.empty_count += 1
+                self.place(cell, value)
+
+    def cell(self, i, j):
+        # the first border cell is the left one of the upper left corner
+        return (i + 1) * self.stride + j + 1
+
+    def coordinates(self, cell):
+        return (cell - 1) // self.stride - 1, (cell - 1) % self.stride
+
+    def place(self, cell, player):
+        self.board[cell] = player
+        self.key ^= zobrist_key(cell, player)
+        self.empty_count -= 1
+        self.frontier.discard(cell)
+        for step in self.neighbours:
+            self.near[cell + step] += 1
+            if self.board[cell + step] == EMPTY:
+                self.frontier.add(cell + step)
+
+    def remove(self, cell):
+        self.key ^= zobrist_key(cell, self.board[cell])
+        self.board[cell] = EMPTY
+        self.empty_count += 1
+        for step in self.neighbours:
+            self.near[cell + step] -= 1
+            if self.near[cell + step] == 0:
+                self.frontier.discard(cell + step)
+        if self.near[cell] > 0:
+            self.frontier.add(cell)
+
+    def count(self, cell, step, values):
+        # cells with one of the values from the cell along the step
+        # (without the cell), up to win_threshold
+        board = self.board
+        length = 0
+        cell += step
+        while length < self.win_threshold and board[cell] in values:
+            length += 1
+            cell += step
+        return length
+
+    def cell_value(self, cell, player):
+        # what the player's lines through the empty cell would be worth
+        value = 0
+        own = (player,)
+        free = (player, EMPTY)
+        for step in self.steps:
+            after = self.count(cell, step, own)
+            before = self.count(cell, -step, own)
+            length = before + after + 1
+            if length >= self.win_threshold:
+                return LINE_VALUE
+            # a line which can not grow to win_threshold is worth nothing
+            room = length \
+                + self.count(cell + step * after, step, free) \
+                + self.count(cell - step * before, -step, free)
+            if room < self.win_threshold:
+                continue
+            open_ends = (self.board[cell + step * (after + 1)] == EMPTY) \
+                + (self.board[cell - step * (before + 1)] == EMPTY)
+            need = self.win_threshold - length
+            value += (1 << max(0, 20 - 4 * need)) * (open_ends + 1)
+        return value
+
+    def moves(self, mover):
+        # [(value, cell, wins)] of the best candidates, the best first
+        if not self.frontier:
+            return []
+        scored = []
+        for cell in self.frontier:
+            attack = self.cell_value(cell, mover)
+            defence = sum(self.cell_value(cell, other)
+                          for other in range(self.players_count)
+                          if other != mover)
+            scored.append((2 * attack + defence, cell,
+                           attack >= LINE_VALUE))
+            self.check_time()
+        return heapq.nlargest(self.branching, scored)
+
+    def check_time(self):
+        self.nodes += 1
+        if self.nodes & 63 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def search(self, depth, alpha, beta, mover, score, ply):
+        """
+        Returns the value of the position for the searching player,
+        score is the value of the cells played on the way to it.
+        """
+        self.check_time()
+        key = self.key
+        best_cell = None
+        if (entry := self.table.get(key)) is not None:
+            entry_depth, flag, value, best_cell = entry
+            if abs(value) < WIN_VALUE // 2:
+                # stored relatively to the score of its own way
+                value += score
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return value
+                if flag == LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        if depth == 0 or not (moves := self.moves(mover)):
+            return score
+        if best_cell is not None:
+            # the best cell of a shallower search first
+            moves.sort(key=lambda move: move[1] != best_cell)
+
+        maximizing = mover == self.player
+        next_mover = (mover + 1) % self.players_count
+        start_alpha, start_beta = alpha, beta
+        best = -WIN_VALUE * 2 if maximizing else WIN_VALUE * 2
+        for cell_score, cell, wins in moves:
+            if wins:
+                value = WIN_VALUE - ply if maximizing else ply - WIN_VALUE
+            else:
+                self.place(cell, mover)
+                try:
+                    value = self.search(
+                        depth - 1, alpha, beta, next_mover,
+                        score + (cell_score if maximizing else -cell_score),
+                        ply + 1
+                    )
+                finally:
+                    self.remove(cell)
+            if maximizing and value > best or not maximizing and value < best:
+                best, best_cell = value, cell
+            if maximizing:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                break
+
+        if ply == 0:
+            self.root_cell = best_cell
+        if best <= start_alpha:
+            flag = UPPER
+        elif best >= start_beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        if len(self.table) < self.table_size or key in self.table:
+            stored = best - score if abs(best) < WIN_VALUE // 2 else best
+            self.table[key] = (depth, flag, stored, best_cell)
+        return best
+
+    def best_cell(self):
+        moves = self.moves(self.player)
+        if not moves:
+            return None
+        for _, cell, wins in moves:
+            if wins:
+                return cell
+
+        best = moves[0][1]
+        for depth in range(1, self.empty_count + 1):
+            self.table.pop(self.key, None)
+            try:
+                value = self.search(depth, -WIN_VALUE * 2, WIN_VALUE * 2,
+                                    self.player, 0, 0)
+            except SearchTimeout:
+                break
+            best = self.root_cell
+            if abs(value) >= WIN_VALUE // 2:
+                # won or lost whatever is searched deeper
+                break
+        return best
+
+
+def choose_move(width, height, win_threshold, field, player, players_count,
+                time_limit, table_size, branching=12):
+    """
+    Returns (i, j) of the turn of the player (an index in order)
+    on the field (list[list[int:player_index or -1]]),
+    searched for at most time_limit seconds.
+    """
+    search = Search(width, height, win_threshold, field, player,
+                    players_count, time.monotonic() + time_limit,
+                    table_size, branching)
+    try:
+        cell = search.best_cell()
+    except SearchTimeout:
+        # not even the candidates are valued, any of them will do
+        cell = next(iter(search.frontier), None)
+    if cell is None:
+        # the field is empty
+        return height // 2, width // 2
+    return search.coordinates(cell)
@@ -0,0 +1,406 @@
+import asyncio
+import json
+import logging
+import queue
+import re
+import select
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# events for the listeners of the broker (see game_cache),
+# not for the subscribers of the game
+INTERNAL_EVENTS = frozenset(['invalidate'])
+
+
+class LocalEventBroker:
+    """
+    In-process pub/sub of game events.
+
+    Subscribers are asyncio queues living in some event loop
+    or thread-safe queues of sync views,
+    publishers may be plain sync views running in any thread.
+    Only events published inside the current process are delivered,
+    so this broker is meant for a single worker or local testing.
+
+    Listeners are called with the events of all the games
+    in the thread which delivers them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # dict[int:game_id -> set[tuple[loop or None, queue]]]
+        self._subscribers = defaultdict(set)
+        # list[callable(game_id, event)]
+        self._listeners = []
+
+    def subscribe(self, game_id):
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers[game_id].add(
+                (asyncio.get_event_loop(), queue)
+            )
+        return queue
+
+    def subscribe_sync(self, game_id):
+        sync_queue = queue.SimpleQueue()
+        with self._lock:
+            self._subscribers[game_id].add((None, sync_queue))
+        return sync_queue
+
+    def unsubscribe(self, game_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(game_id, set())
+            subscribers.difference_update(
+                [s for s in subscribers if s[1] is queue]
+            )
+            if not subscribers:
+                self._subscribers.pop(game_id, None)
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def publish(self, game_id, event):
+        self.deliver(game_id, event)
+
+    def deliver(self, game_id, event):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(game_id, event)
+        if event['event'] not in INTERNAL_EVENTS:
+            self.deliver_to_subscribers(game_id, event)
+
+    def resync(self):
+        """
+        Tells the listeners (with None for game_id) and the subscribers
+        of all the games that events may have been lost,
+        they reload what they need from the database.
+        """
+        event = {'event': 'resync'}
+        with self._lock:
+            listeners = list(self._listeners)
+            game_ids = list(self._subscribers)
+        for listener in listeners:
+            listener(None, event)
+        for game_id in game_ids:
+            self.deliver_to_subscribers(game_id, event)
+
+    def deliver_to_subscribers(self, game_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(game_id, ()))
+        for loop, subscriber in subscribers:
+            if loop is None:
+                subscriber.put_nowait(event)
+                continue
+            try:
+                loop.call_soon_threadsafe(subscriber.put_nowait, event)
+            except RuntimeError:
+                # subscriber's loop is already closed
+                self.unsubscribe(game_id, subscriber)
+
+
+class PostgresEventBroker(LocalEventBroker):
+    """
+    Pub/sub of game events between all the processes
+    using the database, through Postgres LISTEN/NOTIFY.
+
+    Events are sent with pg_notify and received by a listener thread
+    of every subscribing process which passes them to its subscribers.
+    Notifications sent while the thread is not listening are lost,
+    so everyone resyncs once it listens (again).
+    """
+    channel = 'tic_tac_toe_events'
+    reconnect_interval = 1
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def subscribe(self, game_id):
+        self.start_listener()
+        return super().subscribe(game_id)
+
+    def subscribe_sync(self, game_id):
+        self.start_listener()
+        return super().subscribe_sync(game_id)
+
+    def add_listener(self, listener):
+        self.start_listener()
+        super().add_listener(listener)
+
+    def publish(self, game_id, event):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [
+                self.channel, json.dumps({'game_id': game_id, **event})
+            ])
+
+    def start_listener(self):
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self.listen, name='tic-tac-toe-events',
+                    daemon=True
+                )
+                self._listener.start()
+
+    def listen(self):
+        while True:
+            try:
+                self.listen_connection()
+            except Exception:
+                logger.exception('Game events listener failed')
+            time.sleep(self.reconnect_interval)
+
+    def listen_connection(self):
+        # a connection of its own, not managed by django
+        listener = connection.get_new_connection(
+            connection.get_connection_params()
+        )
+        try:
+            listener.autocommit = True
+            with listener.cursor() as cursor:
+                cursor.execute(f'LISTEN {self.channel}')
+            self.resync()
+            while True:
+                if select.select([listener], [], [], 60) == ([], [], []):
+                    continue
+                listener.poll()
+                while listener.notifies:
+                    event = json.loads(listener.notifies.pop(0).payload)
+                    self.deliver(event.pop('game_id'), event)
+        finally:
+            listener.close()
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(getattr(
+        settings, 'TIC_TAC_TOE_EVENT_BROKER',
+        'ticTacToe.events.LocalEventBroker'
+    ))()
+
+
+def publish(game_id, event, **data):
+    # subscribers must not see changes that may be rolled back
+    message = {'event': event, **data}
+    transaction.on_commit(lambda: get_broker().publish(game_id, message))
+
+
+def game_snapshot_events(game, start_index):
+    if game.started:
+        yield {'event': 'start', 'order': game.order}
+    for index in range(start_index, len(game.history)):
+        i, j = game.history[index]
+        yield {'event': 'turn', 'index': index, 'i': i, 'j': j}
+    if game.finished:
+        from .serializers import WinDataSerializer
+        yield {'event': 'win', 'win_data': WinDataSerializer(game).data}
+
+
+def should_wait(game_id, start_index):
+    # the game is running and has no turns since start_index yet
+    from .models import Game, Turn
+    return Game.unfinished_query(Game.objects.filter(id=game_id)).exists() \
+        and not Turn.objects.filter(game_id=game_id,
+                                    index__gte=start_index).exists()
+
+
+def wakes(message, start_index):
+    return message['event'] == 'win' \
+        or message['event'] == 'turn' and message['index'] >= start_index
+
+
+def wait_for_turn(game_id, start_index, timeout):
+    """
+    Blocks until there is a turn with an index not less than start_index
+    or the game is finished, but for timeout seconds at most.
+    """
+    broker = get_broker()
+    # subscribe before checking the game so no event is lost in between
+    subscriber = broker.subscribe_sync(game_id)
+    try:
+        if not should_wait(game_id, start_index):
+            return
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                message = subscriber.get(timeout=remaining)
+            except queue.Empty:
+                return
+            if wakes(message, start_index):
+                return
+            # the turn may have been made while events were lost
+            if message['event'] == 'resync' \
+                    and not should_wait(game_id, start_index):
+                return
+    finally:
+        broker.unsubscribe(game_id, subscriber)
+
+
+async def async_wait_for_turn(game_id, start_index, timeout):
+    # wait_for_turn which does not hold a thread
+    broker = get_broker()
+    subscriber = broker.subscribe(game_id)
+    try:
+        if not await sync_to_async(should_wait)(game_id, start_index):
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                message = await asyncio.wait_for(subscriber.get(),
+                                                 remaining)
+            except asyncio.TimeoutError:
+                return
+            if wakes(message, start_index):
+                return
+            if message['event'] == 'resync' and not await sync_to_async(
+                    should_wait)(game_id, start_index):
+                return
+    finally:
+        broker.unsubscribe(game_id, subscriber)
+
+
+def format_sse(message):
+    data = json.dumps({k: v for k, v in message.items() if k != 'event'})
+    return f"event: {message['event']}\ndata: {data}\n\n".encode()
+
+
+class GameEventsApplication:
+    """
+    ASGI wrapper streaming game events as Server-Sent Events.
+
+    Requests to ``<prefix>game/<pk>/events?start_index=N`` are served
+    by the stream, everything else is passed to the wrapped application.
+    The stream starts with a snapshot of the game (start, turns since
+    ``start_index`` and win) and then relays broker events.
+    """
+    heartbeat_interval = 15
+
+    def __init__(self, application, prefix='/api/v1/ticTacToe/'):
+        self.application = application
+        self.path_regex = re.compile(
+            rf'^{re.escape(prefix)}game/(?P<pk>[0-9]+)/events$'
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET' \
+                and (match := self.path_regex.match(scope['path'])):
+            await self.stream(scope, receive, send, int(match['pk']))
+        else:
+            await self.application(scope, receive, send)
+
+    @staticmethod
+    def parse_start_index(scope):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        try:
+            return max(0, int(query.get('start_index', ['0'])[0]))
+        except ValueError:
+            return 0
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    def load_game(pk):
+        from .models import Game
+        return Game.objects.filter(id=pk).first()
+
+    @classmethod
+    def load_events(cls, pk, start_index):
+        if (game := cls.load_game(pk)) is None:
+            return []
+        return list(game_snapshot_events(game, start_index))
+
+    async def stream(self, scope, receive, send, pk):
+        broker = get_broker()
+        # subscribe before loading the game so no event is lost in between
+        queue = broker.subscribe(pk)
+        try:
+            game = await sync_to_async(self.load_game)(pk)
+            if game is None:
+                await send({'type': 'http.response.start', 'status': 404,
+                            'headers': [(b'content-type', b'text/plain')]})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'),
+                            (b'cache-control', b'no-cache')],
+            })
+            next_index = self.parse_start_index(scope)
+            snapshot = await sync_to_async(list)(
+                game_snapshot_events(game, next_index)
+            )
+            for message in snapshot:
+                await self.send_message(send, message)
+            next_index = max(next_index, len(game.history))
+            # the events which are sent once
+            sent = {message['event'] for message in snapshot} \
+                & {'start', 'win'}
+
+            disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+            try:
+                while not disconnect.done():
+                    getter = asyncio.ensure_future(queue.get())
+                    await asyncio.wait({getter, disconnect},
+                                       timeout=self.heartbeat_interval,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        getter.cancel()
+                        if not disconnect.done():
+                            await send({'type': 'http.response.body',
+                                        'body': b': heartbeat\n\n',
+                                        'more_body': True})
+                        continue
+
+                    messages = [getter.result()]
+                    if messages[0]['event'] == 'resync' \
+                            or messages[0]['event'] == 'turn' \
+                            and messages[0]['index'] > next_index:
+                        # events have been lost, the turns since the last
+                        # sent one are reloaded (the event is among them)
+                        messages = await sync_to_async(self.load_events)(
+                            pk, next_index
+                        )
+                    for message in messages:
+                        if message['event'] == 'turn':
+                            # already sent within the snapshot
+                            if message['index'] < next_index:
+                                continue
+                            next_index = message['index'] + 1
+                        elif message['event'] in {'start', 'win'}:
+                            if message['event'] in sent:
+                                continue
+                            sent.add(message['event'])
+                        await self.send_message(send, message)
+            finally:
+                disconnect.cancel()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            broker.unsubscribe(pk, queue)
+
+    @staticmethod
+    async def send_message(send, message):
+        await send({'type': 'http.response.body',
+                    'body': format_sse(message), 'more_body': True})
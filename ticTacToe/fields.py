@@ -0,0 +1,87 @@
+import base64
+import zlib
+from abc import abstractmethod, ABC
+
+import numpy
+from django.db import models
+
+
+class PackedBinaryField(models.BinaryField, ABC):
+    """
+    Binary column that is seen as a plain python value on the model.
+
+    Subclasses define ``pack`` (python value -> bytes)
+    and ``unpack`` (bytes -> python value).
+    """
+
+    @abstractmethod
+    def pack(self, value):
+        return None
+
+    @abstractmethod
+    def unpack(self, data):
+        return None
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return self.unpack(bytes(value))
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            value = base64.b64decode(value.encode('ascii'))
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self.unpack(bytes(value))
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is not None \
+                and not isinstance(value, (bytes, bytearray, memoryview)):
+            value = self.pack(value)
+        return super().get_db_prep_value(value, connection, prepared)
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        if value is None:
+            return None
+        return base64.b64encode(self.pack(value)).decode('ascii')
+
+
+class PackedBoardField(PackedBinaryField):
+    """
+    list[list[int:player_index or -1]] stored as
+    [item size, width, cells...] where every cell is
+    (player_index + 1) in item size little-endian bytes
+    """
+
+    def pack(self, value):
+        cells = numpy.array(value, numpy.int64) + 1
+        item_size = 1 if cells.size == 0 or cells.max() <= 0xff else 2
+        cells = cells.astype(f'<u{item_size}')
+        width = cells.shape[1] if cells.ndim == 2 else 0
+        return bytes((item_size, width)) + cells.tobytes()
+
+    def unpack(self, data):
+        item_size, width = data[0], data[1]
+        cells = numpy.frombuffer(data, f'<u{item_size}', offset=2)
+        if width == 0:
+            return []
+        return (cells.reshape(-1, width).astype(numpy.int64) - 1).tolist()
+
+
+class PackedLineRunsField(PackedBinaryField):
+    """
+    numpy.ndarray[uint8] of shape (directions, height, width) stored as
+    [height, width, zlib compressed cells...]
+    (run lengths are kept in run end cells only, so it is mostly zeros)
+    """
+
+    def pack(self, value):
+        height, width = value.shape[1:]
+        return bytes((height, width)) \
+            + zlib.compress(numpy.ascontiguousarray(value, numpy.uint8), 1)
+
+    def unpack(self, data):
+        height, width = data[0], data[1]
+        cells = numpy.frombuffer(zlib.decompress(data[2:]), numpy.uint8)
+        return cells.reshape(-1, height, width).copy()
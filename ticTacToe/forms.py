@@ -4,6 +4,8 @@ from django import forms
 class PageCountForm(forms.Form):
     page = forms.IntegerField(min_value=1, required=False)
     count = forms.IntegerField(min_value=1, max_value=100, required=False)
+    # keyset pagination is used if passed (empty for the first page)
+    cursor = forms.CharField(required=False)
 
     def clean_page(self):
         return int(self.data.get('page', 1))
@@ -11,10 +13,42 @@ class PageCountForm(forms.Form):
     def clean_count(self):
         return int(self.data.get('count', 10))
 
+    def clean_cursor(self):
+        return self.data.get('cursor')
+
 
 class HistorySuffixForm(forms.Form):
     start_index = forms.IntegerField(min_value=0, max_value=9999)
+    # seconds to wait for a turn if there are no turns since start_index
+    wait = forms.FloatField(min_value=0, max_value=30, required=False)
+
+
+class BoardForm(forms.Form):
+    # the board after that many turns
+    index = forms.IntegerField(min_value=0, max_value=10000)
+
+
+class BoardDeltaForm(forms.Form):
+    # changes from the board after start_index turns
+    # to the one after end_index turns, either may be the greater
+    start_index = forms.IntegerField(min_value=0, max_value=10000)
+    end_index = forms.IntegerField(min_value=0, max_value=10000)
+
+
+class ProjectionForm(forms.Form):
+    # comma separated names of serializer fields, all of them if missing
+    fields = forms.CharField(required=False)
+
+    def clean_fields(self):
+        if not (fields := self.cleaned_data['fields']):
+            return None
+        return [name.strip() for name in fields.split(',')]
 
 
 class MyGamesForm(forms.Form):
     finished = forms.NullBooleanField()
+
+
+class PictureForm(forms.Form):
+    # longest side in pixels, rounded up to a prepared one
+    size = forms.IntegerField(min_value=1, required=False)
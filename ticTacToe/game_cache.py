@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import events, profiling
+from .models import Game
+from .serializers import GamePlayersSerializer, GameColorsSerializer
+
+
+def game_state(game):
+    # everything the read views of a running game need,
+    # decoded and serialized once
+    with profiling.timed('serializer'):
+        players = GamePlayersSerializer(game).data['players']
+        colors = GameColorsSerializer(game).data['colors']
+    return {
+        'version': game.version,
+        'status': game.status,
+        'started': game.started,
+        'players': players,
+        'colors': colors,
+        'history': game.history,
+        'turns_count': len(game.history),
+        # the bot whose turn is searched for (see bot.resume)
+        'bot': game.current_bot,
+    }
+
+
+class GameStateCache:
+    """
+    Cache of the states (see game_state) of unfinished games.
+
+    Writers invalidate a game after their transaction is committed,
+    which also bumps its generation, so a reader which loaded the game
+    before an invalidation does not put its stale state afterwards.
+    """
+
+    def load(self, game_id, load_game):
+        """
+        Returns (state, None) for a cached or just cached game
+        and (None, game) for a finished game loaded by load_game.
+        """
+        if (state := self.get(game_id)) is not None:
+            return state, None
+
+        generation = self.generation(game_id)
+        game = load_game()
+        if game.status in [Game.Status.FINISHED, Game.Status.DRAW]:
+            return None, game
+        state = game_state(game)
+        self.put(game_id, generation, state)
+        return state, None
+
+    def invalidate_on_commit(self, game_id):
+        transaction.on_commit(lambda: self.invalidate(game_id))
+
+
+class LocalGameStateCache(GameStateCache):
+    """
+    In-process LRU of game states, not pickled.
+
+    Invalidations are sent to the other processes through
+    the event broker, so the processes share them on Postgres
+    (see events.PostgresEventBroker) and the cache is local
+    to a single worker with the local broker.
+    """
+
+    def __init__(self):
+        self.max_games = settings.TIC_TAC_TOE_GAME_CACHE_MAX_GAMES
+        self.timeout = settings.TIC_TAC_TOE_GAME_CACHE_TIMEOUT
+        self._lock = threading.Lock()
+        # dict[int:game_id -> tuple[float:expiry_time, dict:state]]
+        self._states = OrderedDict()
+        # the number of invalidations when a game was invalidated last,
+        # the games which are not there are as old as _floor
+        self._invalidations = 0
+        self._generations = {}
+        self._floor = 0
+        events.get_broker().add_listener(self.receive)
+
+    def get(self, game_id):
+        with self._lock:
+            if (entry := self._states.get(game_id)) is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._states[game_id]
+                return None
+            self._states.move_to_end(game_id)
+            return entry[1]
+
+    def generation(self, game_id):
+        with self._lock:
+            return self._generations.get(game_id, self._floor)
+
+    def put(self, game_id, generation, state):
+        with self._lock:
+            if self._generations.get(game_id, self._floor) != generation:
+                return
+            self._states[game_id] = (time.monotonic() + self.timeout, state)
+            self._states.move_to_end(game_id)
+            while len(self._states) > self.max_games:
+                self._states.popitem(last=False)
+
+    def receive(self, game_id, event):
+        if event['event'] == 'invalidate':
+            self.drop(game_id)
+        elif event['event'] == 'resync':
+            # invalidations may have been lost
+            self.clear()
+
+    def invalidate(self, game_id):
+        # dropped here at once, the broker may deliver it later
+        self.drop(game_id)
+        events.get_broker().publish(game_id, {'event': 'invalidate'})
+
+    def drop(self, game_id):
+        with self._lock:
+            self._states.pop(game_id, None)
+            self._invalidations += 1
+            self._generations[game_id] = self._invalidations
+            if len(self._generations) > 4 * self.max_games:
+                # as if all the games were invalidated now
+                self._generations.clear()
+                self._floor = self._invalidations
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._generations.clear()
+            self._floor = self._invalidations
+
+
+class SharedGameStateCache(GameStateCache):
+    """
+    Game states in a django cache (settings.TIC_TAC_TOE_GAME_CACHE_ALIAS)
+    shared by all the processes, e.g. memcached or redis.
+
+    The local memory cache of django can stand in for it in development.
+    """
+
+    def __init__(self):
+        self.cache = caches[settings.TIC_TAC_TOE_GAME_CACHE_ALIAS]
+        self.timeout = settings.TIC_TAC_TOE_GAME_CACHE_TIMEOUT
+
+    @staticmethod
+    def state_key(game_id):
+        return f'tic-tac-toe-game-state-{game_id}'
+
+    @staticmethod
+    def generation_key(game_id):
+        return f'tic-tac-toe-game-generation-{game_id}'
+
+    def get(self, game_id):
+        return self.cache.get(self.state_key(game_id))
+
+    def generation(self, game_id):
+        return self.cache.get(self.generation_key(game_id), 0)
+
+    def put(self, game_id, generation, state):
+        # an invalidation may still slip in between,
+        # the state expires after the timeout anyway
+        if self.generation(game_id) == generation:
+            self.cache.set(self.state_key(game_id), state, self.timeout)
+
+    def invalidate(self, game_id):
+        self.cache.delete(self.state_key(game_id))
+        try:
+            self.cache.incr(self.generation_key(game_id))
+        except ValueError:
+            # there is no generation yet (or it has been evicted)
+            if not self.cache.add(self.generation_key(game_id), 1, None):
+                self.cache.incr(self.generation_key(game_id))
+
+    def clear(self):
+        # the whole django cache
+        self.cache.clear()
+
+
+@lru_cache(maxsize=None)
+def get_game_states():
+    return import_string(settings.TIC_TAC_TOE_GAME_CACHE)()
+
+
+def game_version_state(pk):
+    # Game.version_query which does not touch the database for hot games
+    if (state := get_game_states().get(pk)) is not None:
+        return state
+    return Game.version_query(pk)
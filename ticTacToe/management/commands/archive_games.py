@@ -0,0 +1,149 @@
+import gzip
+import json
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+
+from ticTacToe.models import Game, Turn
+
+# the packed fields and the bot leases of finished games are empty
+ARCHIVED_FIELDS = [field.name for field in Game._meta.get_fields()
+                   if field.concrete and not field.auto_created
+                   and field.name not in ['field', 'line_runs',
+                                          'bot_lease_turn',
+                                          'bot_lease_until']]
+
+
+class Command(BaseCommand):
+    help = 'Moves finished games to gzipped NDJSON archives and back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['export', 'import'])
+        parser.add_argument('path', help='.ndjson.gz archive')
+        parser.add_argument('--batch', type=int, default=500)
+        parser.add_argument('--older-than', type=int, default=0,
+                            help='Days since the games were finished')
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete the exported games')
+
+    def handle(self, *args, **options):
+        if options['action'] == 'export':
+            report = self.export(options)
+        else:
+            report = self.import_(options)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def archived_query(cutoff):
+        # games finished while exporting are not matched,
+        # finish_time of the games finished before it was added is null
+        return Game.finished_query(Game.objects.all()).filter(
+            Q(finish_time__lt=cutoff) | Q(finish_time__isnull=True)
+        )
+
+    def export(self, options):
+        cutoff = timezone.now() - timedelta(days=options['older_than'])
+        query_set = self.archived_query(cutoff)
+
+        exported = 0
+        last_id = 0
+        with gzip.open(options['path'], 'wt', encoding='utf-8') as archive:
+            while games := list(
+                query_set.filter(id__gt=last_id).order_by('id')
+                .prefetch_related(
+                    'players',
+                    Prefetch('turns', Turn.objects.only('game', 'i', 'j'))
+                )[:options['batch']]
+            ):
+                for game, record in zip(games, serializers.serialize(
+                        'python', games, fields=ARCHIVED_FIELDS)):
+                    record['history'] = game.history
+                    archive.write(json.dumps(record, cls=DjangoJSONEncoder))
+                    archive.write('\n')
+                exported += len(games)
+                last_id = games[-1].id
+
+        deleted = 0
+        if options['delete'] and exported:
+            # the archive is complete before anything is deleted
+            deleted = self.delete(query_set.filter(id__lte=last_id),
+                                  options['batch'])
+        return {'exported': exported, 'deleted': deleted,
+                'path': options['path']}
+
+    @staticmethod
+    def delete(query_set, batch):
+        deleted = 0
+        while ids := list(query_set.values_list('id', flat=True)[:batch]):
+            with transaction.atomic():
+                # turns and players with them
+                Game.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+        return deleted
+
+    def import_(self, options):
+        imported = 0
+        skipped = []
+        with gzip.open(options['path'], 'rt', encoding='utf-8') as archive:
+            while lines := list(islice(archive, options['batch'])):
+                batch_imported, batch_skipped = self.import_batch(
+                    [json.loads(line) for line in lines]
+                )
+                imported += batch_imported
+                skipped += batch_skipped
+        return {'imported': imported, 'skipped': skipped,
+                'path': options['path']}
+
+    @staticmethod
+    def import_batch(records):
+        histories = {record['pk']: record.pop('history')
+                     for record in records}
+        try:
+            objects = list(serializers.deserialize('python', records))
+        except serializers.base.DeserializationError as e:
+            raise CommandError(f'Invalid archive: {e}')
+
+        ids = [obj.object.id for obj in objects]
+        existing = set(Game.objects.filter(id__in=ids)
+                       .values_list('id', flat=True))
+        user_ids = set(User.objects.filter(id__in={
+            user_id for obj in objects
+            for user_id in [obj.object.owner_id,
+                            *obj.m2m_data['players']]
+        }).values_list('id', flat=True))
+
+        games, memberships, turns = [], [], []
+        skipped = []
+        for obj in objects:
+            game = obj.object
+            if game.id in existing or game.owner_id not in user_ids:
+                skipped.append(game.id)
+                continue
+            if game.winner_id not in user_ids:
+                game.winner_id = None
+            games.append(game)
+            memberships += [
+                Game.players.through(game_id=game.id, user_id=user_id)
+                for user_id in obj.m2m_data['players']
+                if user_id in user_ids
+            ]
+            order = game.order
+            turns += [
+                Turn(game_id=game.id, index=index, i=i, j=j,
+                     player_id=order[index % len(order)]
+                     if order[index % len(order)] in user_ids else None)
+                for index, (i, j) in enumerate(histories[game.id])
+            ]
+
+        with transaction.atomic():
+            Game.objects.bulk_create(games)
+            Game.players.through.objects.bulk_create(memberships)
+            Turn.objects.bulk_create(turns)
+        return len(games), skipped
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from ticTacToe import service
+from ticTacToe.game_cache import get_game_states
+from ticTacToe.models import Game
+
+
+class Command(BaseCommand):
+    help = 'Replays stored games in batches and checks their win data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=200)
+        parser.add_argument('--fix', action='store_true',
+                            help='Store replayed win data of invalid games')
+
+    def handle(self, *args, **options):
+        ids = list(Game.objects.filter(started=True)
+                   .order_by('id').values_list('id', flat=True))
+        invalid = []
+        for offset in range(0, len(ids), options['batch']):
+            games = Game.objects.filter(
+                id__in=ids[offset:offset + options['batch']]
+            ).defer('field', 'line_runs').prefetch_related('turns')
+            for game in games:
+                if errors := service.validate_replay(game):
+                    invalid.append({'id': game.id, 'errors': errors})
+                    if options['fix']:
+                        self.fix(game)
+
+        self.stdout.write(json.dumps({
+            'checked': len(ids),
+            'invalid': invalid,
+            'fixed': options['fix'],
+        }, indent=2))
+
+    @staticmethod
+    def fix(game):
+        win_data = service.replay_win_data(game) or {}
+        Game.objects.filter(id=game.id).update(
+            win_line_start_i=win_data.get('start_i'),
+            win_line_start_j=win_data.get('start_j'),
+            win_line_direction_i=win_data.get('direction_i'),
+            win_line_direction_j=win_data.get('direction_j'),
+            # rebuilt on the next turn if the game is not finished
+            field=None, line_runs=None, version=F('version') + 1,
+        )
+        Game.update_results(Game.objects.filter(id=game.id))
+        get_game_states().invalidate(game.id)
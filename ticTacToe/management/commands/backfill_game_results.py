@@ -0,0 +1,22 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ticTacToe.models import Game
+
+
+class Command(BaseCommand):
+    help = 'Recomputes status and winner of the games from their win data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        ids = list(Game.objects.order_by('id').values_list('id', flat=True))
+        updated = 0
+        # short updates instead of one long lock on the whole table
+        for offset in range(0, len(ids), options['batch']):
+            updated += Game.update_results(Game.objects.filter(
+                id__in=ids[offset:offset + options['batch']]
+            ))
+        self.stdout.write(json.dumps({'games': len(ids), 'updated': updated}))
@@ -0,0 +1,265 @@
+import json
+import random
+import time
+import tracemalloc
+import uuid
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ticTacToe import service
+from ticTacToe.models import Game
+from ticTacToe.views import (
+    MakeTurnView, HistorySuffixView, GameDetailView, GamePlayersView,
+    StartedGamesView, WaitingGamesView, MyGamesView, CircleCrossPictureView,
+    GameBoardPictureView
+)
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        'mean_ms': round(sum(latencies) / len(latencies) * 1e3, 3),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1e3, 3),
+        'p95_ms': round(latencies[len(latencies) * 95 // 100] * 1e3, 3),
+        'max_ms': round(latencies[-1] * 1e3, 3),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the game API hot paths and prints a JSON report'
+    # against the configured database, e.g. DATABASE_NAME=postgresql
+    # DATABASE_URL=postgres://localhost/tictactoe manage.py bench_api
+
+    sections = ['make_turn', 'win_check', 'lists', 'history_suffix',
+                'images', 'memory']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sections', nargs='+', choices=self.sections,
+                            default=self.sections)
+        parser.add_argument('--size', type=int, default=100)
+        parser.add_argument('--turns', type=int, default=10000)
+        parser.add_argument('--bucket', type=int, default=1000,
+                            help='Turns per MakeTurnView latency bucket')
+        parser.add_argument('--games', type=int, default=100,
+                            help='Games in the lobbies')
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true',
+                            help='Do not delete the games and their players')
+
+    def handle(self, *args, **options):
+        if options['turns'] > options['size'] ** 2:
+            raise CommandError('There are less cells than turns')
+
+        self.options = options
+        self.factory = APIRequestFactory()
+        self.prefix = f'bench-{uuid.uuid4().hex[:8]}'
+        self.players = [User.objects.create(username=f'{self.prefix}-{k}')
+                        for k in range(3)]
+        self.game = Game.objects.create(
+            width=options['size'], height=options['size'],
+            # nobody should win before all turns are made
+            win_threshold=options['size'], owner=self.players[0],
+            colors=['#c00000', '#00c000', '#0000c0'],
+            order=[player.id for player in self.players], started=True,
+            status=Game.Status.STARTED,
+        )
+        self.game.players.add(*self.players)
+
+        report = {
+            'database': connection.vendor,
+            'size': options['size'],
+            'turns': options['turns'],
+        }
+        try:
+            # turns first, the other sections read the long game
+            for section in self.sections:
+                if section in options['sections']:
+                    report[section] = getattr(self, f'bench_{section}')()
+        finally:
+            if not options['keep']:
+                Game.objects.filter(owner__username__startswith=self.prefix) \
+                    .delete()
+                User.objects.filter(username__startswith=self.prefix) \
+                    .delete()
+
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def request(self, view, method='get', user=None, data=None, **extra):
+        if method == 'get':
+            request = self.factory.get('/', data, **extra)
+        else:
+            request = getattr(self.factory, method)('/', data, format='json')
+        if user is not None:
+            force_authenticate(request, user)
+        response = view(request, **getattr(view, 'bench_kwargs', {}))
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    def measure(self, call, repeat):
+        latencies = []
+        with CaptureQueriesContext(connection) as context:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                response = call()
+                latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise CommandError(f'{response.status_code}: {response.content}')
+        return {
+            'status': response.status_code,
+            'queries': len(context.captured_queries) // repeat,
+            **percentiles(latencies),
+            'requests_per_second': round(repeat / sum(latencies), 1),
+        }
+
+    def game_view(self, view_class, **kwargs):
+        view = view_class.as_view()
+        view.bench_kwargs = {'pk': self.game.id, **kwargs}
+        return view
+
+    def bench_make_turn(self):
+        size = self.options['size']
+        cells = [(i, j) for i in range(size) for j in range(size)]
+        random.Random(self.options['seed']).shuffle(cells)
+
+        view = self.game_view(MakeTurnView)
+        users = {player.id: player for player in self.players}
+        order = self.game.order
+        buckets = []
+        latencies = []
+        for index, (i, j) in enumerate(cells[:self.options['turns']]):
+            user = users[order[index % len(order)]]
+            start = time.perf_counter()
+            response = self.request(view, method='patch', user=user,
+                                    data={'i': i, 'j': j})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise CommandError(f'Turn #{index}: {response.data}')
+            if len(latencies) == self.options['bucket']:
+                buckets.append({'history_length': index + 1,
+                                **percentiles(latencies)})
+                latencies = []
+        if latencies:
+            buckets.append({'history_length': self.options['turns'],
+                            **percentiles(latencies)})
+        return buckets
+
+    def bench_win_check(self):
+        out = StringIO()
+        lengths = sorted({min(length, self.options['size'] ** 2 - 1)
+                          for length in [100, 1000, 5000, 9999]})
+        call_command('bench_win_check', size=self.options['size'],
+                     lengths=lengths, seed=self.options['seed'], stdout=out)
+        return json.loads(out.getvalue())['results']
+
+    def bench_lists(self):
+        owner, user = self.players[:2]
+        for k in range(self.options['games']):
+            game = Game.objects.create(
+                width=3, height=3, win_threshold=3, owner=owner,
+                colors={owner.id: '#000000'}, started=k % 2 == 0,
+                status=Game.Status.STARTED if k % 2 == 0
+                else Game.Status.WAITING,
+            )
+            game.players.add(owner, user)
+
+        results = {}
+        for name, view_class in [('started', StartedGamesView),
+                                 ('waiting', WaitingGamesView),
+                                 ('my', MyGamesView)]:
+            view = view_class.as_view()
+            for mode, params in [('offset', {'count': 100}),
+                                 ('cursor', {'count': 100, 'cursor': ''})]:
+                results[f'{name}_{mode}'] = self.measure(
+                    lambda: self.request(view, user=user, data=params),
+                    self.options['repeat']
+                )
+        return results
+
+    def bench_history_suffix(self):
+        view = self.game_view(HistorySuffixView)
+        turns_count = self.game.turns.count()
+        results = {}
+        for name, start_index in [('full', 0),
+                                  ('last_turn', max(turns_count - 1, 0)),
+                                  ('up_to_date', turns_count)]:
+            results[name] = self.measure(
+                lambda: self.request(view, data={'start_index': start_index}),
+                self.options['repeat']
+            )
+
+        # a poll of a client which has already got the game
+        etag = self.request(view, data={'start_index': turns_count})['ETag']
+        results['not_modified'] = self.measure(
+            lambda: self.request(view, data={'start_index': turns_count},
+                                 HTTP_IF_NONE_MATCH=etag),
+            self.options['repeat']
+        )
+        return results
+
+    def bench_images(self):
+        out = StringIO()
+        call_command('bench_images', seed=self.options['seed'], stdout=out)
+        results = json.loads(out.getvalue())
+
+        view = CircleCrossPictureView.as_view()
+        view.bench_kwargs = {'name': 'circle', 'rgb': 'c00000'}
+        results['piece_view'] = self.measure(
+            lambda: self.request(view), self.options['repeat']
+        )
+
+        view = self.game_view(GameBoardPictureView)
+        for size in [None, 256]:
+            cell_size = service.board_cell_size(self.game.width,
+                                                self.game.height, size)
+            results[f'board_{size or "full"}_render'] = \
+                self.measure_board(cell_size)
+            results[f'board_{size or "full"}_view'] = self.measure(
+                lambda: self.request(view, data={'size': size} if size
+                                     else None),
+                self.options['repeat']
+            )
+        return results
+
+    def measure_board(self, cell_size, repeat=5):
+        game = Game.objects.get(id=self.game.id)
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            service.render_board_bytes(game, cell_size)
+            latencies.append(time.perf_counter() - start)
+        return percentiles(latencies)
+
+    def bench_memory(self):
+        # tracemalloc slows everything down, so it is run apart
+        user = self.players[0]
+        turns_count = self.game.turns.count()
+        endpoints = {
+            'detail': (self.game_view(GameDetailView), None),
+            'players': (self.game_view(GamePlayersView), None),
+            'history_suffix': (self.game_view(HistorySuffixView),
+                               {'start_index': 0}),
+            'history_suffix_up_to_date': (self.game_view(HistorySuffixView),
+                                          {'start_index': turns_count}),
+            'started': (StartedGamesView.as_view(), {'count': 100}),
+            'my': (MyGamesView.as_view(), {'count': 100}),
+            'board_picture': (self.game_view(GameBoardPictureView),
+                              {'size': 512}),
+        }
+        results = {}
+        for name, (view, params) in endpoints.items():
+            # rendered images must not be taken from the cache
+            service.get_image_cache().clear()
+            tracemalloc.start()
+            self.request(view, user=user, data=params)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = {'peak_memory_bytes': peak}
+        return results
@@ -0,0 +1,74 @@
+import json
+import random
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from PIL import Image
+
+from ticTacToe import service
+
+
+def render_float(r, g, b, name):
+    # the former float64 tinting, kept as the baseline
+    pattern = numpy.array(service.get_image_pattern(name))
+    pix_array = numpy.multiply(pattern, (r / 255, g / 255, b / 255, 1))
+    pix_array = numpy.round(pix_array, 0).astype(numpy.uint8)
+    buffered = BytesIO()
+    Image.fromarray(pix_array).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+class Command(BaseCommand):
+    help = 'Measures per-color piece image render latency and peak memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--colors', type=int, default=20)
+        parser.add_argument('--levels', type=int, nargs='+',
+                            default=[1, 6, 9])
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        colors = [(rng.randrange(256), rng.randrange(256), rng.randrange(256),
+                   rng.choice(['circle', 'cross']))
+                  for _ in range(options['colors'])]
+        # patterns are loaded once per worker, not measured
+        for name in ['circle', 'cross']:
+            service.get_image_planes(name)
+
+        results = [dict(renderer='float', compress_level=6,
+                        **self.measure(render_float, colors))]
+        for level in options['levels']:
+            with override_settings(
+                    TIC_TAC_TOE_IMAGE_PNG_COMPRESS_LEVEL=level):
+                results.append(dict(
+                    renderer='table', compress_level=level,
+                    **self.measure(service.render_image_bytes, colors)
+                ))
+        self.stdout.write(json.dumps({'colors': len(colors),
+                                      'results': results}, indent=2))
+
+    @staticmethod
+    def measure(render, colors):
+        latencies = []
+        sizes = []
+        tracemalloc.start()
+        for color in colors:
+            start = time.perf_counter()
+            sizes.append(len(render(*color)))
+            latencies.append(time.perf_counter() - start)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        latencies.sort()
+        return {
+            'mean_ms': round(sum(latencies) / len(latencies) * 1e3, 3),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1e3, 3),
+            'max_ms': round(latencies[-1] * 1e3, 3),
+            'mean_png_bytes': sum(sizes) // len(sizes),
+            'peak_memory_bytes': peak,
+        }
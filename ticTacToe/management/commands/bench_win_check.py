@@ -0,0 +1,88 @@
+import json
+import random
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from ticTacToe import service
+
+
+class Command(BaseCommand):
+    help = 'Compares win check implementations on long histories'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100)
+        parser.add_argument('--threshold', type=int, default=5)
+        parser.add_argument('--players', type=int, default=2)
+        parser.add_argument('--lengths', type=int, nargs='+',
+                            default=[100, 1000, 5000, 9999])
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        size = options['size']
+        cells = [[i, j] for i in range(size) for j in range(size)]
+        random.Random(options['seed']).shuffle(cells)
+
+        results = []
+        for length in options['lengths']:
+            game = SimpleNamespace(
+                width=size, height=size, win_threshold=options['threshold'],
+                order=list(range(options['players'])),
+                history=cells[:length], field=None, line_runs=None,
+            )
+            last_i, last_j = game.history[-1]
+            results.append({
+                'history_length': length,
+                'history_us': self.measure(
+                    lambda: service.check_win_history(last_i, last_j, game),
+                    options['repeat']
+                ),
+                'init_field_us': self.measure(
+                    lambda: service.init_field(game), options['repeat']
+                ),
+                'field_us': self.measure(
+                    lambda: service.check_win_field(last_i, last_j, game),
+                    options['repeat']
+                ),
+                'line_runs_rebuild_us': self.measure(
+                    lambda: service.init_line_runs(game), options['repeat']
+                ),
+                'line_runs_us': self.measure_line_runs(
+                    game, options['repeat']
+                ),
+            })
+
+        self.stdout.write(json.dumps({
+            'size': size,
+            'threshold': options['threshold'],
+            'players': options['players'],
+            'results': results,
+        }, indent=2))
+
+    @staticmethod
+    def measure(action, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            action()
+        return round((time.perf_counter() - start) / repeat * 1e6, 2)
+
+    @staticmethod
+    def measure_line_runs(game, repeat):
+        # the index must not contain the last turn before it is added
+        last_i, last_j = game.history[-1]
+        game.history = game.history[:-1]
+        service.init_line_runs(game)
+        game.history.append([last_i, last_j])
+        game.field[last_i][last_j] = \
+            (len(game.history) - 1) % len(game.order)
+
+        line_runs = game.line_runs
+        elapsed = 0
+        for _ in range(repeat):
+            game.line_runs = line_runs.copy()
+            start = time.perf_counter()
+            service.add_to_line_runs(last_i, last_j, game)
+            elapsed += time.perf_counter() - start
+        return round(elapsed / repeat * 1e6, 2)
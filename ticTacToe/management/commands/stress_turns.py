@@ -0,0 +1,128 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ticTacToe.models import Game, Turn
+from ticTacToe.views import MakeTurnView
+
+
+class Command(BaseCommand):
+    help = 'Fires concurrent turns at one game and checks history integrity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=4)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--turns', type=int, default=200)
+        parser.add_argument('--size', type=int, default=30)
+        parser.add_argument('--keep', action='store_true',
+                            help='Do not delete the game and its players')
+
+    def handle(self, *args, **options):
+        if options['turns'] > options['size'] ** 2:
+            raise CommandError('There are less cells than turns')
+
+        prefix = f'stress-{uuid.uuid4().hex[:8]}'
+        players = [User.objects.create(username=f'{prefix}-{k}')
+                   for k in range(options['players'])]
+        game = Game.objects.create(
+            width=options['size'], height=options['size'],
+            # nobody should win before all turns are made
+            win_threshold=options['size'], owner=players[0],
+            colors=['#000000'] * len(players),
+            order=[player.id for player in players], started=True,
+            status=Game.Status.STARTED,
+        )
+        game.players.add(*players)
+
+        try:
+            statuses, elapsed = self.fire(game, players, options)
+            report = {
+                'game': game.id,
+                'threads': options['threads'],
+                'requests': sum(statuses.values()),
+                'statuses': {str(k): v for k, v in statuses.items()},
+                'seconds': round(elapsed, 3),
+                'turns_per_second': round(statuses[200] / elapsed, 1),
+                'errors': self.check_server_errors(statuses)
+                + self.check_integrity(game, statuses[200]),
+            }
+        finally:
+            if not options['keep']:
+                game.delete()
+                User.objects.filter(id__in=[p.id for p in players]).delete()
+
+        self.stdout.write(json.dumps(report, indent=2))
+        if report['errors']:
+            raise CommandError('History integrity is broken')
+
+    @staticmethod
+    def fire(game, players, options):
+        factory = APIRequestFactory()
+        view = MakeTurnView.as_view()
+        users = {player.id: player for player in players}
+        statuses = Counter()
+        lock = threading.Lock()
+
+        def worker():
+            rng = random.Random()
+            try:
+                while True:
+                    # racy on purpose: several threads aim at the same turn
+                    made = Turn.objects.filter(game=game).count()
+                    if made >= options['turns'] or Game.finished_query(
+                            Game.objects.filter(id=game.id)).exists():
+                        return
+                    user = users[game.order[made % len(game.order)]]
+                    request = factory.patch('/', {
+                        'i': rng.randrange(game.height),
+                        'j': rng.randrange(game.width),
+                    }, format='json')
+                    force_authenticate(request, user)
+                    try:
+                        status = view(request, pk=game.id).status_code
+                    except Exception as e:
+                        status = type(e).__name__
+                    with lock:
+                        statuses[status] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(options['threads'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return statuses, time.perf_counter() - start
+
+    @staticmethod
+    def check_server_errors(statuses):
+        # unhandled exceptions are counted by their names
+        failed = sum(count for status, count in statuses.items()
+                     if isinstance(status, str) or status >= 500)
+        return [f'{failed} requests failed'] if failed else []
+
+    @staticmethod
+    def check_integrity(game, accepted):
+        errors = []
+        turns = list(Turn.objects.filter(game=game))
+        if len(turns) != accepted:
+            errors.append(f'{accepted} turns accepted, {len(turns)} stored')
+        if [turn.index for turn in turns] != list(range(len(turns))):
+            errors.append('Turn indexes are not contiguous')
+        if len({(turn.i, turn.j) for turn in turns}) != len(turns):
+            errors.append('Several turns on the same cell')
+        for turn in turns:
+            if turn.player_id != game.order[turn.index % len(game.order)]:
+                errors.append(f'Turn #{turn.index} made out of order')
+                break
+        return errors
@@ -0,0 +1,52 @@
+from django.db import migrations
+
+import ticTacToe.fields
+
+
+# history is moved to Turn rows by 0003, so only field is packed here
+# (the name is kept for the databases which have applied it)
+def copy_field(apps, source, target):
+    Game = apps.get_model('ticTacToe', 'Game')
+    batch = []
+    for game in Game.objects.only('id', source).iterator():
+        setattr(game, target, getattr(game, source))
+        batch.append(game)
+        if len(batch) == 500:
+            Game.objects.bulk_update(batch, [target])
+            batch = []
+    if batch:
+        Game.objects.bulk_update(batch, [target])
+
+
+def pack_json(apps, schema_editor):
+    copy_field(apps, 'field', 'field_packed')
+
+
+def unpack_json(apps, schema_editor):
+    copy_field(apps, 'field_packed', 'field')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='field_packed',
+            field=ticTacToe.fields.PackedBoardField(blank=True, default=None,
+                                                    null=True),
+        ),
+        migrations.RunPython(pack_json, unpack_json),
+        migrations.RemoveField(
+            model_name='game',
+            name='field',
+        ),
+        migrations.RenameField(
+            model_name='game',
+            old_name='field_packed',
+            new_name='field',
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def history_to_turns(apps, schema_editor):
+    Game = apps.get_model('ticTacToe', 'Game')
+    Turn = apps.get_model('ticTacToe', 'Turn')
+    for game in Game.objects.only('id', 'order', 'history').iterator():
+        Turn.objects.bulk_create([
+            Turn(game_id=game.id, index=index, i=i, j=j,
+                 player_id=game.order[index % len(game.order)])
+            for index, (i, j) in enumerate(game.history)
+        ], batch_size=500)
+
+
+def turns_to_history(apps, schema_editor):
+    Game = apps.get_model('ticTacToe', 'Game')
+    Turn = apps.get_model('ticTacToe', 'Turn')
+    for game in Game.objects.only('id').iterator():
+        game.history = [
+            [i, j] for i, j in Turn.objects.filter(game_id=game.id)
+            .order_by('index').values_list('i', 'j')
+        ]
+        game.save(update_fields=['history'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ticTacToe', '0002_packed_history_and_field'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Turn',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('i', models.PositiveSmallIntegerField()),
+                ('j', models.PositiveSmallIntegerField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='turns', to='ticTacToe.game')),
+                ('player', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tic_tac_toe_turns', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['index'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='turn',
+            constraint=models.UniqueConstraint(fields=('game', 'index'), name='unique_game_turn_index'),
+        ),
+        migrations.RunPython(history_to_turns, turns_to_history),
+        migrations.RemoveField(
+            model_name='game',
+            name='history',
+        ),
+    ]
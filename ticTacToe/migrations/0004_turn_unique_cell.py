@@ -0,0 +1,17 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0003_turn'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='turn',
+            constraint=models.UniqueConstraint(fields=('game', 'i', 'j'), name='unique_game_turn_cell'),
+        ),
+    ]
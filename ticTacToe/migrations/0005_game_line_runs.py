@@ -0,0 +1,19 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:31
+
+from django.db import migrations
+import ticTacToe.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0004_turn_unique_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='line_runs',
+            field=ticTacToe.fields.PackedLineRunsField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_results(apps, schema_editor):
+    # Game.update_results, the turns are there since 0003
+    Game = apps.get_model('ticTacToe', 'Game')
+    Turn = apps.get_model('ticTacToe', 'Turn')
+    winner_id = Turn.objects.filter(
+        game=models.OuterRef('pk'),
+        i=models.OuterRef('win_line_start_i'),
+        j=models.OuterRef('win_line_start_j'),
+    ).values('player_id')[:1]
+    unfinished = Game.objects.filter(win_line_start_i__isnull=True)
+    unfinished.filter(started=True).update(status='started')
+    Game.objects.filter(win_line_start_i=-1).update(status='draw')
+    Game.objects.filter(win_line_start_i__gte=0).update(
+        status='finished', winner_id=models.Subquery(winner_id)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ticTacToe', '0005_game_line_runs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='finish_time',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'Waiting'), ('started', 'Started'), ('finished', 'Finished'), ('draw', 'Draw')], db_index=True, default='waiting', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='winner',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='won_tic_tac_toe_games', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(set_results, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0006_game_results'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['started', '-creation_time', '-id'], name='game_started_lobby_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['status', '-creation_time', '-id'], name='game_status_lobby_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['-creation_time', '-id'], name='game_lobby_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+import ticTacToe.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0008_game_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BoardSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('field', ticTacToe.fields.PackedBoardField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='ticTacToe.game')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='boardsnapshot',
+            constraint=models.UniqueConstraint(fields=('game', 'index'), name='unique_game_snapshot_index'),
+        ),
+    ]
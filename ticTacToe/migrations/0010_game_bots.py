@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0009_board_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='bots',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
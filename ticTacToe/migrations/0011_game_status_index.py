@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0010_game_bots'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='game',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'Waiting'), ('started', 'Started'), ('finished', 'Finished'), ('draw', 'Draw')], default='waiting', max_length=8),
+        ),
+    ]
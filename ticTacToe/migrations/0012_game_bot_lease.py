@@ -0,0 +1,23 @@
+# Generated by Django 3.1.4 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ticTacToe', '0011_game_status_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='bot_lease_turn',
+            field=models.PositiveIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='bot_lease_until',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
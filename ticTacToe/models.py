@@ -1,11 +1,21 @@
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
+
+from .fields import PackedBoardField, PackedLineRunsField
 
 game_size_validators = [MinValueValidator(1), MaxValueValidator(100)]
 
 
 class Game(models.Model):
+    class Status(models.TextChoices):
+        WAITING = 'waiting'
+        STARTED = 'started'
+        FINISHED = 'finished'
+        DRAW = 'draw'
+
     width = models.PositiveIntegerField(validators=game_size_validators)
     height = models.PositiveIntegerField(validators=game_size_validators)
     win_threshold = models.PositiveIntegerField(
@@ -20,14 +30,21 @@ class Game(models.Model):
     colors = models.JSONField()
     # list[int:id]
     order = models.JSONField(default=list, blank=True)
-    # list[tuple[int:i, int:j]]
-    history = models.JSONField(default=list, blank=True)
+    # list[int:id] of the players whose turns are made by the server
+    # (see bot)
+    bots = models.JSONField(default=list, blank=True)
 
-    # field and history must not have conflicts
+    # saved every settings.TIC_TAC_TOE_FIELD_SAVE_INTERVAL turns,
+    # so it can miss the latest turns (see service.load_field),
     # if null so history should be used
     # (field can be initialized from history at any time)
     # list[list[int:player_index or -1]]
-    field = models.JSONField(default=None, null=True, blank=True)
+    # (stored packed, one byte per cell)
+    field = PackedBoardField(default=None, null=True, blank=True)
+    # saved with field while the game is not finished
+    # (see service.add_to_line_runs)
+    # numpy.ndarray[direction, i, j -> run length at run ends]
+    line_runs = PackedLineRunsField(default=None, null=True, blank=True)
     creation_time = models.DateTimeField(auto_now_add=True)
     started = models.BooleanField(default=False)
 
@@ -40,45 +57,214 @@ class Game(models.Model):
     win_line_direction_j = models.IntegerField(default=None, null=True,
                                                blank=True)
 
+    # denormalized results, kept by the views which change the game
+    # (see update_results for games stored before),
+    # status is indexed by game_status_lobby_idx
+    status = models.CharField(max_length=8, choices=Status.choices,
+                              default=Status.WAITING)
+    winner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True,
+                               blank=True, default=None,
+                               related_name='won_tic_tac_toe_games')
+    finish_time = models.DateTimeField(default=None, null=True, blank=True,
+                                       db_index=True)
+    # incremented on every change of the game, its turns or players
+    # (the ETag of the game views)
+    version = models.PositiveIntegerField(default=0)
+    # the search for the bot turn bot_lease_turn is taken by a worker
+    # until bot_lease_until (see bot.submit), not a change of the game
+    bot_lease_turn = models.PositiveIntegerField(default=None, null=True,
+                                                 blank=True)
+    bot_lease_until = models.DateTimeField(default=None, null=True,
+                                           blank=True)
+
+    class Meta:
+        indexes = [
+            # lobbies (see StartedGamesView, WaitingGamesView, MyGamesView)
+            models.Index(fields=['started', '-creation_time', '-id'],
+                         name='game_started_lobby_idx'),
+            models.Index(fields=['status', '-creation_time', '-id'],
+                         name='game_status_lobby_idx'),
+            models.Index(fields=['-creation_time', '-id'],
+                         name='game_lobby_idx'),
+        ]
+
     @property
     def str_status(self):
-        if self.finished:
-            return 'finished'
-        elif self.started:
-            return 'started'
-        else:
-            return 'waiting'
+        return self.status
 
     def __str__(self):
         return f"[{self.str_status}] " \
                f"{self.width}x{self.height}x{self.win_threshold} game with " \
                f"[{', '.join(str(u) for u in self.players.all())}]"
 
+    # list[tuple[int:i, int:j]]
+    # (loaded from turns, append a Turn to make a move)
+    @cached_property
+    def history(self):
+        return [[turn.i, turn.j] for turn in self.turns.all()]
+
+    @cached_property
+    def turns_count(self):
+        if 'history' in self.__dict__:
+            return len(self.history)
+        return self.turns.count()
+
+    def add_turn(self, i, j):
+        """
+        Saves a turn of the current player and puts it on the field,
+        the game row itself is not saved
+        """
+        index = self.turns_count
+        player_index = index % len(self.order)
+        Turn.objects.create(game=self, index=index, i=i, j=j,
+                            player_id=self.order[player_index])
+
+        if 'history' in self.__dict__:
+            self.history.append([i, j])
+        self.turns_count += 1
+        if self.field is not None:
+            self.field[i][j] = player_index
+
+    @staticmethod
+    def version_query(pk):
+        # one primary key lookup for conditional requests,
+        # with the bot whose turn it is (see bot.resume)
+        turns_count = Turn.objects.filter(game=models.OuterRef('pk')) \
+            .order_by().values('game') \
+            .annotate(count=models.Count('id')).values('count')
+        state = Game.objects.filter(id=pk) \
+            .annotate(turns_count=Coalesce(models.Subquery(turns_count), 0)) \
+            .values('version', 'status', 'order', 'bots', 'turns_count') \
+            .first()
+        if state is None:
+            return None
+        order, bots = state.pop('order'), state.pop('bots')
+        state['bot'] = None
+        if state['status'] == Game.Status.STARTED:
+            state['bot'] = Game.turn_bot(order, bots, state['turns_count'])
+        return state
+
     @property
     def finished(self):
         return self.win_line_start_i is not None
 
-    @property
-    def winner(self):
-        if not self.finished:
+    @staticmethod
+    def turn_bot(order, bots, turns_count):
+        # id of the bot which makes the turn turns_count of a running game
+        if not bots:
             return None
+        player_id = order[turns_count % len(order)]
+        return player_id if player_id in bots else None
 
-        win = [self.win_line_start_i, self.win_line_start_j]
-        uid = None
-        if self.field is not None:
-            uid = self.field[win[0]][win[1]]
-        else:
-            for pos, i in zip(self.history, range(len(self.history))):
-                if pos[0] == win[0] and pos[1] == win[1]:
-                    uid = self.order[i % len(self.order)]
-                    break
-        if uid is not None:
-            return self.players.filter(id=uid).first()
+    @property
+    def current_bot(self):
+        # id of the bot whose turn it is (see bot),
+        # None if it is not a bot's turn
+        if not self.started or self.finished:
+            return None
+        return Game.turn_bot(self.order, self.bots, self.turns_count)
 
     @staticmethod
     def finished_query(query_set):
-        return query_set.filter(win_line_start_i__isnull=False)
+        return query_set.filter(
+            status__in=[Game.Status.FINISHED, Game.Status.DRAW]
+        )
 
     @staticmethod
     def unfinished_query(query_set):
-        return query_set.filter(win_line_start_i__isnull=True)
+        return query_set.exclude(
+            status__in=[Game.Status.FINISHED, Game.Status.DRAW]
+        )
+
+    @staticmethod
+    def list_query(query_set, user):
+        # everything GameListSerializer and user_joined need
+        # in a constant number of queries
+        if user.is_authenticated:
+            user_joined = models.Exists(Game.players.through.objects.filter(
+                game=models.OuterRef('pk'), user=user
+            ))
+        else:
+            user_joined = models.Value(False, models.BooleanField())
+
+        return query_set.defer('field', 'line_runs') \
+            .select_related('owner', 'winner') \
+            .annotate(user_joined=user_joined)
+
+    @staticmethod
+    def summary_query(query_set):
+        # everything GameSummarySerializer needs in one query,
+        # without history, field and line_runs
+        # (the annotation takes the place of turns_count)
+        turns_count = Turn.objects.filter(game=models.OuterRef('pk')) \
+            .order_by().values('game') \
+            .annotate(count=models.Count('id')).values('count')
+        return query_set.only('status', 'order', 'winner') \
+            .annotate(turns_count=Coalesce(models.Subquery(turns_count), 0))
+
+    @staticmethod
+    def update_results(query_set):
+        # recomputes status and winner from started and win data
+        # (finish_time of the games finished before is unknown)
+        winner_id = Turn.objects.filter(
+            game=models.OuterRef('pk'),
+            i=models.OuterRef('win_line_start_i'),
+            j=models.OuterRef('win_line_start_j'),
+        ).values('player_id')[:1]
+        unfinished = query_set.filter(win_line_start_i__isnull=True)
+        version = models.F('version') + 1
+        return sum([
+            unfinished.filter(started=False)
+            .update(status=Game.Status.WAITING, winner=None, version=version),
+            unfinished.filter(started=True)
+            .update(status=Game.Status.STARTED, winner=None, version=version),
+            query_set.filter(win_line_start_i=-1)
+            .update(status=Game.Status.DRAW, winner=None, version=version),
+            query_set.filter(win_line_start_i__gte=0)
+            .update(status=Game.Status.FINISHED,
+                    winner_id=models.Subquery(winner_id), version=version),
+        ])
+
+
+class Turn(models.Model):
+    game = models.ForeignKey(Game, on_delete=models.CASCADE,
+                             related_name='turns')
+    index = models.PositiveIntegerField()
+    i = models.PositiveSmallIntegerField()
+    j = models.PositiveSmallIntegerField()
+    player = models.ForeignKey(User, on_delete=models.SET_NULL, null=True,
+                               related_name='tic_tac_toe_turns')
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'index'],
+                                    name='unique_game_turn_index'),
+            models.UniqueConstraint(fields=['game', 'i', 'j'],
+                                    name='unique_game_turn_cell'),
+        ]
+
+    def __str__(self):
+        return f"#{self.index} ({self.i}, {self.j}) in game {self.game_id}"
+
+
+class BoardSnapshot(models.Model):
+    """
+    Field of a game after its first ``index`` turns,
+    saved every settings.TIC_TAC_TOE_REPLAY_SNAPSHOT_INTERVAL turns
+    by replays (see replay.board_at)
+    """
+    game = models.ForeignKey(Game, on_delete=models.CASCADE,
+                             related_name='snapshots')
+    index = models.PositiveIntegerField()
+    # list[list[int:player_index or -1]]
+    field = PackedBoardField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'index'],
+                                    name='unique_game_snapshot_index'),
+        ]
+
+    def __str__(self):
+        return f"#{self.index} snapshot of game {self.game_id}"
@@ -0,0 +1,56 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+def encode_cursor(obj, ordering):
+    values = [obj._meta.get_field(field.lstrip('-')).value_to_string(obj)
+              for field in ordering]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, model, ordering):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        # strings of value_to_string (see encode_cursor)
+        if not isinstance(values, list) or len(values) != len(ordering) \
+                or not all(isinstance(value, str) for value in values):
+            raise ValueError
+        values = [model._meta.get_field(field.lstrip('-')).to_python(value)
+                  for field, value in zip(ordering, values)]
+        if None in values:
+            raise ValueError
+        return values
+    except (ValueError, TypeError, ValidationError, binascii.Error):
+        raise ValidationError('Invalid cursor')
+
+
+def keyset_page(query_set, cursor, count, ordering):
+    """
+    Returns objects after the cursor (all the objects for an empty one)
+    and a cursor of the next page or None if it is the last one.
+    ordering must end with a unique field, e.g. ('-creation_time', '-id')
+    """
+    query_set = query_set.order_by(*ordering)
+    if cursor:
+        values = decode_cursor(cursor, query_set.model, ordering)
+        # (a < x) or (a == x and (b < y or (b == y and ...)))
+        after = None
+        for field, value in reversed(list(zip(ordering, values))):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition = Q(**{f'{name}__{lookup}': value})
+            if after is not None:
+                condition |= Q(**{name: value}) & after
+            after = condition
+        query_set = query_set.filter(after)
+
+    page = list(query_set[:count + 1])
+    next_cursor = None
+    if len(page) > count:
+        page = page[:count]
+        next_cursor = encode_cursor(page[-1], ordering)
+    return page, next_cursor
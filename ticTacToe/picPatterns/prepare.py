@@ -1,7 +1,17 @@
-import pickle
-
+import numpy
 from PIL import Image
 
+# longest side of downscaled patterns, see service.IMAGE_PYRAMID_SIZES
+PYRAMID_SIZES = (256, 128, 64, 32)
+
+
+def save_planes(prefix, rgba):
+    # gray to look tints up by and alpha already in its place
+    # of a little-endian RGBA pixel (see service.get_image_planes)
+    numpy.save(f'{prefix}-gray.npy', numpy.ascontiguousarray(rgba[:, :, 0]))
+    numpy.save(f'{prefix}-alpha.npy', rgba[:, :, 3].astype('<u4') << 24)
+
+
 for name1, name2 in [('image_cross.png', 'cross'),
                      ('image_circle.png', 'circle')]:
     pattern = Image.open(name1)
@@ -37,5 +47,20 @@ for name1, name2 in [('image_cross.png', 'cross'),
                 j2 = pattern.size[1] - j - 1
                 result_pixels[i2][j2] = [gray, rgba[3]]
 
-    with open(name2, 'wb') as f:
-        pickle.dump(result_pixels, f)
+    # gray is repeated for r, g and b so the pattern can be tinted
+    # and memory-mapped by workers as is (see service.get_image_pattern)
+    gray_alpha = numpy.array(result_pixels, numpy.uint8)
+    rgba = gray_alpha[:, :, [0, 0, 0, 1]]
+    numpy.save(f'{name2}.npy', rgba)
+    save_planes(name2, rgba)
+
+    # resizing of RGBA images is done with premultiplied alpha by PIL
+    full = Image.fromarray(numpy.ascontiguousarray(rgba), 'RGBA')
+    for size in PYRAMID_SIZES:
+        scale = size / max(full.size)
+        scaled = full.resize((max(1, round(full.size[0] * scale)),
+                              max(1, round(full.size[1] * scale))),
+                             Image.LANCZOS)
+        scaled = numpy.asarray(scaled)
+        numpy.save(f'{name2}-{size}.npy', scaled)
+        save_planes(f'{name2}-{size}', scaled)
@@ -0,0 +1,249 @@
+import cProfile
+import os
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+from backend.middleware import SyncAndAsyncMiddleware
+from . import service
+
+# timings of the request being handled, None if it is not profiled
+current_profile = ContextVar('current_profile', default=None)
+
+# upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.view = 'unresolved'
+        self.seconds = defaultdict(float)
+        self.sql_queries = 0
+        self.running = set()
+        # sampled into cProfile by the threads which run the request
+        # (see run_sampled)
+        self.sampled = False
+        self.profilers = []
+
+    def sql(self, execute, sql, params, many, context):
+        # connection.execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds['sql'] += time.perf_counter() - start
+            self.sql_queries += 1
+
+
+def record_sql(execute, sql, params, many, context):
+    # connection.execute_wrapper of every connection (see track_sql),
+    # the queries count for the request the thread runs for
+    if (profile := current_profile.get()) is None:
+        return execute(sql, params, many, context)
+    return profile.sql(execute, sql, params, many, context)
+
+
+def track_sql(connection, **kwargs):
+    # also a receiver of connection_created, connections are per thread
+    # and the one which runs a view depends on the stack and the view
+    if record_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_sql)
+
+
+def run_sampled(function, *args, **kwargs):
+    # cProfile runs per thread, so it is enabled where the sync work
+    # of a sampled request runs, the event loop would mix the requests up
+    profile = current_profile.get()
+    if profile is None or not profile.sampled:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profile.profilers.append(profiler)
+
+
+@contextmanager
+def timed(name):
+    # time of the block for the request being profiled
+    # (a ContextVar lookup otherwise), nested blocks
+    # (e.g. serialization in a serialization) are counted once
+    profile = current_profile.get()
+    if profile is None or name in profile.running:
+        yield
+        return
+
+    profile.running.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.seconds[name] += time.perf_counter() - start
+        profile.running.discard(name)
+
+
+installed = False
+install_lock = threading.Lock()
+
+
+def install():
+    # queries are counted only if profiling is on
+    # (the serializer and win check times are measured by the
+    # timed blocks of the views, serializers and bot)
+    global installed
+    with install_lock:
+        if installed:
+            return
+        connection_created.connect(track_sql)
+        for existing in connections.all():
+            track_sql(existing)
+        installed = True
+
+
+class Metrics:
+    """
+    Totals of the profiled requests of this process by view.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.durations = defaultdict(lambda: [0] * len(DURATION_BUCKETS))
+        self.totals = defaultdict(lambda: defaultdict(float))
+
+    def observe(self, profile, status, seconds):
+        view = profile.view
+        with self._lock:
+            self.requests[view, status] += 1
+            buckets = self.durations[view]
+            for k, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    buckets[k] += 1
+            totals = self.totals[view]
+            totals['request_seconds'] += seconds
+            totals['sql_queries'] += profile.sql_queries
+            for name, value in profile.seconds.items():
+                totals[f'{name}_seconds'] += value
+
+    def render(self):
+        # Prometheus text exposition format
+        with self._lock:
+            lines = [
+                '# TYPE tictactoe_requests_total counter',
+                *(f'tictactoe_requests_total{{view="{view}",'
+                  f'status="{status}"}} {count}'
+                  for (view, status), count in sorted(self.requests.items())),
+                '# TYPE tictactoe_request_duration_seconds histogram',
+            ]
+            for view, buckets in sorted(self.durations.items()):
+                totals = self.totals[view]
+                count = sum(count for (name, _), count
+                            in self.requests.items() if name == view)
+                lines += [
+                    f'tictactoe_request_duration_seconds_bucket'
+                    f'{{view="{view}",le="{bound}"}} {bucket}'
+                    for bound, bucket in zip(DURATION_BUCKETS, buckets)
+                ]
+                lines += [
+                    f'tictactoe_request_duration_seconds_bucket'
+                    f'{{view="{view}",le="+Inf"}} {count}',
+                    f'tictactoe_request_duration_seconds_sum'
+                    f'{{view="{view}"}} {totals["request_seconds"]}',
+                    f'tictactoe_request_duration_seconds_count'
+                    f'{{view="{view}"}} {count}',
+                ]
+            for name in ['sql_queries', 'sql_seconds', 'serializer_seconds',
+                         'check_win_seconds']:
+                lines.append(f'# TYPE tictactoe_{name}_total counter')
+                lines += [f'tictactoe_{name}_total{{view="{view}"}} '
+                          f'{totals[name]}'
+                          for view, totals in sorted(self.totals.items())]
+
+        for name, value in service.get_image_cache().stats().items():
+            lines.append(f'tictactoe_image_cache_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class ProfilingMiddleware(SyncAndAsyncMiddleware):
+    """
+    Records the wall time, SQL queries and their time, serializer time
+    and win check time of every request by view (see Metrics),
+    requests are sampled into cProfile dumps if they are slow
+    (under ASGI only the work of the read threads of async_views is,
+    not the one of sync views).
+
+    Removed from the middleware chain unless
+    settings.TIC_TAC_TOE_PROFILING is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.TIC_TAC_TOE_PROFILING:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+        install()
+
+    def handle(self, request):
+        track_sql(connection)
+        profile, token = self.start()
+        start = time.perf_counter()
+        try:
+            response = run_sampled(self.get_response, request)
+        finally:
+            current_profile.reset(token)
+        self.finish(profile, response, time.perf_counter() - start)
+        return response
+
+    async def async_handle(self, request):
+        # sampled in the threads of async_views
+        profile, token = self.start()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        self.finish(profile, response, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def start():
+        profile = RequestProfile()
+        profile.sampled = random.random() \
+            < settings.TIC_TAC_TOE_PROFILING_SAMPLE_RATE
+        return profile, current_profile.set(profile)
+
+    def finish(self, profile, response, seconds):
+        metrics.observe(profile, response.status_code, seconds)
+        if profile.profilers and seconds * 1000 \
+                >= settings.TIC_TAC_TOE_PROFILING_THRESHOLD_MS:
+            self.dump(profile, seconds)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (profile := current_profile.get()) is not None:
+            view = getattr(view_func, 'view_class', view_func)
+            profile.view = view.__name__
+            # run in the thread of a sync view
+            track_sql(connection)
+
+    @staticmethod
+    def dump(profile, seconds):
+        directory = settings.TIC_TAC_TOE_PROFILING_DIR
+        os.makedirs(directory, exist_ok=True)
+        pstats.Stats(*profile.profilers).dump_stats(os.path.join(
+            directory,
+            f'{profile.view}-{time.time():.0f}-{os.getpid()}'
+            f'-{seconds * 1000:.0f}ms.prof'
+        ))
@@ -0,0 +1,77 @@
+import numpy
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from .models import BoardSnapshot
+
+
+def turns_between(game, start_index, end_index):
+    # (index, i, j) rows of the turns in [start_index, end_index)
+    turns = game.turns.filter(index__gte=start_index, index__lt=end_index) \
+        .values_list('index', 'i', 'j')
+    turns = numpy.array(list(turns), numpy.intp).reshape(-1, 3)
+    if len(turns) != end_index - start_index:
+        raise ValidationError(f'The game has less than {end_index} turns')
+    return turns
+
+
+def put_turns(board, turns, players_count):
+    board[turns[:, 1], turns[:, 2]] = turns[:, 0] % players_count
+
+
+def board_at(game, index):
+    """
+    Returns the field (numpy.ndarray, -1 for empty cells) of the game
+    after its first index turns.
+
+    The field is replayed from the latest snapshot before it,
+    the snapshots passed on the way are saved, so a replay costs
+    at most TIC_TAC_TOE_REPLAY_SNAPSHOT_INTERVAL turns once
+    the snapshots are there. The game needs width, height and order.
+    """
+    interval = settings.TIC_TAC_TOE_REPLAY_SNAPSHOT_INTERVAL
+    players_count = max(len(game.order), 1)
+
+    snapshot = game.snapshots.filter(index__lte=index) \
+        .order_by('-index').values_list('index', 'field').first()
+    if snapshot is None:
+        start_index = 0
+        board = numpy.full((game.height, game.width), -1, numpy.int16)
+    else:
+        start_index = snapshot[0]
+        board = numpy.array(snapshot[1], numpy.int16)
+    turns = turns_between(game, start_index, index)
+
+    # the first turns of a game never change, so neither do the snapshots
+    snapshots = []
+    position = start_index
+    for snapshot_index in range(start_index - start_index % interval
+                                + interval, index + 1, interval):
+        put_turns(board, turns[position - start_index:
+                               snapshot_index - start_index], players_count)
+        snapshots.append(BoardSnapshot(game=game, index=snapshot_index,
+                                       field=board.tolist()))
+        position = snapshot_index
+    put_turns(board, turns[position - start_index:], players_count)
+
+    # a concurrent replay may have saved them already
+    BoardSnapshot.objects.bulk_create(snapshots, ignore_conflicts=True)
+    return board
+
+
+def board_delta(game, start_index, end_index):
+    """
+    Returns [i, j, player_index] of the cells changed between the field
+    after start_index turns and the one after end_index turns
+    in the order of the replay, player_index is -1 for the cells
+    which are freed if end_index is the less one.
+    The game needs order.
+    """
+    turns = turns_between(game, min(start_index, end_index),
+                          max(start_index, end_index))
+    if start_index <= end_index:
+        players = turns[:, 0] % max(len(game.order), 1)
+    else:
+        turns = turns[::-1]
+        players = numpy.full(len(turns), -1)
+    return numpy.column_stack([turns[:, 1], turns[:, 2], players]).tolist()
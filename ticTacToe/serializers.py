@@ -1,9 +1,11 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from .models import Game
-from . import service
+from . import profiling, service
 
 
 class PlayerSerializer(serializers.ModelSerializer):
@@ -72,6 +74,7 @@ class GameColorsSerializer(serializers.ModelSerializer):
 
 
 class GameSerializer(serializers.ModelSerializer):
+    history = serializers.ListField(read_only=True)
     players = serializers.SerializerMethodField('get_players')
     colors = serializers.SerializerMethodField('get_colors')
     win_data = serializers.SerializerMethodField('get_win_data')
@@ -86,12 +89,53 @@ class GameSerializer(serializers.ModelSerializer):
     def get_win_data(self, game):
         return WinDataSerializer(game).data
 
+    # model fields read by the fields which are not model fields
+    # (history is read from turns)
+    field_sources = {
+        'history': [],
+        'players': ['started', 'order'],
+        'colors': ['started', 'colors'],
+        'win_data': ['win_line_start_i', 'win_line_start_j',
+                     'win_line_direction_i', 'win_line_direction_j'],
+        'finished': ['win_line_start_i'],
+    }
+
+    def __init__(self, *args, fields=None, **kwargs):
+        # fields is a projection, all the fields if None
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def model_fields(cls, fields):
+        # for .only(), the primary key is passed so it is never empty
+        # (an empty .only() loads every field)
+        return ['id', *{source for name in fields
+                        for source in cls.field_sources.get(name, [name])
+                        if source != 'id'}]
+
     class Meta:
         model = Game
-        exclude = ("field", "win_line_start_i", "win_line_start_j",
+        exclude = ("field", "line_runs", "bot_lease_turn", "bot_lease_until",
+                   "win_line_start_i", "win_line_start_j",
                    "win_line_direction_i", "win_line_direction_j")
 
 
+class GameSummarySerializer(serializers.ModelSerializer):
+    turns_count = serializers.IntegerField()
+    current_player = serializers.SerializerMethodField('get_current_player')
+
+    def get_current_player(self, game):
+        if game.status != Game.Status.STARTED:
+            return None
+        return game.order[game.turns_count % len(game.order)]
+
+    class Meta:
+        model = Game
+        fields = ['id', 'status', 'turns_count', 'current_player', 'winner']
+
+
 class CreateGameSerializer(serializers.ModelSerializer):
     owner_color = serializers.RegexField(r'^#[0-9a-fA-F]{6}$')
 
@@ -133,7 +177,12 @@ class JoinSerializer(serializers.Serializer):
         user = validated_data['user']
         game.players.add(user)
         game.colors[user.id] = validated_data['color']
-        game.save()
+        game.version += 1
+        update_fields = ['colors', 'version']
+        if validated_data.get('bot'):
+            game.bots.append(user.id)
+            update_fields.append('bots')
+        game.save(update_fields=update_fields)
         return game
 
 
@@ -158,8 +207,8 @@ class TurnSerializer(serializers.Serializer):
     def validate(self, data):
         i, j = data['i'], data['j']
         game = self.instance
-        if (game.field is not None and game.field[i][j] != -1
-                or game.field is None and [i, j] in game.history):
+        service.load_field(game)
+        if game.field[i][j] != -1:
             raise serializers.ValidationError(
                 f'Cell ({i}, {j}) is already busy'
             )
@@ -167,19 +216,39 @@ class TurnSerializer(serializers.Serializer):
 
     def update(self, game, validated_data):
         i, j = validated_data['i'], validated_data['j']
-        if game.field:
-            game.field[i][j] = len(game.history) % len(game.order)
-        game.history.append([i, j])
-
-        if win_data := service.check_win(i, j, game):
+        # the only insert which is done on every turn
+        game.add_turn(i, j)
+
+        game.version += 1
+        update_fields = ['version']
+        with profiling.timed('check_win'):
+            win_data = service.check_win(i, j, game)
+        if win_data:
             game.win_line_start_i = win_data['start_i']
             game.win_line_start_j = win_data['start_j']
             game.win_line_direction_i = win_data['direction_i']
             game.win_line_direction_j = win_data['direction_j']
-            game.field = None
-        elif len(game.history) == game.width * game.height:
+            game.status = Game.Status.FINISHED
+            game.winner_id = game.order[(game.turns_count - 1)
+                                        % len(game.order)]
+            update_fields += ['win_line_start_i', 'win_line_start_j',
+                              'win_line_direction_i', 'win_line_direction_j',
+                              'status', 'winner']
+        elif game.turns_count == game.width * game.height:
             game.win_line_start_i = -1
             game.win_line_start_j = -1
+            game.status = Game.Status.DRAW
+            update_fields += ['win_line_start_i', 'win_line_start_j',
+                              'status']
+
+        if game.finished:
             game.field = None
-        game.save()
+            game.line_runs = None
+            game.finish_time = timezone.now()
+            update_fields += ['field', 'line_runs', 'finish_time']
+        elif game.turns_count % settings.TIC_TAC_TOE_FIELD_SAVE_INTERVAL == 0:
+            # the other turns are read again by service.load_field
+            update_fields += ['field', 'line_runs']
+
+        game.save(update_fields=update_fields)
         return game
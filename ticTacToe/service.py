@@ -1,12 +1,16 @@
 import os
-import pickle
+import threading
 from functools import lru_cache
 from io import BytesIO
+from itertools import chain
+from types import SimpleNamespace
 
 import numpy
+from django.conf import settings
 from PIL import Image
 
 from backend.settings import BASE_DIR
+from .caching import BytesLRUCache, DirectoryBytesCache
 
 
 def check_captured(last_i, last_j, game, captured):
@@ -68,44 +72,507 @@ def check_win_history(last_i, last_j, game):
     return check_captured(last_i, last_j, game, captured)
 
 
+def turns_array(history):
+    # fromiter is several times faster than numpy.array on nested lists
+    return numpy.fromiter(chain.from_iterable(history), numpy.intp,
+                          2 * len(history)).reshape(-1, 2)
+
+
+def board_array(height, width, history, players_count):
+    # one scatter instead of a loop over turns
+    board = numpy.full((height, width), -1, numpy.int16)
+    turns = turns_array(history)
+    board[turns[:, 0], turns[:, 1]] = numpy.arange(len(turns)) % players_count
+    return board
+
+
 def init_field(game):
-    game.field = [[-1] * game.width for _ in range(game.height)]
-    for i in range(len(game.history)):
-        turn = game.history[i]
-        game.field[turn[0]][turn[1]] = i % len(game.order)
+    game.field = board_array(game.height, game.width,
+                             game.history, len(game.order)).tolist()
 
 
-def check_win(last_i, last_j, game):
-    if game.field is None \
-            and len(game.history) > 2 * min(game.width, game.height):
-        init_field(game)
+# the order is the same as the one check_captured reports wins in
+LINE_DIRECTIONS = ((1, 1), (1, 0), (1, -1), (0, 1))
+
+
+def line_run_length(i, j, direction, player, game):
+    if (i < 0 or i >= game.height or j < 0 or j >= game.width
+            or game.field[i][j] != player):
+        return 0
+    return int(game.line_runs[direction, i, j])
+
+
+def add_to_line_runs(last_i, last_j, game):
+    # a length of a run of one player's cells along a direction
+    # is kept in both end cells of the run, so a new cell
+    # joins runs of its neighbours in O(1) for every direction
+    player = game.field[last_i][last_j]
+    win_data = None
+    for direction, (step_i, step_j) in enumerate(LINE_DIRECTIONS):
+        before = line_run_length(last_i - step_i, last_j - step_j,
+                                 direction, player, game)
+        after = line_run_length(last_i + step_i, last_j + step_j,
+                                direction, player, game)
+        length = before + after + 1
+        start_i = last_i - step_i * before
+        start_j = last_j - step_j * before
+        end_i = last_i + step_i * after
+        end_j = last_j + step_j * after
+        game.line_runs[direction, start_i, start_j] = length
+        game.line_runs[direction, end_i, end_j] = length
+
+        if win_data is None and length >= game.win_threshold:
+            win_data = {
+                'start_i': start_i,
+                'start_j': start_j,
+                'direction_i': step_i,
+                'direction_j': step_j,
+            }
+    return win_data
+
 
-    if game.field is not None:
-        return check_win_field(last_i, last_j, game)
+def line_run_lengths(board, step_i, step_j):
+    # length of the same-player run through every busy cell
+    # (0 for empty cells), computed row by row along the direction
+    if step_i == 0:
+        return line_run_lengths(board.T, step_j, step_i).T
+
+    height, width = board.shape
+    if step_j == 0:
+        previous = current = slice(0, width)
+    elif step_j > 0:
+        previous, current = slice(0, width - 1), slice(1, width)
     else:
-        return check_win_history(last_i, last_j, game)
+        previous, current = slice(1, width), slice(0, width - 1)
+
+    busy = board >= 0
+    before = numpy.zeros(board.shape, numpy.int32)
+    after = numpy.zeros(board.shape, numpy.int32)
+    for i in range(1, height):
+        same = busy[i, current] \
+            & (board[i, current] == board[i - 1, previous])
+        before[i, current] = numpy.where(same, before[i - 1, previous] + 1, 0)
+    for i in range(height - 2, -1, -1):
+        same = busy[i, previous] \
+            & (board[i, previous] == board[i + 1, current])
+        after[i, previous] = numpy.where(same, after[i + 1, current] + 1, 0)
+    return numpy.where(busy, before + after + 1, 0)
+
+
+def init_line_runs(game):
+    # the index is built for all turns but the last one at once,
+    # the last turn is added as usual to get its win data
+    board = board_array(game.height, game.width,
+                        game.history[:-1], len(game.order))
+    game.line_runs = numpy.minimum(numpy.stack([
+        line_run_lengths(board, step_i, step_j)
+        for step_i, step_j in LINE_DIRECTIONS
+    ]), 0xff).astype(numpy.uint8)
+    game.field = board.tolist()
+
+    if not game.history:
+        return None
+    last_i, last_j = game.history[-1]
+    game.field[last_i][last_j] = (len(game.history) - 1) % len(game.order)
+    return add_to_line_runs(last_i, last_j, game)
+
+
+def load_field(game):
+    """
+    Brings the field and the line runs of the game up to its turns.
+
+    They are saved every settings.TIC_TAC_TOE_FIELD_SAVE_INTERVAL turns
+    (see serializers.TurnSerializer), a turn takes a free cell,
+    so the saved field holds as many turns as it has busy cells
+    and only the turns after them are read and added.
+    """
+    if game.field is None or game.line_runs is None:
+        init_line_runs(game)
+        return
+    saved = int(numpy.count_nonzero(numpy.array(game.field) >= 0))
+    turns = game.turns.filter(index__gte=saved).order_by('index') \
+        .values_list('index', 'i', 'j')
+    players_count = len(game.order)
+    count = saved
+    for index, i, j in turns:
+        game.field[i][j] = index % players_count
+        add_to_line_runs(i, j, game)
+        count = index + 1
+    game.turns_count = count
+
+
+def shifted(array, step_i, step_j, fill):
+    # array[i - step_i, j - step_j] at (i, j), fill outside of the board
+    height, width = array.shape
+    result = numpy.full_like(array, fill)
+    result[max(step_i, 0):height + min(step_i, 0),
+           max(step_j, 0):width + min(step_j, 0)] = \
+        array[max(-step_i, 0):height - max(step_i, 0),
+              max(-step_j, 0):width - max(step_j, 0)]
+    return result
+
+
+def find_threats(game):
+    """
+    Returns, by player index in order, the open lines of
+    win_threshold - 1 and win_threshold - 2 cells of the player
+    (with a free cell at least at one of their ends), the free cells
+    which win for the player and the ones the player has to block
+    (the winning cells of the others).
+
+    Read from the line runs (see add_to_line_runs): a free cell
+    joins the runs which end next to it, as a turn there would.
+    """
+    load_field(game)
+    board = numpy.array(game.field, numpy.int16)
+    height, width = board.shape
+    players_count = len(game.order)
+    threshold = game.win_threshold
+    lengths = [length for length in (threshold - 1, threshold - 2)
+               if length > 0]
+
+    free = board < 0
+    winning = numpy.zeros((players_count, height, width), bool)
+    lines = [[] for _ in range(players_count)]
+    for direction, (step_i, step_j) in enumerate(LINE_DIRECTIONS):
+        runs = game.line_runs[direction].astype(numpy.int32)
+        owner_before = shifted(board, step_i, step_j, -1)
+        run_before = shifted(runs, step_i, step_j, 0)
+        owner_after = shifted(board, -step_i, -step_j, -1)
+        run_after = shifted(runs, -step_i, -step_j, 0)
+        for player in range(players_count):
+            length = numpy.where(owner_before == player, run_before, 0) \
+                + numpy.where(owner_after == player, run_after, 0) + 1
+            winning[player] |= free & (length >= threshold)
+
+        # a run starts where the cell before it is not the player's
+        starts = ~free & (owner_before != board) & numpy.isin(runs, lengths)
+        for i, j in numpy.argwhere(starts).tolist():
+            length = int(runs[i, j])
+            ends = [(i - step_i, j - step_j),
+                    (i + step_i * length, j + step_j * length)]
+            open_ends = [[end_i, end_j] for end_i, end_j in ends
+                         if 0 <= end_i < height and 0 <= end_j < width
+                         and free[end_i, end_j]]
+            if open_ends:
+                lines[board[i, j]].append({
+                    'start': [i, j],
+                    'direction': [step_i, step_j],
+                    'length': length,
+                    'open_ends': open_ends,
+                })
+
+    return [{
+        'player': player_id,
+        'lines': lines[player],
+        'winning_cells': numpy.argwhere(winning[player]).tolist(),
+        'blocking_cells': numpy.argwhere(
+            numpy.delete(winning, player, axis=0).any(axis=0)
+        ).tolist(),
+    } for player, player_id in enumerate(game.order)]
+
+
+def line_windows(array, step_i, step_j, length):
+    # views of the array shifted along the direction, k-th view holds
+    # k-th cells of all the lines of the length which fit the board
+    height, width = array.shape
+    rows = height - (length - 1) * step_i
+    columns = width - (length - 1) * abs(step_j)
+    if rows <= 0 or columns <= 0:
+        return
+    first_j = (length - 1) if step_j < 0 else 0
+    for k in range(length):
+        i = k * step_i
+        j = first_j + k * step_j
+        yield array[i:i + rows, j:j + columns]
+
+
+def find_first_win_turn(game):
+    # a line is completed by the latest of its turns,
+    # so the game is won on the earliest such turn among all lines
+    turns_count = len(game.history)
+    times = numpy.full((game.height, game.width), turns_count, numpy.int64)
+    turns = turns_array(game.history)
+    times[turns[:, 0], turns[:, 1]] = numpy.arange(turns_count)
+    board = numpy.where(times < turns_count, times % len(game.order), -1)
+
+    first = turns_count
+    for step_i, step_j in LINE_DIRECTIONS:
+        owners = line_windows(board, step_i, step_j, game.win_threshold)
+        if (line := next(owners, None)) is None:
+            continue
+        same = line >= 0
+        for owner in owners:
+            same &= owner == line
+        if not same.any():
+            continue
+
+        completed = None
+        for turn_times in line_windows(times, step_i, step_j,
+                                       game.win_threshold):
+            completed = turn_times if completed is None \
+                else numpy.maximum(completed, turn_times)
+        first = min(first, int(completed[same].min()))
+    return first if first < turns_count else None
+
+
+def replay_win_data(game):
+    # win data check_win reported (or should have reported) for the history,
+    # draw is (-1, -1) without direction as in TurnSerializer
+    if (index := find_first_win_turn(game)) is not None:
+        last_i, last_j = game.history[index]
+        replayed = SimpleNamespace(
+            width=game.width, height=game.height,
+            win_threshold=game.win_threshold,
+            field=board_array(game.height, game.width,
+                              game.history[:index + 1],
+                              len(game.order)).tolist()
+        )
+        return check_win_field(last_i, last_j, replayed)
+    if len(game.history) == game.width * game.height:
+        return {'start_i': -1, 'start_j': -1,
+                'direction_i': None, 'direction_j': None}
+    return None
+
+
+def validate_replay(game):
+    errors = []
+    turns = turns_array(game.history)
+    outside = (turns[:, 0] < 0) | (turns[:, 0] >= game.height) \
+        | (turns[:, 1] < 0) | (turns[:, 1] >= game.width)
+    if outside.any():
+        errors.append(f'Turns outside of the field: '
+                      f'{numpy.flatnonzero(outside).tolist()}')
+        return errors
+
+    cells = turns[:, 0] * game.width + turns[:, 1]
+    _, first_indexes = numpy.unique(cells, return_index=True)
+    if len(first_indexes) != len(cells):
+        repeated = numpy.setdiff1d(numpy.arange(len(cells)), first_indexes)
+        errors.append(f'Turns on busy cells: {repeated.tolist()}')
+        return errors
+
+    if (index := find_first_win_turn(game)) is not None \
+            and index != len(game.history) - 1:
+        errors.append(f'Turns after the game was won on turn {index}')
+
+    stored = {
+        'start_i': game.win_line_start_i,
+        'start_j': game.win_line_start_j,
+        'direction_i': game.win_line_direction_i,
+        'direction_j': game.win_line_direction_j,
+    }
+    replayed = replay_win_data(game)
+    if (replayed or {k: None for k in stored}) != stored:
+        errors.append(f'Stored win data {stored} differs '
+                      f'from replayed {replayed}')
+    return errors
+
+
+def check_win(last_i, last_j, game):
+    if game.field is None or game.line_runs is None:
+        # replays the whole history, so the last turn is checked too
+        return init_line_runs(game)
+    return add_to_line_runs(last_i, last_j, game)
+
+
+# longest side of downscaled patterns, generated by picPatterns/prepare.py
+IMAGE_PYRAMID_SIZES = (256, 128, 64, 32)
+
+
+def image_pattern_size(size):
+    # the smallest downscaled pattern which is not less than the size,
+    # None for the full one
+    if size is None:
+        return None
+    fitting = [s for s in IMAGE_PYRAMID_SIZES if s >= size]
+    return min(fitting) if fitting else None
+
+
+@lru_cache(maxsize=None)
+def get_image_pattern(name, size=None, plane=None):
+    # read-only and shared by all the workers through the page cache
+    # (generated by picPatterns/prepare.py),
+    # RGBA or its 'gray' or 'alpha' plane
+    file_name = '-'.join(str(part) for part in (name, size, plane)
+                         if part is not None)
+    path = os.path.join(BASE_DIR, 'ticTacToe', 'picPatterns',
+                        f'{file_name}.npy')
+    return numpy.load(path, mmap_mode='r')
+
+
+def get_image_planes(name, size=None):
+    # gray values (the same in r, g and b) to look tints up by
+    # and alpha already in its place of a little-endian RGBA pixel,
+    # both precomputed, so nothing is copied into the process
+    return get_image_pattern(name, size, 'gray'), \
+        get_image_pattern(name, size, 'alpha')
+
+
+# tint value of every gray value, round(gray * channel / 255)
+# is exactly (gray * channel + 127) // 255 as there are no ties
+TINT_TABLE = (numpy.arange(256, dtype=numpy.uint32)[:, None]
+              * numpy.arange(256, dtype=numpy.uint32) + 127) // 255
+
+image_buffers = threading.local()
+
+
+def get_image_buffer(key, shape):
+    # reused by renders of the thread (the pixels are encoded before
+    # the next render), one RGBA pixel per uint32
+    buffers = image_buffers.__dict__.setdefault('buffers', {})
+    if (buffer := buffers.get(key)) is None or buffer.shape != shape:
+        buffer = buffers[key] = numpy.empty(shape, '<u4')
+    return buffer
+
+
+# media type -> (PIL format, save options), in the order of preference
+IMAGE_FORMATS = {
+    'image/avif': ('AVIF', {'quality': 70}),
+    'image/webp': ('WEBP', {'quality': 90}),
+    'image/png': ('PNG', {}),
+}
 
 
 @lru_cache(maxsize=None)
-def get_image_pattern(name):
-    path = os.path.join(BASE_DIR, 'ticTacToe', 'picPatterns', name)
-    with open(path, 'rb') as f:
-        pattern = pickle.load(f)
-    for row in pattern:
-        for pix in row:
-            pix.insert(0, pix[0])
-            pix.insert(0, pix[0])
-    return numpy.array(pattern, numpy.uint8)
+def image_format_supported(image_format):
+    Image.init()
+    return image_format in Image.SAVE
+
+
+def choose_image_media_type(accept):
+    accepted = set()
+    for media_range in (accept or '').split(','):
+        media_type, *params = [p.strip() for p in media_range.split(';')]
+        quality = 1
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            accepted.add(media_type.lower())
 
+    for media_type, (image_format, _) in IMAGE_FORMATS.items():
+        if media_type in accepted and image_format_supported(image_format):
+            return media_type
+    return 'image/png'
 
-@lru_cache
-def generate_image_bytes(r, g, b, name):
-    pattern = get_image_pattern(name).copy()
 
-    pix_array = numpy.multiply(pattern, (r / 255, g / 255, b / 255, 1))
-    pix_array = numpy.round(pix_array, 0).astype(numpy.uint8)
-    result = Image.fromarray(pix_array)
+def tint_table(r, g, b):
+    # packed RGB pixel (without alpha) of every gray value
+    table = TINT_TABLE[:, r] | TINT_TABLE[:, g] << 8 | TINT_TABLE[:, b] << 16
+    return table.astype('<u4')
 
+
+def pixels_image(pixels):
+    # PIL image sharing memory with packed RGBA pixels
+    height, width = pixels.shape
+    return Image.frombuffer('RGBA', (width, height), pixels,
+                            'raw', 'RGBA', 0, 1)
+
+
+def encode_image(image, media_type):
+    image_format, options = IMAGE_FORMATS[media_type]
+    if image_format == 'PNG':
+        options = {'compress_level':
+                   settings.TIC_TAC_TOE_IMAGE_PNG_COMPRESS_LEVEL}
     buffered = BytesIO()
-    result.save(buffered, format="PNG")
+    image.save(buffered, format=image_format, **options)
     return buffered.getvalue()
+
+
+def render_image_bytes(r, g, b, name, size=None, media_type='image/png'):
+    gray, alpha = get_image_planes(name, size)
+    pixels = get_image_buffer((name, size), gray.shape)
+    numpy.take(tint_table(r, g, b), gray, out=pixels)
+    numpy.bitwise_or(pixels, alpha, out=pixels)
+    return encode_image(pixels_image(pixels), media_type)
+
+
+@lru_cache(maxsize=None)
+def get_image_cache():
+    shared = None
+    if settings.TIC_TAC_TOE_IMAGE_CACHE_DIR:
+        shared = DirectoryBytesCache(
+            settings.TIC_TAC_TOE_IMAGE_CACHE_DIR,
+            settings.TIC_TAC_TOE_IMAGE_CACHE_DIR_BYTES
+        )
+    return BytesLRUCache(settings.TIC_TAC_TOE_IMAGE_CACHE_BYTES, shared)
+
+
+def generate_image_bytes(r, g, b, name, size=None, media_type='image/png'):
+    # size must be one of IMAGE_PYRAMID_SIZES or None
+    extension = IMAGE_FORMATS[media_type][0].lower()
+    return get_image_cache().get_or_set(
+        f'{name}-{size or "full"}-{r:02x}{g:02x}{b:02x}.{extension}',
+        lambda: render_image_bytes(r, g, b, name, size, media_type)
+    )
+
+
+BOARD_CELL_SIZE = 64
+# longest side of board images in pixels
+BOARD_IMAGE_MAX_SIZE = 2048
+BOARD_BACKGROUND = (255, 255, 255, 255)
+BOARD_GRID = (208, 208, 208, 255)
+
+
+def board_cell_size(width, height, size=None):
+    # the largest cell (up to BOARD_CELL_SIZE) with which
+    # the board fits in size pixels
+    size = min(size or BOARD_IMAGE_MAX_SIZE, BOARD_IMAGE_MAX_SIZE)
+    return max(1, min(BOARD_CELL_SIZE, size // max(width, height)))
+
+
+def piece_name(player_index):
+    # the first player plays crosses
+    return 'cross' if player_index == 0 else 'circle'
+
+
+@lru_cache(maxsize=256)
+def get_board_tile(color, name, cell_size):
+    # packed RGBA pixels of an empty cell or a cell with a piece
+    # tinted with the '#rrggbb' color
+    tile = Image.new('RGBA', (cell_size, cell_size), BOARD_BACKGROUND)
+    if cell_size >= 4:
+        tile.paste(BOARD_GRID, (0, cell_size - 1, cell_size, cell_size))
+        tile.paste(BOARD_GRID, (cell_size - 1, 0, cell_size, cell_size))
+
+    if name is not None:
+        r, g, b = (int(color[k:k + 2], 16) for k in (1, 3, 5))
+        gray, alpha = get_image_planes(name, image_pattern_size(cell_size))
+        piece = pixels_image(tint_table(r, g, b)[gray] | alpha)
+        tile.alpha_composite(piece.resize((cell_size, cell_size),
+                                          Image.LANCZOS))
+
+    return numpy.frombuffer(tile.tobytes(), '<u4') \
+        .reshape(cell_size, cell_size)
+
+
+def render_board_bytes(game, cell_size, media_type='image/png'):
+    # a tile per player (and one for empty cells) gathered by the board
+    # in one take instead of pasting a piece per turn
+    colors = game.colors if game.started else []
+    tiles = numpy.stack(
+        [get_board_tile(None, None, cell_size)]
+        + [get_board_tile(color, piece_name(index), cell_size)
+           for index, color in enumerate(colors)]
+    )
+    board = board_array(game.height, game.width, game.history,
+                        max(len(colors), 1))
+    pixels = numpy.take(tiles, board + 1, axis=0) \
+        .transpose(0, 2, 1, 3) \
+        .reshape(game.height * cell_size, game.width * cell_size)
+    return encode_image(pixels_image(pixels), media_type)
+
+
+def generate_board_bytes(game, size=None, media_type='image/png'):
+    # a board changes only with its turns
+    # (colors are not changed after the start)
+    cell_size = board_cell_size(game.width, game.height, size)
+    extension = IMAGE_FORMATS[media_type][0].lower()
+    return get_image_cache().get_or_set(
+        f'board-{game.id}-{game.turns_count}-{cell_size}.{extension}',
+        lambda: render_board_bytes(game, cell_size, media_type)
+    )
@@ -1,3 +1,1539 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import pstats
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import partial
+from io import BytesIO, StringIO
+from types import SimpleNamespace
 
-# Create your tests here.
+import numpy
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management import call_command
+from django.db import (
+    IntegrityError, OperationalError, connection, transaction
+)
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    AsyncClient, AsyncRequestFactory, SimpleTestCase, TestCase,
+    TransactionTestCase, override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+
+from .caching import BytesLRUCache, DirectoryBytesCache
+from .management.commands.bench_images import render_float
+from . import async_views, bot, engine, events, profiling, service, views
+from .fields import PackedBoardField, PackedLineRunsField
+from .game_cache import LocalGameStateCache, get_game_states
+from .models import BoardSnapshot, Game, Turn
+from .serializers import GameSerializer
+
+
+def create_started_game(owner, *players, colors=None, width=3, height=3,
+                        win_threshold=3):
+    # the owner makes the first turn, then the players in their order
+    players = [owner, *players]
+    game = Game.objects.create(
+        width=width, height=height, win_threshold=win_threshold,
+        owner=owner, colors=colors or ['#000000', '#ffffff'][:len(players)],
+        order=[player.id for player in players], started=True,
+        status=Game.Status.STARTED,
+    )
+    game.players.add(*players)
+    return game
+
+
+class GameListQueriesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_games(self, count):
+        for k in range(count):
+            owner = User.objects.create(
+                username=f'owner{Game.objects.count()}'
+            )
+            game = Game.objects.create(
+                width=3, height=3, win_threshold=1, owner=owner,
+                colors=['#000000', '#ffffff'],
+                order=[owner.id, self.user.id], started=k % 3 != 0,
+            )
+            game.players.add(owner, self.user)
+            if k % 3 == 2:
+                Turn.objects.create(game=game, index=0, i=1, j=1,
+                                    player=owner)
+                game.win_line_start_i = game.win_line_start_j = 1
+                game.win_line_direction_i = game.win_line_direction_j = 1
+                game.status = Game.Status.FINISHED
+                game.winner = owner
+                game.save()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, {'count': 100})
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response.data
+
+    def assert_constant_queries(self, url):
+        self.create_games(3)
+        few_queries, _ = self.count_queries(url)
+        self.create_games(30)
+        many_queries, data = self.count_queries(url)
+        self.assertEqual(few_queries, many_queries)
+        return data
+
+    def test_started_games(self):
+        data = self.assert_constant_queries('/api/v1/ticTacToe/games/started')
+        finished = [game for game in data if game['finished']]
+        self.assertTrue(finished)
+        for game in finished:
+            self.assertEqual(game['winner']['id'], game['owner']['id'])
+        self.assertTrue(all(game['user_joined'] for game in data))
+
+    def test_waiting_games(self):
+        self.assert_constant_queries('/api/v1/ticTacToe/games/waiting')
+
+    def test_my_games(self):
+        data = self.assert_constant_queries('/api/v1/ticTacToe/games/my')
+        self.assertEqual(len(data), 33)
+
+    def test_anonymous_user_joined(self):
+        self.create_games(3)
+        data = APIClient().get('/api/v1/ticTacToe/games/started').data
+        self.assertFalse(any(game['user_joined'] for game in data))
+
+
+class GameListPaginationTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username='owner')
+        for _ in range(25):
+            Game.objects.create(width=3, height=3, win_threshold=3,
+                                owner=owner, colors={})
+        # ties are ordered by id
+        tied = Game.objects.order_by('id')[:10]
+        Game.objects.filter(id__in=tied.values('id')).update(
+            creation_time=tied[0].creation_time
+        )
+        self.client = APIClient()
+
+    def get(self, **params):
+        response = self.client.get('/api/v1/ticTacToe/games/waiting',
+                                   {'count': 10, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_cursor_pages_match_offset_pages(self):
+        offset_ids = [game['id'] for page in range(1, 4)
+                      for game in self.get(page=page)]
+        cursor_ids = []
+        data = self.get(cursor='')
+        while True:
+            cursor_ids += [game['id'] for game in data['results']]
+            if data['next_cursor'] is None:
+                break
+            data = self.get(cursor=data['next_cursor'])
+        self.assertEqual(cursor_ids, offset_ids)
+        self.assertEqual(sorted(cursor_ids),
+                         list(Game.objects.order_by('id')
+                              .values_list('id', flat=True)))
+
+    def test_invalid_cursor(self):
+        cursors = ['not a cursor'] + [
+            base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            for values in [[None, None], [{'a': 1}, 1], [1, 2],
+                           ['2021-01-01T00:00:00+00:00', 'id'], ['', '1']]
+        ]
+        for cursor in cursors:
+            response = self.client.get('/api/v1/ticTacToe/games/waiting',
+                                       {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        get_game_states().clear()
+        self.owner = User.objects.create(username='owner')
+        self.game = create_started_game(self.owner)
+        self.client = APIClient()
+
+    def test_unchanged_game_is_not_modified(self):
+        for url in [f'/api/v1/ticTacToe/game/{self.game.id}',
+                    f'/api/v1/ticTacToe/game/{self.game.id}/players',
+                    f'/api/v1/ticTacToe/game/{self.game.id}/historySuffix'
+                    f'?start_index=0']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            # none if the game is cached
+            self.assertLessEqual(len(context.captured_queries), 1)
+
+    def test_turn_changes_etag(self):
+        url = f'/api/v1/ticTacToe/game/{self.game.id}'
+        etag = self.client.get(url)['ETag']
+        self.client.force_authenticate(self.owner)
+        response = self.client.patch(f'{url}/turn', {'i': 0, 'j': 0})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['history'], [[0, 0]])
+
+    def test_picture_is_immutable(self):
+        url = '/api/v1/ticTacToe/pics/circle/ff0000'
+        response = self.client.get(url, {'size': 32})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.client.get(url, {'size': 32},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class GameBoardPictureTest(TestCase):
+    def test_board_thumbnail(self):
+        owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        game = create_started_game(owner, other, width=4,
+                                   colors=['#ff0000', '#0000ff'])
+        game.add_turn(0, 0)
+        game.add_turn(2, 3)
+
+        response = APIClient().get(f'/api/v1/ticTacToe/game/{game.id}/picture',
+                                   {'size': 40}, HTTP_ACCEPT='image/png')
+        self.assertEqual(response.status_code, 200)
+        image = Image.open(BytesIO(response.content))
+        # 10 pixels per cell
+        self.assertEqual(image.size, (40, 30))
+        self.assertEqual(image.getpixel((5, 25)), (255, 255, 255, 255))
+        red, _, blue, _ = image.getpixel((5, 5))
+        self.assertGreater(red, blue)
+        red, _, blue, _ = image.getpixel((35, 25))
+        self.assertGreater(blue, red)
+        self.assertIn('Accept', response['Vary'])
+
+        if service.image_format_supported('WEBP'):
+            response = APIClient().get(
+                f'/api/v1/ticTacToe/game/{game.id}/picture', {'size': 40},
+                HTTP_ACCEPT='image/webp,*/*'
+            )
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertEqual(Image.open(BytesIO(response.content)).size,
+                             (40, 30))
+
+
+class CircleCrossPictureTest(SimpleTestCase):
+    url = '/api/v1/ticTacToe/pics/cross/ff0000'
+
+    def setUp(self):
+        service.get_image_cache().clear()
+
+    def get(self, accept=None, **params):
+        headers = {} if accept is None else {'HTTP_ACCEPT': accept}
+        return APIClient().get(self.url, params, **headers)
+
+    def test_accept(self):
+        for accept, media_type, image_format in [
+            (None, 'image/png', 'PNG'),
+            ('*/*', 'image/png', 'PNG'),
+            ('image/webp,image/png', 'image/webp', 'WEBP'),
+            ('image/avif,image/webp,*/*;q=0.8', 'image/avif', 'AVIF'),
+            ('image/avif;q=0,image/webp;q=0,image/png', 'image/png', 'PNG'),
+        ]:
+            if not service.image_format_supported(image_format):
+                continue
+            response = self.get(accept, size=32)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], media_type, accept)
+            self.assertIn('Accept', response['Vary'])
+            self.assertEqual(Image.open(BytesIO(response.content)).format,
+                             image_format)
+            self.assertIn(media_type.split('/')[1], response['ETag'])
+
+    def test_not_modified_by_media_type(self):
+        etag = self.get('image/png', size=32)['ETag']
+        response = APIClient().get(self.url, {'size': 32},
+                                   HTTP_ACCEPT='image/png',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('Accept', response['Vary'])
+        if service.image_format_supported('WEBP'):
+            response = APIClient().get(self.url, {'size': 32},
+                                       HTTP_ACCEPT='image/webp',
+                                       HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+    def test_pyramid_size(self):
+        full = service.get_image_pattern('cross')
+        for size, pattern_size in [(1, 32), (32, 32), (40, 64), (100, 128),
+                                   (256, 256), (257, None), (None, None)]:
+            params = {} if size is None else {'size': size}
+            image = Image.open(BytesIO(self.get('image/png', **params)
+                                       .content))
+            pattern = service.get_image_pattern('cross', pattern_size)
+            self.assertEqual(image.size, pattern.shape[1::-1], size)
+            if pattern_size is None:
+                self.assertEqual(pattern.shape, full.shape)
+            else:
+                self.assertEqual(max(image.size), pattern_size)
+
+    def test_pattern_pixels(self):
+        # the image is the memory-mapped pattern tinted with the color
+        pattern = service.get_image_pattern('cross', 64)
+        self.assertIsInstance(pattern, numpy.memmap)
+        pixels = numpy.asarray(Image.open(BytesIO(
+            self.get('image/png', size=64).content
+        )))
+        self.assertTrue(numpy.array_equal(pixels[:, :, 3], pattern[:, :, 3]))
+        self.assertTrue(numpy.array_equal(pixels[:, :, 0], pattern[:, :, 0]))
+        self.assertFalse(pixels[:, :, 1:3].any())
+
+    def test_invalid(self):
+        for url in ['/api/v1/ticTacToe/pics/square/ff0000',
+                    '/api/v1/ticTacToe/pics/cross/red']:
+            self.assertEqual(APIClient().get(url).status_code, 404)
+        self.assertEqual(self.get(size=0).status_code, 400)
+
+
+@override_settings(TIC_TAC_TOE_IMAGE_PNG_COMPRESS_LEVEL=6)
+class ImageTintTest(SimpleTestCase):
+    def test_same_as_float_tint(self):
+        for r, g, b in [(0, 0, 0), (255, 255, 255), (255, 0, 0),
+                        (1, 128, 254), (17, 200, 99)]:
+            for name in ['cross', 'circle']:
+                self.assertEqual(
+                    service.render_image_bytes(r, g, b, name),
+                    render_float(r, g, b, name), (r, g, b, name)
+                )
+
+    def test_planes(self):
+        for size in [None, *service.IMAGE_PYRAMID_SIZES]:
+            pattern = service.get_image_pattern('cross', size)
+            gray, alpha = service.get_image_planes('cross', size)
+            # mapped from the files, not copied
+            self.assertIsInstance(gray, numpy.memmap)
+            self.assertIsInstance(alpha, numpy.memmap)
+            self.assertTrue(numpy.array_equal(gray, pattern[:, :, 0]))
+            self.assertTrue(numpy.array_equal(
+                alpha, pattern[:, :, 3].astype('<u4') << 24
+            ))
+
+
+@override_settings(TIC_TAC_TOE_PROFILING=True,
+                   TIC_TAC_TOE_PROFILING_SAMPLE_RATE=0,
+                   TIC_TAC_TOE_METRICS_TOKEN='secret')
+class ProfilingTest(TestCase):
+    def get_metrics(self):
+        return APIClient().get('/api/v1/ticTacToe/metrics',
+                               HTTP_AUTHORIZATION='Bearer secret') \
+            .content.decode()
+
+    def test_metrics_by_view(self):
+        owner = User.objects.create(username='owner')
+        game = create_started_game(owner)
+        client = APIClient()
+        client.force_authenticate(owner)
+        response = client.patch(f'/api/v1/ticTacToe/game/{game.id}/turn',
+                                {'i': 0, 'j': 0})
+        self.assertEqual(response.status_code, 200)
+
+        metrics = self.get_metrics()
+        self.assertIn('tictactoe_requests_total{view="MakeTurnView",'
+                      'status="200"} 1', metrics)
+        for name in ['sql_queries', 'serializer_seconds',
+                     'check_win_seconds']:
+            line = next(line for line in metrics.splitlines()
+                        if line.startswith(f'tictactoe_{name}_total'
+                                           '{view="MakeTurnView"}'))
+            self.assertGreater(float(line.split()[-1]), 0)
+
+    def test_sync_view_under_asgi(self):
+        owner = User.objects.create(username='owner')
+        game = create_started_game(owner)
+
+        async def get():
+            # the sync view runs in a thread of its own,
+            # not in the one of the middleware
+            return await AsyncClient().get(
+                f'/api/v1/ticTacToe/game/{game.id}'
+            )
+        response = async_to_sync(get)()
+        self.assertEqual(response.status_code, 200)
+
+        metrics = self.get_metrics()
+        line = next(line for line in metrics.splitlines()
+                    if line.startswith('tictactoe_sql_queries_total'
+                                       '{view="GameDetailView"}'))
+        self.assertGreater(float(line.split()[-1]), 0)
+
+    @override_settings(TIC_TAC_TOE_PROFILING=False)
+    def test_metrics_are_off(self):
+        response = APIClient().get('/api/v1/ticTacToe/metrics',
+                                   HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 404)
+
+    def test_metrics_access(self):
+        url = '/api/v1/ticTacToe/metrics'
+        for authorization in [None, 'Bearer wrong', 'secret']:
+            headers = {} if authorization is None \
+                else {'HTTP_AUTHORIZATION': authorization}
+            self.assertEqual(APIClient().get(url, **headers).status_code,
+                             403)
+        # a logged in user has to be a staff one
+        client = APIClient()
+        client.force_login(User.objects.create(username='user'))
+        self.assertEqual(client.get(url).status_code, 403)
+
+        client.force_login(User.objects.create(username='staff',
+                                               is_staff=True))
+        self.assertEqual(client.get(url).status_code, 200)
+        with override_settings(TIC_TAC_TOE_METRICS_ALLOWED_IPS=['10.0.0.1']):
+            self.assertEqual(APIClient().get(url).status_code, 403)
+            self.assertEqual(APIClient().get(url, REMOTE_ADDR='10.0.0.1')
+                             .status_code, 200)
+        with override_settings(TIC_TAC_TOE_METRICS_TOKEN=''):
+            self.assertEqual(APIClient().get(
+                url, HTTP_AUTHORIZATION='Bearer '
+            ).status_code, 403)
+
+    def test_timed_blocks(self):
+        profile = profiling.RequestProfile()
+        token = profiling.current_profile.set(profile)
+        try:
+            with profiling.timed('serializer'):
+                with profiling.timed('serializer'):
+                    time.sleep(0.01)
+        finally:
+            profiling.current_profile.reset(token)
+        self.assertGreaterEqual(profile.seconds['serializer'], 0.01)
+        self.assertLess(profile.seconds['serializer'], 0.02)
+        # nothing is recorded outside of a profiled request
+        with profiling.timed('serializer'):
+            pass
+        self.assertEqual(list(profile.seconds), ['serializer'])
+
+
+class AsyncViewsTest(TransactionTestCase):
+    def setUp(self):
+        get_game_states().clear()
+        owner = User.objects.create(username='owner')
+        self.game = create_started_game(owner)
+        self.game.add_turn(1, 1)
+        self.factory = AsyncRequestFactory()
+
+    def get(self, view, **headers):
+        # extra arguments are ASGI headers
+        request = self.factory.get('/', **headers)
+        return async_to_sync(view)(request, pk=self.game.id)
+
+    def test_game_detail(self):
+        response = self.get(async_views.game_detail)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['history'], [[1, 1]])
+
+        response = self.get(async_views.game_detail,
+                            **{'if-none-match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_profile_dump(self):
+        directory = tempfile.mkdtemp()
+
+        async def get_response(request):
+            return await async_views.game_detail(request, pk=self.game.id)
+
+        with self.settings(TIC_TAC_TOE_PROFILING=True,
+                           TIC_TAC_TOE_PROFILING_SAMPLE_RATE=1,
+                           TIC_TAC_TOE_PROFILING_THRESHOLD_MS=0,
+                           TIC_TAC_TOE_PROFILING_DIR=directory):
+            middleware = profiling.ProfilingMiddleware(get_response)
+            response = async_to_sync(middleware)(self.factory.get('/'))
+        self.assertEqual(response.status_code, 200)
+
+        dump, = os.listdir(directory)
+        stats = pstats.Stats(os.path.join(directory, dump))
+        # the view ran in a read thread, which was profiled
+        self.assertIn('get', [
+            function for path, _, function in stats.stats
+            if path.endswith(os.path.join('ticTacToe', 'views.py'))
+        ])
+
+    def test_board_picture(self):
+        response = self.get(async_views.game_board_picture)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+
+class GameEventsTest(TransactionTestCase):
+    def setUp(self):
+        get_game_states().clear()
+        self.owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        self.game = create_started_game(self.owner, other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.application = events.GameEventsApplication(
+            get_asgi_application()
+        )
+
+    def stream(self, scenario, start_index=0):
+        """
+        Runs scenario(messages) while the event stream of the game
+        is open, messages is an asyncio.Queue of its (event, data).
+        """
+        async def run():
+            messages = asyncio.Queue()
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                for chunk in message.get('body', b'').decode().split('\n\n'):
+                    if chunk.startswith('event: '):
+                        event, data = chunk.split('\n')
+                        await messages.put((event[len('event: '):],
+                                            json.loads(data[len('data: '):])))
+
+            application = asyncio.ensure_future(self.application({
+                'type': 'http', 'method': 'GET',
+                'path': f'/api/v1/ticTacToe/game/{self.game.id}/events',
+                'query_string': f'start_index={start_index}'.encode(),
+            }, receive, send))
+            try:
+                await scenario(messages)
+            finally:
+                disconnected.set()
+                await asyncio.wait_for(application, 5)
+        async_to_sync(run)()
+
+    def test_turn(self):
+        async def scenario(messages):
+            self.assertEqual(await asyncio.wait_for(messages.get(), 5),
+                             ('start', {'order': self.game.order}))
+            response = await sync_to_async(self.client.patch)(
+                f'/api/v1/ticTacToe/game/{self.game.id}/turn',
+                {'i': 2, 'j': 1}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(await asyncio.wait_for(messages.get(), 5),
+                             ('turn', {'index': 0, 'i': 2, 'j': 1}))
+        self.stream(scenario)
+
+    def add_turns(self, turns):
+        # without their events
+        for i, j in turns:
+            self.game.add_turn(i, j)
+
+    def test_lost_events(self):
+        async def scenario(messages):
+            await asyncio.wait_for(messages.get(), 5)
+            await sync_to_async(self.add_turns)([(0, 0), (1, 1), (2, 2)])
+            events.get_broker().publish(self.game.id, {
+                'event': 'turn', 'index': 2, 'i': 2, 'j': 2
+            })
+            await sync_to_async(self.add_turns)([(0, 1)])
+            events.get_broker().resync()
+            # late events of the reloaded turns are skipped
+            events.get_broker().publish(self.game.id, {
+                'event': 'turn', 'index': 3, 'i': 0, 'j': 1
+            })
+            events.get_broker().publish(self.game.id, {
+                'event': 'join', 'user_id': self.owner.id
+            })
+            received = [await asyncio.wait_for(messages.get(), 5)
+                        for _ in range(5)]
+            self.assertEqual([data.get('index') for _, data in received],
+                             [0, 1, 2, 3, None])
+        self.stream(scenario)
+
+    def test_resync_wakes_long_poll(self):
+        def make_lost_turn():
+            self.game.add_turn(0, 0)
+            connection.close()
+            events.get_broker().resync()
+
+        timer = threading.Timer(0.1, make_lost_turn)
+        timer.start()
+        start = time.monotonic()
+        response = self.client.get(
+            f'/api/v1/ticTacToe/game/{self.game.id}/historySuffix',
+            {'start_index': 0, 'wait': 10}
+        )
+        timer.join()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual([list(turn) for turn in response.data['history']],
+                         [[0, 0]])
+
+
+class LongPollTest(TestCase):
+    def setUp(self):
+        get_game_states().clear()
+        owner = User.objects.create(username='owner')
+        self.game = create_started_game(owner)
+        self.url = f'/api/v1/ticTacToe/game/{self.game.id}/historySuffix'
+
+    def poll(self, start_index, wait):
+        start = time.monotonic()
+        response = APIClient().get(self.url, {'start_index': start_index,
+                                              'wait': wait})
+        self.assertEqual(response.status_code, 200)
+        return response.data, time.monotonic() - start
+
+    def test_timeout(self):
+        data, elapsed = self.poll(0, 0.2)
+        self.assertEqual(data['history'], [])
+        self.assertGreaterEqual(elapsed, 0.2)
+
+    def test_new_turn_wakes(self):
+        timer = threading.Timer(0.1, events.get_broker().publish, [
+            self.game.id, {'event': 'turn', 'index': 0, 'i': 0, 'j': 0}
+        ])
+        timer.start()
+        _, elapsed = self.poll(0, 10)
+        timer.join()
+        self.assertLess(elapsed, 5)
+
+    def test_old_turns_do_not_wait(self):
+        self.game.add_turn(0, 0)
+        data, elapsed = self.poll(0, 10)
+        self.assertEqual([list(turn) for turn in data['history']],
+                         [[0, 0]])
+        self.assertLess(elapsed, 5)
+
+
+class GameProjectionTest(TestCase):
+    def setUp(self):
+        get_game_states().clear()
+        self.owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        self.game = create_started_game(self.owner, other)
+        self.game.add_turn(1, 1)
+        self.order = self.game.order
+
+    def get(self, path, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = APIClient().get(
+                f'/api/v1/ticTacToe/game/{self.game.id}{path}', params
+            )
+        return response, context.captured_queries
+
+    def test_fields(self):
+        response, queries = self.get('', fields='status,win_data,finished')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data),
+                         {'status', 'win_data', 'finished'})
+        # the version and the game, no turns or packed fields
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('field', queries[1]['sql'])
+
+    def test_fields_without_columns(self):
+        response, queries = self.get('', fields='history')
+        self.assertEqual(response.data, {'history': [[1, 1]]})
+        # after the version query only the primary key of the game is read
+        game_query = [query['sql'] for query in queries
+                      if 'FROM "ticTacToe_game"' in query['sql']][-1]
+        self.assertEqual(
+            game_query.split(' FROM ')[0],
+            'SELECT "ticTacToe_game"."id"'
+        )
+        self.assertEqual(GameSerializer.model_fields(['history']), ['id'])
+        self.assertEqual(
+            sorted(GameSerializer.model_fields(['id', 'finished'])),
+            ['id', 'win_line_start_i']
+        )
+
+    def test_unknown_fields(self):
+        response, _ = self.get('', fields='status,password')
+        self.assertEqual(response.status_code, 400)
+
+    def test_summary(self):
+        response, queries = self.get('/summary')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            'id': self.game.id, 'status': 'started', 'turns_count': 1,
+            'current_player': self.order[1], 'winner': None,
+        })
+        self.assertEqual(len(queries), 2)
+
+
+class GameStateCacheTest(TransactionTestCase):
+    def setUp(self):
+        get_game_states().clear()
+        self.owner = User.objects.create(username='owner')
+        self.game = create_started_game(self.owner)
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.url = f'/api/v1/ticTacToe/game/{self.game.id}'
+
+    def get(self, path, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f'{self.url}{path}', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(context.captured_queries)
+
+    def test_hot_reads(self):
+        self.get('/historySuffix', start_index=0)
+        for path, params in [('/historySuffix', {'start_index': 0}),
+                             ('/players', {}), ('/started', {})]:
+            _, queries = self.get(path, **params)
+            self.assertEqual(queries, 0)
+
+    def test_turn_invalidates(self):
+        data, _ = self.get('/historySuffix', start_index=0)
+        self.assertEqual(data['history'], [])
+        response = self.client.patch(f'{self.url}/turn', {'i': 2, 'j': 1})
+        self.assertEqual(response.status_code, 200)
+
+        data, _ = self.get('/historySuffix', start_index=0)
+        self.assertEqual(data['history'], [[2, 1]])
+
+    def test_invalidations_between_processes(self):
+        # the caches of two processes, the broker is shared between them
+        states = [LocalGameStateCache(), LocalGameStateCache()]
+        load_game = partial(Game.objects.get, id=self.game.id)
+        for cache in states:
+            self.addCleanup(events.get_broker().remove_listener,
+                            cache.receive)
+            state, _ = cache.load(self.game.id, load_game)
+            self.assertEqual(state['history'], [])
+
+        self.game.add_turn(2, 1)
+        states[0].invalidate(self.game.id)
+        self.assertIsNone(states[1].get(self.game.id))
+        state, _ = states[1].load(self.game.id, load_game)
+        self.assertEqual(state['history'], [[2, 1]])
+
+
+class ArchiveGamesTest(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.other = User.objects.create(username='other')
+        self.games = []
+        for status in [Game.Status.FINISHED, Game.Status.DRAW,
+                       Game.Status.STARTED]:
+            game = create_started_game(self.owner, self.other)
+            for i, j in [(0, 0), (1, 0), (0, 1)]:
+                game.add_turn(i, j)
+            Game.objects.filter(id=game.id).update(status=status)
+            self.games.append(game)
+        self.path = os.path.join(tempfile.mkdtemp(), 'games.ndjson.gz')
+
+    def archive(self, *args):
+        stdout = StringIO()
+        call_command('archive_games', *args, self.path, stdout=stdout)
+        return json.loads(stdout.getvalue())
+
+    def test_round_trip(self):
+        finished, draw, started = self.games
+        report = self.archive('export', '--delete', '--batch', '1')
+        self.assertEqual((report['exported'], report['deleted']), (2, 2))
+        self.assertEqual(list(Game.objects.values_list('id', flat=True)),
+                         [started.id])
+
+        report = self.archive('import', '--batch', '1')
+        self.assertEqual((report['imported'], report['skipped']), (2, []))
+        game = Game.objects.get(id=finished.id)
+        self.assertEqual(game.status, Game.Status.FINISHED)
+        self.assertEqual(game.history, [[0, 0], [1, 0], [0, 1]])
+        self.assertEqual(list(game.turns.values_list('player', flat=True)),
+                         [self.owner.id, self.other.id, self.owner.id])
+        self.assertEqual(set(game.players.values_list('id', flat=True)),
+                         {self.owner.id, self.other.id})
+
+        # already there
+        report = self.archive('import')
+        self.assertEqual(report['skipped'], [finished.id, draw.id])
+
+
+@override_settings(TIC_TAC_TOE_REPLAY_SNAPSHOT_INTERVAL=2)
+class ReplayTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        self.game = create_started_game(owner, other)
+        for i, j in [(0, 0), (1, 0), (1, 1), (2, 0), (0, 2)]:
+            self.game.add_turn(i, j)
+
+    def get(self, path, **params):
+        return APIClient().get(
+            f'/api/v1/ticTacToe/game/{self.game.id}/{path}', params
+        )
+
+    def test_board(self):
+        response = self.get('board', index=3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['field'],
+                         [[0, -1, -1], [1, 0, -1], [-1, -1, -1]])
+        self.assertEqual(list(BoardSnapshot.objects.values_list(
+            'index', flat=True)), [2])
+
+        # from the snapshot after 4 turns
+        self.get('board', index=5)
+        with CaptureQueriesContext(connection) as context:
+            response = self.get('board', index=5)
+        self.assertEqual(response.data['field'],
+                         [[0, -1, 0], [1, 0, -1], [1, -1, -1]])
+        turns_sql = context.captured_queries[-1]['sql']
+        self.assertIn('"index" >= 4', turns_sql)
+
+        self.assertEqual(self.get('board', index=6).status_code, 400)
+
+    def test_delta(self):
+        response = self.get('boardDelta', start_index=1, end_index=3)
+        self.assertEqual(response.data['cells'], [[1, 0, 1], [1, 1, 0]])
+        response = self.get('boardDelta', start_index=3, end_index=1)
+        self.assertEqual(response.data['cells'], [[1, 1, -1], [1, 0, -1]])
+
+
+class EngineTest(TestCase):
+    def test_wins_and_blocks(self):
+        field = [[0, 0, -1], [1, -1, -1], [-1, -1, -1]]
+        self.assertEqual(engine.choose_move(3, 3, 3, field, 1, 2, 1, 1000),
+                         (0, 2))
+        field[1][1] = 1
+        self.assertEqual(engine.choose_move(3, 3, 3, field, 0, 2, 1, 1000),
+                         (0, 2))
+
+    def test_time_limit(self):
+        # two players' cells (0 and 1) among empty ones (-1)
+        field = [[(i * 7 + j * 3) % 2 if (i + j) % 3 else -1
+                  for j in range(100)] for i in range(100)]
+        start = time.monotonic()
+        i, j = engine.choose_move(100, 100, 100, field, 0, 2, 0.2, 1000)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(field[i][j], -1)
+
+
+@override_settings(TIC_TAC_TOE_BOT_PROCESSES=0,
+                   TIC_TAC_TOE_BOT_TIME_LIMIT=0.05)
+class BotTest(TransactionTestCase):
+    def setUp(self):
+        get_game_states().clear()
+        self.owner = User.objects.create(username='owner')
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        response = self.client.post('/api/v1/ticTacToe/games/create', {
+            'width': 3, 'height': 3, 'win_threshold': 3,
+            'owner_color': '#000000',
+        })
+        self.url = f'/api/v1/ticTacToe/game/{response.data["id"]}'
+
+    def test_bot_plays(self):
+        response = self.client.patch(f'{self.url}/addBot',
+                                     {'color': '#ffffff'})
+        self.assertEqual(response.status_code, 200)
+        bot_id = response.data['id']
+        self.assertEqual(self.client.patch(f'{self.url}/start')
+                         .status_code, 200)
+
+        game = Game.objects.get()
+        self.assertEqual(game.bots, [bot_id])
+        while game.status == Game.Status.STARTED:
+            # the bot has made its turn once the owner can make one
+            self.assertEqual(game.order[game.turns_count % 2],
+                             self.owner.id)
+            i, j = next((i, j) for i in range(3) for j in range(3)
+                        if [i, j] not in game.history)
+            response = self.client.patch(f'{self.url}/turn',
+                                         {'i': i, 'j': j})
+            self.assertEqual(response.status_code, 200)
+            game = Game.objects.get()
+        # the owner plays the first free cell, the bot does not lose
+        self.assertNotEqual(game.winner_id, self.owner.id)
+
+    def test_lost_turn(self):
+        self.client.patch(f'{self.url}/addBot', {'color': '#ffffff'})
+        self.client.patch(f'{self.url}/start')
+        game = Game.objects.get()
+        # the search after the owner's turn is taken by a worker
+        # (of another process) which is gone before it makes the turn
+        self.assertTrue(bot.lease(game.id, game.turns_count + 1, 0.3))
+        i, j = next((i, j) for i in range(3) for j in range(3)
+                    if [i, j] not in game.history)
+        self.client.patch(f'{self.url}/turn', {'i': i, 'j': j})
+        game = Game.objects.get()
+        self.assertIsNotNone(game.current_bot)
+        self.assertEqual(Game.version_query(game.id)['bot'],
+                         game.current_bot)
+
+        time.sleep(0.4)
+        # the game is not cached, its version query resumes its bot
+        get_game_states().clear()
+        self.client.get(f'{self.url}/historySuffix?start_index=0')
+        self.assertEqual(Game.objects.get().turns_count,
+                         game.turns_count + 1)
+
+    def test_lease(self):
+        game_id = Game.objects.get().id
+        self.assertTrue(bot.lease(game_id, 1, 10))
+        # taken until it expires, whatever process asks
+        self.assertFalse(bot.lease(game_id, 1, 10))
+        self.assertTrue(bot.lease(game_id, 2, 0.05))
+        self.assertFalse(bot.lease(game_id, 2, 10))
+        time.sleep(0.1)
+        self.assertTrue(bot.lease(game_id, 2, 10))
+        self.assertFalse(bot.lease(game_id + 1, 1, 10))
+
+    def test_not_owner(self):
+        other = User.objects.create(username='other')
+        self.client.force_authenticate(other)
+        response = self.client.patch(f'{self.url}/addBot',
+                                     {'color': '#ffffff'})
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(TIC_TAC_TOE_FIELD_SAVE_INTERVAL=3)
+class FieldSaveTest(TestCase):
+    def setUp(self):
+        get_game_states().clear()
+        self.players = [User.objects.create(username=f'player{k}')
+                        for k in range(2)]
+        self.game = create_started_game(*self.players, width=5, height=5,
+                                        win_threshold=4)
+        self.url = f'/api/v1/ticTacToe/game/{self.game.id}/turn'
+
+    def make_turn(self, i, j):
+        client = APIClient()
+        client.force_authenticate(
+            self.players[self.game.turns.count() % 2]
+        )
+        with CaptureQueriesContext(connection) as context:
+            response = client.patch(self.url, {'i': i, 'j': j})
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries
+                if query['sql'].startswith('UPDATE "ticTacToe_game"')]
+
+    def test_field_saved_every_interval(self):
+        # the first player wins on the seventh turn with a line
+        # which crosses the saved fields
+        turns = [(0, 0), (4, 4), (0, 1), (4, 3), (0, 2), (3, 0), (0, 3)]
+        for count, (i, j) in enumerate(turns, 1):
+            updates = self.make_turn(i, j)
+            self.assertEqual(len(updates), 1)
+            game = Game.objects.get(id=self.game.id)
+            if game.finished:
+                break
+            saved = count - count % 3
+            self.assertEqual('"field"' in updates[0], count == saved)
+            if saved:
+                self.assertEqual(
+                    numpy.count_nonzero(numpy.array(game.field) >= 0), saved
+                )
+            else:
+                self.assertIsNone(game.field)
+            # the loaded field has all the turns
+            service.load_field(game)
+            self.assertEqual(game.turns_count, count)
+            self.assertEqual(game.field, service.board_array(
+                5, 5, turns[:count], 2
+            ).tolist())
+
+        self.assertEqual(count, len(turns))
+        self.assertEqual(game.winner_id, self.players[0].id)
+        self.assertEqual(
+            (game.win_line_start_i, game.win_line_start_j,
+             game.win_line_direction_i, game.win_line_direction_j),
+            (0, 0, 0, 1)
+        )
+        self.assertIsNone(game.field)
+        self.assertIsNone(game.line_runs)
+
+    def test_busy_cell_after_saved_field(self):
+        for i, j in [(0, 0), (4, 4), (0, 1), (4, 3)]:
+            self.make_turn(i, j)
+        client = APIClient()
+        client.force_authenticate(self.players[0])
+        # (4, 3) is not in the saved field
+        response = client.patch(self.url, {'i': 4, 'j': 3})
+        self.assertEqual(response.status_code, 400)
+
+
+class ConcurrentTurnsTest(TransactionTestCase):
+    def setUp(self):
+        get_game_states().clear()
+        self.players = [User.objects.create(username=f'player{k}')
+                        for k in range(2)]
+        self.game = create_started_game(*self.players, width=6, height=6,
+                                        win_threshold=6)
+        self.url = f'/api/v1/ticTacToe/game/{self.game.id}/turn'
+
+    def play(self, player, cells, barrier, statuses):
+        client = APIClient()
+        client.force_authenticate(player)
+        barrier.wait()
+        try:
+            for i, j in cells:
+                response = client.patch(self.url, {'i': i, 'j': j})
+                statuses.append(response.status_code)
+        finally:
+            connection.close()
+
+    def test_concurrent_turns(self):
+        # every player makes turns from several threads at once,
+        # the threads of a player try the same cells
+        cells = [(i, j) for i in range(6) for j in range(6)]
+        random.Random(0).shuffle(cells)
+        threads_count = 3
+        barrier = threading.Barrier(threads_count * len(self.players))
+        statuses = []
+        threads = [
+            threading.Thread(target=self.play, args=(
+                player, cells[k::len(self.players)], barrier, statuses
+            ))
+            for k, player in enumerate(self.players)
+            for _ in range(threads_count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(set(statuses), {200, 400, 403})
+        turns = list(self.game.turns.order_by('index')
+                     .values_list('index', 'i', 'j', 'player_id'))
+        self.assertEqual(len(turns), statuses.count(200))
+        self.assertGreater(len(turns), 1)
+        # no gaps, no cell taken twice, the players alternate
+        self.assertEqual([turn[0] for turn in turns],
+                         list(range(len(turns))))
+        self.assertEqual(len({turn[1:3] for turn in turns}), len(turns))
+        self.assertEqual([turn[3] for turn in turns],
+                         [self.players[index % 2].id
+                          for index in range(len(turns))])
+        game = Game.objects.get(id=self.game.id)
+        self.assertEqual(game.turns_count, len(turns))
+        self.assertEqual(game.history, [list(turn[1:3]) for turn in turns])
+
+
+    def test_lock_conflict_codes(self):
+        def django_error(cause, **codes):
+            for name, code in codes.items():
+                setattr(cause, name, code)
+            error = OperationalError(str(cause))
+            error.__cause__ = cause
+            return error
+
+        for cause, codes, conflict in [
+            (sqlite3.OperationalError('database is locked'),
+             {'sqlite_errorcode': sqlite3.SQLITE_BUSY}, True),
+            (sqlite3.OperationalError('database table is locked'),
+             {'sqlite_errorcode': sqlite3.SQLITE_LOCKED_SHAREDCACHE}, True),
+            # the code is checked, not the message
+            (sqlite3.OperationalError('no such table: lock timeout'),
+             {'sqlite_errorcode': sqlite3.SQLITE_ERROR}, False),
+            (Exception('deadlock detected'), {'pgcode': '40P01'}, True),
+            (Exception('canceling statement due to lock timeout'),
+             {'pgcode': '55P03'}, True),
+            (Exception('could not serialize access'),
+             {'pgcode': '40001'}, True),
+            (Exception('relation "lock" does not exist'),
+             {'pgcode': '42P01'}, False),
+            (Exception('database is locked'), {}, False),
+        ]:
+            self.assertEqual(
+                views.is_lock_conflict(django_error(cause, **codes)),
+                conflict, cause
+            )
+
+class BytesLRUCacheTest(SimpleTestCase):
+    def test_size_bound_and_eviction_order(self):
+        cache = BytesLRUCache(10)
+        for key in 'abc':
+            cache.set(key, b'xxx')
+        # a is used, so b is the least recently used one
+        self.assertEqual(cache.get('a'), b'xxx')
+        cache.set('d', b'xxx')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(key) for key in 'acd'], [b'xxx'] * 3)
+
+        # an update counts the new size only
+        cache.set('a', b'xxxx')
+        self.assertEqual(cache.stats()['bytes'], 10)
+        cache.set('e', b'x')
+        self.assertIsNone(cache.get('c'))
+        self.assertLessEqual(cache.stats()['bytes'], 10)
+
+        # values larger than the cache are not kept
+        cache.set('f', b'x' * 11)
+        self.assertIsNone(cache.get('f'))
+        self.assertEqual(cache.get('a'), b'xxxx')
+
+    def test_counters(self):
+        cache = BytesLRUCache(4)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', b'aa')
+        cache.get('a')
+        cache.get('a')
+        cache.set('b', b'bbb')
+        self.assertEqual(cache.get_or_set('b', lambda: b'ccc'), b'bbb')
+        self.assertEqual(cache.stats(), {
+            'items': 1, 'bytes': 3, 'max_bytes': 4, 'hits': 3,
+            'shared_hits': 0, 'misses': 1, 'evictions': 1,
+        })
+
+    def test_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shared = DirectoryBytesCache(directory, 100)
+            BytesLRUCache(100, shared).set('a', b'aaa')
+            # another process with the same directory
+            cache = BytesLRUCache(100, shared)
+            self.assertEqual(cache.get('a'), b'aaa')
+            self.assertEqual(cache.get('a'), b'aaa')
+            stats = cache.stats()
+            self.assertEqual((stats['shared_hits'], stats['hits'],
+                              stats['misses']), (1, 1, 0))
+
+
+class DirectoryBytesCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_shrink(self):
+        cache = DirectoryBytesCache(self.directory.name, 10, check_every=4)
+        for k, key in enumerate('abc'):
+            cache.set(key, b'xxxx')
+            os.utime(cache.path(key), (k, k))
+        # a read makes a the most recently used one
+        self.assertEqual(cache.get('a'), b'xxxx')
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['a', 'b', 'c'])
+
+        # checked on the fourth write, shrunk below 90% of max_bytes
+        cache.set('d', b'xxxx')
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['a', 'd'])
+        self.assertIsNone(cache.get('b'))
+
+    def test_concurrent_writes_counted(self):
+        cache = DirectoryBytesCache(self.directory.name, 10 ** 6,
+                                    check_every=10 ** 6)
+        threads = [threading.Thread(target=lambda k=k: [
+            cache.set(f'{k}-{n}', b'x') for n in range(50)
+        ]) for k in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache._writes, 200)
+
+
+class GameThreatsTest(TestCase):
+    def setUp(self):
+        get_game_states().clear()
+        owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        self.game = create_started_game(owner, other, width=5, height=5)
+        for i, j in [(0, 0), (4, 4), (0, 1), (4, 3)]:
+            self.game.add_turn(i, j)
+        self.url = f'/api/v1/ticTacToe/game/{self.game.id}/threats'
+
+    def test_threats(self):
+        response = APIClient().get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['turns_count'], 4)
+        first, second = response.data['players']
+        self.assertEqual(first['player'], self.game.order[0])
+        self.assertEqual(
+            [line for line in first['lines'] if line['length'] == 2],
+            [{'start': [0, 0], 'direction': [0, 1], 'length': 2,
+              'open_ends': [[0, 2]]}]
+        )
+        self.assertEqual(first['winning_cells'], [[0, 2]])
+        self.assertEqual(first['blocking_cells'], [[4, 2]])
+        self.assertEqual(second['winning_cells'], [[4, 2]])
+
+        # cached by the number of turns
+        with CaptureQueriesContext(connection) as context:
+            APIClient().get(self.url)
+        self.assertEqual(len(context.captured_queries), 0)
+        self.game.add_turn(0, 2)
+        get_game_states().invalidate(self.game.id)
+        response = APIClient().get(self.url)
+        self.assertEqual(response.data['turns_count'], 5)
+
+
+def line_cells(game, start_i, start_j, direction_i, direction_j):
+    return [(start_i + direction_i * k, start_j + direction_j * k)
+            for k in range(game.win_threshold)]
+
+
+def brute_force_win(game, player):
+    # whether the player has win_threshold cells in a line anywhere
+    return any(
+        all(0 <= i < game.height and 0 <= j < game.width
+            and game.field[i][j] == player
+            for i, j in line_cells(game, start_i, start_j, step_i, step_j))
+        for start_i in range(game.height) for start_j in range(game.width)
+        for step_i, step_j in service.LINE_DIRECTIONS
+    )
+
+
+class CheckWinTest(TestCase):
+    def play(self, width, height, win_threshold, turns, players_count=2):
+        """
+        Makes the turns as TurnSerializer does, checks check_win against
+        a brute force scan after every turn and returns the win data
+        """
+        game = SimpleNamespace(width=width, height=height,
+                               win_threshold=win_threshold,
+                               order=list(range(players_count)),
+                               history=[], field=None, line_runs=None)
+        for index, (i, j) in enumerate(turns):
+            player = index % players_count
+            game.history.append([i, j])
+            if game.field is not None:
+                game.field[i][j] = player
+            win_data = service.check_win(i, j, game)
+
+            self.assertEqual(win_data is not None,
+                             brute_force_win(game, player), game.history)
+            if win_data is not None:
+                cells = line_cells(game, *win_data.values())
+                self.assertIn((i, j), cells)
+                self.assertTrue(all(game.field[ci][cj] == player
+                                    for ci, cj in cells))
+                return win_data
+        return None
+
+    def test_directions(self):
+        for cells in [[(1, 1), (2, 2), (3, 3)], [(0, 2), (1, 2), (2, 2)],
+                      [(0, 3), (1, 2), (2, 1)], [(3, 0), (3, 1), (3, 2)]]:
+            # the other player plays away from the line
+            other = [(4, 4), (4, 0), (0, 0)]
+            turns = [turn for pair in zip(cells, other) for turn in pair]
+            self.assertIsNotNone(self.play(5, 5, 3, turns[:-1]), cells)
+
+    def test_joined_runs(self):
+        # the last turn joins two runs of two
+        turns = [(2, 0), (0, 0), (2, 1), (0, 1), (2, 3), (0, 3),
+                 (2, 4), (4, 4), (2, 2)]
+        self.assertEqual(self.play(5, 5, 5, turns),
+                         {'start_i': 2, 'start_j': 0,
+                          'direction_i': 0, 'direction_j': 1})
+
+    def test_edges(self):
+        turns = [(0, 4), (1, 0), (1, 4), (2, 0), (2, 4)]
+        self.assertIsNotNone(self.play(5, 3, 3, turns))
+        self.assertIsNone(self.play(1, 1, 2, [(0, 0)]))
+        self.assertIsNotNone(self.play(1, 1, 1, [(0, 0)]))
+
+    def test_draw(self):
+        turns = [(0, 0), (1, 1), (2, 2), (0, 1), (2, 1),
+                 (2, 0), (0, 2), (1, 2), (1, 0)]
+        self.assertIsNone(self.play(3, 3, 3, turns))
+
+    def test_random_games(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            width, height = rng.randint(1, 8), rng.randint(1, 8)
+            cells = [(i, j) for i in range(height) for j in range(width)]
+            rng.shuffle(cells)
+            self.play(width, height, rng.randint(1, min(width, height)),
+                      cells, players_count=rng.randint(1, 3))
+
+
+class AuditWinsTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        self.game = create_started_game(owner, other)
+        # the owner has won with the third turn of theirs
+        for i, j in [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]:
+            self.game.add_turn(i, j)
+
+    def load(self):
+        return Game.objects.prefetch_related('turns').get(id=self.game.id)
+
+    def store_win(self):
+        Game.objects.filter(id=self.game.id).update(
+            win_line_start_i=0, win_line_start_j=0,
+            win_line_direction_i=0, win_line_direction_j=1,
+        )
+
+    def test_untampered(self):
+        self.store_win()
+        self.assertEqual(service.validate_replay(self.load()), [])
+
+    def test_tampered_history(self):
+        self.store_win()
+        Turn.objects.create(game=self.game, index=5, i=2, j=2)
+        errors = service.validate_replay(self.load())
+        self.assertEqual(errors, ['Turns after the game was won on turn 4'])
+
+        Turn.objects.filter(game=self.game, index=4).update(i=1, j=2)
+        errors = service.validate_replay(self.load())
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('Stored win data'))
+
+    def test_fix(self):
+        call_command('audit_wins', '--fix', stdout=StringIO())
+        game = self.load()
+        self.assertEqual(service.validate_replay(game), [])
+        self.assertEqual(game.status, Game.Status.FINISHED)
+        self.assertEqual(game.winner_id, game.order[0])
+        self.assertGreater(game.version, self.game.version)
+
+
+class MigrationTest(TransactionTestCase):
+    """
+    Migrates the database back to migrate_from before every test,
+    self.apps are the models of that state,
+    and forward to the latest migrations after it.
+    """
+    migrate_from = None
+
+    def setUp(self):
+        self.apps = self.migrate(self.migrate_from)
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    @staticmethod
+    def migrate(name):
+        executor = MigrationExecutor(connection)
+        target = [('ticTacToe', name)]
+        executor.migrate(target)
+        return executor.loader.project_state(target).apps
+
+
+class GameResultsMigrationTest(MigrationTest):
+    migrate_from = '0005_game_line_runs'
+
+    def create_game(self, turns, **fields):
+        Game = self.apps.get_model('ticTacToe', 'Game')
+        Turn = self.apps.get_model('ticTacToe', 'Turn')
+        game = Game.objects.create(
+            width=3, height=3, win_threshold=3, owner_id=self.owner.id,
+            colors=['#000000', '#ffffff'],
+            order=[self.other.id, self.owner.id], **fields
+        )
+        Turn.objects.bulk_create([
+            Turn(game=game, index=index, i=i, j=j,
+                 player_id=game.order[index % 2])
+            for index, (i, j) in enumerate(turns)
+        ])
+        return game.id
+
+    def test_results(self):
+        User = self.apps.get_model('auth', 'User')
+        self.owner = User.objects.create(username='owner')
+        self.other = User.objects.create(username='other')
+        waiting = self.create_game([])
+        started = self.create_game([(0, 0)], started=True)
+        won = self.create_game(
+            [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)], started=True,
+            win_line_start_i=0, win_line_start_j=0,
+            win_line_direction_i=0, win_line_direction_j=1,
+        )
+        draw = self.create_game([], started=True,
+                                win_line_start_i=-1, win_line_start_j=-1)
+
+        Game = self.migrate('0006_game_results').get_model('ticTacToe',
+                                                           'Game')
+        results = {game['id']: (game['status'], game['winner_id'])
+                   for game in Game.objects.values('id', 'status',
+                                                   'winner_id')}
+        self.assertEqual(results, {
+            waiting: ('waiting', None),
+            started: ('started', None),
+            won: ('finished', self.other.id),
+            draw: ('draw', None),
+        })
+
+
+class GameResultsTest(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.other = User.objects.create(username='other')
+        self.game = create_started_game(self.owner, self.other)
+        self.client = APIClient()
+
+    def turn(self, user, i, j):
+        self.client.force_authenticate(user)
+        response = self.client.patch(
+            f'/api/v1/ticTacToe/game/{self.game.id}/turn', {'i': i, 'j': j}
+        )
+        self.assertEqual(response.status_code, 200)
+        return Game.objects.get(id=self.game.id)
+
+    def test_finishing_turn(self):
+        for user, (i, j) in zip([self.owner, self.other] * 2,
+                                [(0, 0), (1, 0), (0, 1), (1, 1)]):
+            game = self.turn(user, i, j)
+            self.assertEqual(game.status, Game.Status.STARTED)
+            self.assertIsNone(game.finish_time)
+        game = self.turn(self.owner, 0, 2)
+        self.assertEqual(game.status, Game.Status.FINISHED)
+        self.assertEqual(game.winner_id, self.owner.id)
+        self.assertIsNotNone(game.finish_time)
+
+    def test_backfill(self):
+        for index, (i, j) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1),
+                                        (0, 2)]):
+            self.game.add_turn(i, j)
+        # as stored before the results
+        Game.objects.filter(id=self.game.id).update(
+            win_line_start_i=0, win_line_start_j=0,
+            win_line_direction_i=0, win_line_direction_j=1,
+            status=Game.Status.WAITING,
+        )
+        call_command('backfill_game_results', stdout=StringIO())
+        game = Game.objects.get(id=self.game.id)
+        self.assertEqual(game.status, Game.Status.FINISHED)
+        self.assertEqual(game.winner_id, self.owner.id)
+
+    def test_finished_filter(self):
+        for user, (i, j) in zip([self.owner, self.other] * 3,
+                                [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]):
+            self.turn(user, i, j)
+        create_started_game(self.owner, self.other)
+
+        self.client.force_authenticate(self.other)
+        url = '/api/v1/ticTacToe/games/my'
+        for finished, winners in [('true', [self.owner.id]),
+                                  ('false', [None])]:
+            data = self.client.get(url, {'finished': finished}).data
+            self.assertEqual([game['winner'] and game['winner']['id']
+                              for game in data], winners)
+
+
+class PackedFieldsTest(TestCase):
+    @staticmethod
+    def round_trip(field, value):
+        packed = field.get_db_prep_value(value, connection)
+        return packed, field.from_db_value(packed, None, connection)
+
+    def test_board(self):
+        board = [[-1, 0, 1], [1, -1, 0]]
+        packed, unpacked = self.round_trip(PackedBoardField(), board)
+        # item size, width and a byte per cell
+        self.assertEqual(bytes(packed), bytes([1, 3, 0, 1, 2, 2, 0, 1]))
+        self.assertEqual(unpacked, board)
+
+    def test_many_players(self):
+        board = [[299, -1], [0, 254]]
+        packed, unpacked = self.round_trip(PackedBoardField(), board)
+        self.assertEqual(bytes(packed)[:2], bytes([2, 2]))
+        self.assertEqual(len(packed), 2 + 2 * 4)
+        self.assertEqual(unpacked, board)
+
+    def test_empty_board(self):
+        field = PackedBoardField()
+        self.assertEqual(self.round_trip(field, [])[1], [])
+        self.assertEqual(self.round_trip(field, None), (None, None))
+        # serialized games (e.g. fixtures) are base64
+        packed = base64.b64encode(field.pack([[0]])).decode()
+        self.assertEqual(field.to_python(packed), [[0]])
+
+    def test_line_runs(self):
+        runs = numpy.zeros((4, 3, 5), numpy.uint8)
+        runs[1, 2, 4] = 3
+        _, unpacked = self.round_trip(PackedLineRunsField(), runs)
+        self.assertTrue((unpacked == runs).all())
+
+
+class PackedFieldMigrationTest(MigrationTest):
+    migrate_from = '0001_initial'
+
+    def test_pack_and_unpack(self):
+        User = self.apps.get_model('auth', 'User')
+        owner = User.objects.create(username='owner')
+        board = [[0, -1], [-1, 1]]
+        game_ids = [self.apps.get_model('ticTacToe', 'Game').objects.create(
+            width=2, height=2, win_threshold=2, owner_id=owner.id,
+            colors=['#000000', '#ffffff'], field=field
+        ).id for field in [board, None]]
+
+        Game = self.migrate('0002_packed_history_and_field') \
+            .get_model('ticTacToe', 'Game')
+        self.assertEqual(
+            list(Game.objects.filter(id__in=game_ids)
+                 .order_by('id').values_list('field', flat=True)),
+            [board, None]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT field FROM "ticTacToe_game" '
+                           'WHERE id = %s', [game_ids[0]])
+            self.assertEqual(bytes(cursor.fetchone()[0]),
+                             bytes([1, 2, 1, 0, 0, 2]))
+
+        Game = self.migrate('0001_initial').get_model('ticTacToe', 'Game')
+        self.assertEqual(Game.objects.get(id=game_ids[0]).field, board)
+
+
+class TurnsTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        self.game = create_started_game(owner, other)
+        self.turns = [[0, 0], [1, 0], [0, 1], [1, 1], [2, 2]]
+        for i, j in self.turns:
+            self.game.add_turn(i, j)
+        get_game_states().clear()
+
+    def test_history_suffix(self):
+        # finished games are not cached, their turns are read from the table
+        Game.objects.filter(id=self.game.id).update(status=Game.Status.DRAW)
+        url = f'/api/v1/ticTacToe/game/{self.game.id}/historySuffix'
+        for start_index in range(len(self.turns) + 2):
+            with CaptureQueriesContext(connection) as context:
+                response = APIClient().get(url, {'start_index': start_index})
+            self.assertEqual(
+                [list(turn) for turn in response.data['history']],
+                self.turns[start_index:]
+            )
+            # only the suffix is read, by the (game, index) range
+            # (the version query counts the turns)
+            turn_queries = [query['sql'] for query in context.captured_queries
+                            if 'ticTacToe_turn' in query['sql']
+                            and 'COUNT(' not in query['sql']]
+            self.assertEqual(len(turn_queries), 1)
+            self.assertIn('"index" >=', turn_queries[0])
+
+    def test_unique_turns(self):
+        for index, i, j in [(4, 2, 1), (5, 0, 0)]:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Turn.objects.create(game=self.game, index=index, i=i, j=j)
+        self.assertEqual(self.game.turns.count(), len(self.turns))
+
+
+class TurnsMigrationTest(MigrationTest):
+    migrate_from = '0002_packed_history_and_field'
+
+    def test_history_to_turns_and_back(self):
+        User = self.apps.get_model('auth', 'User')
+        owner = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        history = [[0, 0], [1, 1], [2, 0]]
+        game_id = self.apps.get_model('ticTacToe', 'Game').objects.create(
+            width=3, height=3, win_threshold=3, owner_id=owner.id,
+            colors=['#000000', '#ffffff'], order=[owner.id, other.id],
+            started=True, history=history
+        ).id
+
+        Turn = self.migrate('0003_turn').get_model('ticTacToe', 'Turn')
+        self.assertEqual(
+            list(Turn.objects.filter(game_id=game_id).order_by('index')
+                 .values_list('index', 'i', 'j', 'player_id')),
+            [(0, 0, 0, owner.id), (1, 1, 1, other.id), (2, 2, 0, owner.id)]
+        )
+
+        Game = self.migrate(self.migrate_from).get_model('ticTacToe', 'Game')
+        self.assertEqual(Game.objects.get(id=game_id).history, history)
@@ -0,0 +1,12 @@
+from django.db import close_old_connections
+
+
+def run_in_request_thread(function, *args, **kwargs):
+    # runs function in a thread of an executor, database connections
+    # are handled like in a request handler thread (the broken ones
+    # and the ones older than CONN_MAX_AGE are closed before and after)
+    close_old_connections()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        close_old_connections()
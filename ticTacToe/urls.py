@@ -1,25 +1,59 @@
+from types import SimpleNamespace
+
+from django.conf import settings
 from django.urls import path
 
 from ticTacToe.views import (
     GameDetailView, StartedGamesView,
     WaitingGamesView, CreateGameView,
-    JoinGameView, StartGameView,
+    JoinGameView, AddBotView, StartGameView,
     MakeTurnView, HistorySuffixView,
-    GamePlayersView, MyGamesView, GameStartedView, CircleCrossPictureView
+    GamePlayersView, MyGamesView, GameStartedView, CircleCrossPictureView,
+    GameBoardPictureView, GameSummaryView, MetricsView, GameBoardView,
+    GameBoardDeltaView, GameThreatsView
 )
 
+if settings.TIC_TAC_TOE_ASYNC_VIEWS:
+    from ticTacToe import async_views as read_views
+else:
+    read_views = SimpleNamespace(
+        game_detail=GameDetailView.as_view(),
+        game_summary=GameSummaryView.as_view(),
+        history_suffix=HistorySuffixView.as_view(),
+        game_players=GamePlayersView.as_view(),
+        game_started=GameStartedView.as_view(),
+        game_board=GameBoardView.as_view(),
+        game_board_delta=GameBoardDeltaView.as_view(),
+        game_threats=GameThreatsView.as_view(),
+        started_games=StartedGamesView.as_view(),
+        waiting_games=WaitingGamesView.as_view(),
+        my_games=MyGamesView.as_view(),
+        circle_cross_picture=CircleCrossPictureView.as_view(),
+        game_board_picture=GameBoardPictureView.as_view(),
+    )
+
 urlpatterns = [
-    path('game/<int:pk>', GameDetailView.as_view(), name='game'),
-    path('game/<int:pk>/players', GamePlayersView.as_view(), name='players'),
-    path('game/<int:pk>/started', GameStartedView.as_view(), name='started'),
+    path('game/<int:pk>', read_views.game_detail, name='game'),
+    path('game/<int:pk>/summary', read_views.game_summary, name='summary'),
+    path('game/<int:pk>/players', read_views.game_players, name='players'),
+    path('game/<int:pk>/started', read_views.game_started, name='started'),
     path('game/<int:pk>/join', JoinGameView.as_view(), name='join'),
+    path('game/<int:pk>/addBot', AddBotView.as_view(), name='add_bot'),
     path('game/<int:pk>/start', StartGameView.as_view(), name='start'),
     path('game/<int:pk>/turn', MakeTurnView.as_view(), name='start'),
-    path('game/<int:pk>/historySuffix', HistorySuffixView.as_view(),
+    path('game/<int:pk>/historySuffix', read_views.history_suffix,
          name='history_suffix'),
-    path('games/my', MyGamesView.as_view(), name='my_games'),
-    path('games/started', StartedGamesView.as_view(), name='started_games'),
-    path('games/waiting', WaitingGamesView.as_view(), name='waiting_games'),
+    path('game/<int:pk>/board', read_views.game_board, name='board'),
+    path('game/<int:pk>/boardDelta', read_views.game_board_delta,
+         name='board_delta'),
+    path('game/<int:pk>/threats', read_views.game_threats,
+         name='threats'),
+    path('game/<int:pk>/picture', read_views.game_board_picture,
+         name='board_picture'),
+    path('games/my', read_views.my_games, name='my_games'),
+    path('games/started', read_views.started_games, name='started_games'),
+    path('games/waiting', read_views.waiting_games, name='waiting_games'),
     path('games/create', CreateGameView.as_view(), name='create'),
-    path('pics/<name>/<rgb>', CircleCrossPictureView.as_view(), name='pic'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+    path('pics/<name>/<rgb>', read_views.circle_cross_picture, name='pic'),
 ]
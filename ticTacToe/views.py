@@ -1,24 +1,165 @@
 import re
+import sqlite3
+import time
 from abc import abstractmethod, ABC
+from functools import wraps
 import random
 
-from django.http import HttpResponse, HttpResponseNotFound
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, OperationalError, transaction
+from django.http import (
+    HttpResponse, HttpResponseNotFound, HttpResponseBadRequest,
+    HttpResponseNotModified, HttpResponseForbidden
+)
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags, quote_etag
 from django.views import View
 from rest_framework import serializers, exceptions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from . import service
-from .forms import PageCountForm, HistorySuffixForm, MyGamesForm
+from . import service, events, profiling, replay, bot
+from .forms import (
+    PageCountForm, HistorySuffixForm, MyGamesForm, PictureForm,
+    ProjectionForm, BoardForm, BoardDeltaForm
+)
+from .game_cache import get_game_states, game_version_state
 from .models import Game
+from .pagination import keyset_page
 from .serializers import (
-    GameSerializer, GameListSerializer,
+    GameSerializer, GameListSerializer, GameSummarySerializer,
     WinDataSerializer, GameColorsSerializer,
-    GamePlayersSerializer, CreateGameSerializer, JoinSerializer, TurnSerializer
+    GamePlayersSerializer, CreateGameSerializer, JoinSerializer
 )
 
 
+# Postgres serialization failure, deadlock and lock timeout
+LOCK_CONFLICT_PGCODES = {'40001', '40P01', '55P03'}
+LOCK_CONFLICT_SQLITE_CODES = {sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED}
+
+
+def is_lock_conflict(error):
+    # SQLite fails a write while another transaction holds the database
+    # lock for longer than its timeout, Postgres cancels one
+    # of deadlocked transactions or a transaction waiting for too long;
+    # django keeps the driver error as the cause
+    cause = error.__cause__
+    if (pgcode := getattr(cause, 'pgcode', None)) is not None:
+        return pgcode in LOCK_CONFLICT_PGCODES
+    if isinstance(cause, sqlite3.Error) \
+            and (code := getattr(cause, 'sqlite_errorcode', None)) is not None:
+        # extended result codes keep the primary one in the low byte
+        return code & 0xff in LOCK_CONFLICT_SQLITE_CODES
+    return False
+
+
+def atomic_with_retries(attempts=3):
+    """
+    Runs a write view in a transaction.
+
+    Games are locked with select_for_update in the views' validation,
+    a unique constraint violation caused by a concurrent write anyway
+    (e.g. on databases without row locks) or a lock conflict
+    (see is_lock_conflict) rolls the transaction back and the view
+    is validated and run again after a short random pause.
+    If every attempt fails, the client is asked to try again.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    with transaction.atomic():
+                        return method(*args, **kwargs)
+                except (IntegrityError, OperationalError) as e:
+                    if isinstance(e, OperationalError) \
+                            and not is_lock_conflict(e):
+                        raise
+                    if attempt + 1 == attempts:
+                        raise serializers.ValidationError({
+                            'game': 'The game was changed concurrently,'
+                                    ' try again'
+                        })
+                # the concurrent transaction is likely to finish by then
+                time.sleep(random.uniform(0, 0.02 * 2 ** attempt))
+        return wrapper
+    return decorator
+
+
+def game_etag(pk, state):
+    # state is Game.version_query
+    return quote_etag(f'{pk}-{state["version"]}')
+
+
+def game_not_modified(request, etag):
+    return etag in parse_etags(request.headers.get('If-None-Match', ''))
+
+
+def patch_game_cache_headers(response, etag, state):
+    # finished games do not change, they are cached for a day,
+    # clients revalidate the other ones on every request
+    response['ETag'] = etag
+    if state['status'] in [Game.Status.FINISHED, Game.Status.DRAW]:
+        patch_cache_control(response, public=True, max_age=86400)
+    else:
+        patch_cache_control(response, no_cache=True)
+
+
+def polled_game_state(pk):
+    # polls of a game keep its bot playing (see bot.resume)
+    if (state := game_version_state(pk)) is not None:
+        bot.resume(pk, state)
+    return state
+
+
+def conditional_on_game_version(method):
+    """
+    Answers a read view of a game with 304 Not Modified
+    if its ETag (the game version) matches If-None-Match,
+    so an unchanged game costs one primary key lookup
+    (none if the game is cached, see game_cache).
+    """
+    @wraps(method)
+    def wrapper(self, request, pk, *args, **kwargs):
+        state = polled_game_state(pk)
+        if state is None:
+            raise exceptions.NotFound()
+
+        etag = game_etag(pk, state)
+        if game_not_modified(request, etag):
+            response = Response(status=304)
+        else:
+            response = method(self, request, pk, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+        patch_game_cache_headers(response, etag, state)
+        return response
+    return wrapper
+
+
+def long_polled(method):
+    """
+    Waits for a turn (see events.wait_for_turn) before a history view
+    if it is asked to wait and there are no new turns yet.
+    """
+    @wraps(method)
+    def wrapper(self, request, pk, *args, **kwargs):
+        form = HistorySuffixForm(request.GET)
+        if self.long_poll and form.is_valid() \
+                and (wait := form.cleaned_data['wait']):
+            events.wait_for_turn(pk, form.cleaned_data['start_index'], wait)
+        return method(self, request, pk, *args, **kwargs)
+    return wrapper
+
+
 class MyListView(APIView, ABC):
+    # the order of keyset pages, the last field must be unique
+    cursor_ordering = ('-id',)
+
     @abstractmethod
     def get_query_set(self, request):
         return None
@@ -27,6 +168,9 @@ class MyListView(APIView, ABC):
     def get_serializer_class(self):
         return None
 
+    def prepare_query_set(self, objects, request):
+        return objects
+
     def inject_data(self, objects, serialized, request):
         return serialized
 
@@ -38,24 +182,44 @@ class MyListView(APIView, ABC):
         data = form.cleaned_data
         page = data['page']
         count = data['count']
+        cursor = data['cursor']
+
+        objects = self.prepare_query_set(
+            self.get_query_set(request, *args, **kwargs), request
+        )
+        if cursor is None:
+            page_objects = objects[(page - 1) * count:page * count]
+        else:
+            try:
+                page_objects, next_cursor = keyset_page(
+                    objects, cursor, count, self.cursor_ordering
+                )
+            except DjangoValidationError as e:
+                raise serializers.ValidationError({'cursor': e.messages})
 
-        objects = self.get_query_set(request, *args, **kwargs)
-        page_objects = objects[(page - 1) * count:page * count]
         serializer = self.get_serializer_class()(page_objects, many=True)
-        serialized = serializer.data
+        with profiling.timed('serializer'):
+            serialized = serializer.data
         serialized = self.inject_data(
             page_objects, serialized, request, *args, **kwargs
         )
-        return Response(serialized)
+        if cursor is None:
+            return Response(serialized)
+        return Response({'results': serialized, 'next_cursor': next_cursor})
 
 
 class AbstractGameListView(MyListView, ABC):
+    cursor_ordering = ('-creation_time', '-id')
+
     def get_serializer_class(self):
         return GameListSerializer
 
+    def prepare_query_set(self, games, request):
+        return Game.list_query(games, request.user)
+
     def inject_data(self, games, serialized, request, *args, **kwargs):
         for game, serialized_game in zip(games, serialized):
-            serialized_game['user_joined'] = request.user in game.players.all()
+            serialized_game['user_joined'] = game.user_joined
         return serialized
 
 
@@ -63,7 +227,8 @@ class StartedGamesView(AbstractGameListView):
     permission_classes = []
 
     def get_query_set(self, request):
-        return Game.objects.filter(started=True).order_by('-creation_time')
+        return Game.objects.filter(started=True) \
+            .order_by('-creation_time', '-id')
 
 
 class GameDetailView(APIView):
@@ -75,17 +240,56 @@ class GameDetailView(APIView):
             raise exceptions.NotFound()
         return game
 
+    def validate_fields(self, request):
+        form = ProjectionForm(request.GET)
+        if not form.is_valid():
+            raise serializers.ValidationError(form.errors)
+
+        fields = form.cleaned_data['fields']
+        if fields is not None \
+                and (unknown := set(fields) - set(GameSerializer().fields)):
+            raise serializers.ValidationError({
+                'fields': f'Unknown fields: {", ".join(sorted(unknown))}'
+            })
+        return fields
+
+    @conditional_on_game_version
+    def get(self, request, pk):
+        fields = self.validate_fields(request)
+        if fields is None:
+            game = self.validate(pk)
+        else:
+            game = Game.objects.filter(id=pk) \
+                .only(*GameSerializer.model_fields(fields)).first()
+            if game is None:
+                raise exceptions.NotFound()
+        serializer = GameSerializer(game, fields=fields)
+        with profiling.timed('serializer'):
+            return Response(serializer.data)
+
+
+class GameSummaryView(APIView):
+    permission_classes = []
+
+    def validate(self, pk):
+        game = Game.summary_query(Game.objects.filter(id=pk)).first()
+        if game is None:
+            raise exceptions.NotFound()
+        return game
+
+    @conditional_on_game_version
     def get(self, request, pk):
         game = self.validate(pk)
-        serializer = GameSerializer(game)
-        return Response(serializer.data)
+        with profiling.timed('serializer'):
+            return Response(GameSummarySerializer(game).data)
 
 
 class WaitingGamesView(AbstractGameListView):
     permission_classes = []
 
     def get_query_set(self, request):
-        return Game.objects.filter(started=False).order_by('-creation_time')
+        return Game.objects.filter(started=False) \
+            .order_by('-creation_time', '-id')
 
 
 class CreateGameView(APIView):
@@ -111,7 +315,7 @@ class JoinGameView(APIView):
                 '__all__': 'You can not join a game while you are in other game'
             })
 
-        game = Game.objects.filter(id=pk).first()
+        game = Game.objects.select_for_update().filter(id=pk).first()
         if game is None:
             raise exceptions.NotFound()
         if game.started:
@@ -120,17 +324,49 @@ class JoinGameView(APIView):
             })
         return game
 
+    @atomic_with_retries()
     def patch(self, request, pk):
         game = self.validate(request, pk)
         serializer = JoinSerializer(game, data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save(user=request.user)
+        get_game_states().invalidate_on_commit(game.id)
+        events.publish(game.id, 'join', user_id=request.user.id,
+                       color=serializer.validated_data['color'])
         return Response()
 
 
+class AddBotView(APIView):
+    def validate(self, request, pk):
+        game = Game.objects.select_for_update().filter(id=pk).first()
+        if game is None:
+            raise exceptions.NotFound()
+
+        if game.owner_id != request.user.id:
+            raise exceptions.PermissionDenied({'user': 'You are not the owner'})
+
+        if game.started:
+            raise serializers.ValidationError({
+                'game': 'The game has already started'
+            })
+        return game
+
+    @atomic_with_retries()
+    def patch(self, request, pk):
+        game = self.validate(request, pk)
+        serializer = JoinSerializer(game, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = bot.get_bot_user(game)
+        serializer.save(user=user, bot=True)
+        get_game_states().invalidate_on_commit(game.id)
+        events.publish(game.id, 'join', user_id=user.id,
+                       color=serializer.validated_data['color'])
+        return Response({'id': user.id})
+
+
 class StartGameView(APIView):
     def valdidate(self, request, pk):
-        game = Game.objects.filter(id=pk).first()
+        game = Game.objects.select_for_update().filter(id=pk).first()
         if game is None:
             raise exceptions.NotFound()
 
@@ -143,20 +379,26 @@ class StartGameView(APIView):
             })
         return game
 
+    @atomic_with_retries()
     def patch(self, request, pk):
         game = self.valdidate(request, pk)
         game.order = list([player.id for player in game.players.all()])
         random.shuffle(game.order)
         game.colors = [game.colors[str(player_id)] for player_id in game.order]
         game.started = True
+        game.status = Game.Status.STARTED
+        game.version += 1
         game.save()
+        get_game_states().invalidate_on_commit(game.id)
+        events.publish(game.id, 'start', order=game.order)
+        bot.schedule(game)
 
         return Response()
 
 
 class MakeTurnView(APIView):
     def validate(self, request, pk):
-        game = Game.objects.filter(id=pk).first()
+        game = Game.objects.select_for_update().filter(id=pk).first()
         if game is None:
             raise exceptions.NotFound()
 
@@ -170,7 +412,7 @@ class MakeTurnView(APIView):
                 'game': 'Game has already finished'
             })
 
-        turn_user_index = len(game.history) % len(game.order)
+        turn_user_index = game.turns_count % len(game.order)
         turn_user_id = game.order[turn_user_index]
         if turn_user_id != request.user.id:
             raise exceptions.PermissionDenied({
@@ -178,16 +420,17 @@ class MakeTurnView(APIView):
             })
         return game
 
+    @atomic_with_retries()
     def patch(self, request, pk):
         game = self.validate(request, pk)
-        serializer = TurnSerializer(game, request.data)
-        serializer.is_valid(raise_exception=True)
-        serializer.save()
-        return Response(WinDataSerializer(game).data)
+        return Response(bot.make_turn(game, request.data))
 
 
 class HistorySuffixView(APIView):
     permission_classes = []
+    # False if turns are waited for before the view
+    # (see async_views.history_suffix)
+    long_poll = True
 
     def validate(self, pk):
         game = Game.objects.filter(id=pk).first()
@@ -195,21 +438,28 @@ class HistorySuffixView(APIView):
             raise exceptions.NotFound()
         return game
 
+    @long_polled
+    @conditional_on_game_version
     def get(self, request, pk):
-        game = self.validate(pk)
-
         form = HistorySuffixForm(request.GET)
         if not form.is_valid():
             raise serializers.ValidationError(form.errors)
 
+        state, game = get_game_states().load(pk, lambda: self.validate(pk))
+
         start_index = form.cleaned_data['start_index']
-        response = {'history': game.history[start_index:]}
+        if state is not None:
+            return Response({'history': state['history'][start_index:]})
+        history = game.turns.filter(index__gte=start_index) \
+            .values_list('i', 'j')
+        response = {'history': list(history)}
         if game.win_line_start_i is not None:
-            response['win_data'] = WinDataSerializer(game).data
+            with profiling.timed('serializer'):
+                response['win_data'] = WinDataSerializer(game).data
         return Response(response)
 
 
-class GamePlayersView(APIView):
+class GameThreatsView(APIView):
     permission_classes = []
 
     def validate(self, pk):
@@ -218,12 +468,100 @@ class GamePlayersView(APIView):
             raise exceptions.NotFound()
         return game
 
+    @staticmethod
+    def cache_key(pk, turns_count):
+        # the turns of a game are only appended,
+        # so the threats after turns_count turns never change
+        return f'tic-tac-toe-threats-{pk}-{turns_count}'
+
+    @conditional_on_game_version
+    def get(self, request, pk):
+        cache = caches[settings.TIC_TAC_TOE_GAME_CACHE_ALIAS]
+        state, game = get_game_states().load(pk, lambda: self.validate(pk))
+        turns_count = len(state['history']) if state is not None \
+            else game.turns_count
+        if (threats := cache.get(self.cache_key(pk, turns_count))) is None:
+            if game is None:
+                game = self.validate(pk)
+            threats = {'turns_count': len(game.history),
+                       'players': service.find_threats(game)}
+            cache.set(self.cache_key(pk, threats['turns_count']), threats,
+                      settings.TIC_TAC_TOE_GAME_CACHE_TIMEOUT)
+        return Response(threats)
+
+
+class ReplayView(APIView, ABC):
+    permission_classes = []
+    form_class = None
+
+    def validate(self, pk):
+        game = Game.objects.filter(id=pk) \
+            .only('width', 'height', 'order').first()
+        if game is None:
+            raise exceptions.NotFound()
+        return game
+
+    @abstractmethod
+    def replay(self, game, data):
+        return None
+
     def get(self, request, pk):
+        form = self.form_class(request.GET)
+        if not form.is_valid():
+            raise serializers.ValidationError(form.errors)
+
         game = self.validate(pk)
-        return Response({
-            **GamePlayersSerializer(game).data,
-            **GameColorsSerializer(game).data
-        })
+        try:
+            data = self.replay(game, form.cleaned_data)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError({'index': e.messages})
+
+        # the first turns of a game never change
+        response = Response(data)
+        patch_cache_control(response, public=True, max_age=86400)
+        return response
+
+
+class GameBoardView(ReplayView):
+    form_class = BoardForm
+
+    def replay(self, game, data):
+        board = replay.board_at(game, data['index'])
+        return {'index': data['index'], 'field': board.tolist()}
+
+
+class GameBoardDeltaView(ReplayView):
+    form_class = BoardDeltaForm
+
+    def replay(self, game, data):
+        return {
+            'start_index': data['start_index'],
+            'end_index': data['end_index'],
+            'cells': replay.board_delta(game, data['start_index'],
+                                        data['end_index']),
+        }
+
+
+class GamePlayersView(APIView):
+    permission_classes = []
+
+    def validate(self, pk):
+        game = Game.objects.filter(id=pk).first()
+        if game is None:
+            raise exceptions.NotFound()
+        return game
+
+    @conditional_on_game_version
+    def get(self, request, pk):
+        state, game = get_game_states().load(pk, lambda: self.validate(pk))
+        if state is not None:
+            return Response({'players': state['players'],
+                             'colors': state['colors']})
+        with profiling.timed('serializer'):
+            return Response({
+                **GamePlayersSerializer(game).data,
+                **GameColorsSerializer(game).data
+            })
 
 
 class GameStartedView(APIView):
@@ -236,7 +574,9 @@ class GameStartedView(APIView):
         return game
 
     def get(self, request, pk):
-        game = self.validate(pk)
+        state, game = get_game_states().load(pk, lambda: self.validate(pk))
+        if state is not None:
+            return Response({'started': state['started']})
         return Response({'started': game.started})
 
 
@@ -254,7 +594,7 @@ class MyGamesView(AbstractGameListView):
             query_set = Game.finished_query(query_set)
         else:
             query_set = Game.unfinished_query(query_set)
-        query_set = query_set.order_by('-creation_time')
+        query_set = query_set.order_by('-creation_time', '-id')
         return query_set
 
 
@@ -273,5 +613,77 @@ class CircleCrossPictureView(View):
         if r > 255 or g > 255 or b > 255:
             return HttpResponseNotFound()
 
-        result = service.generate_image_bytes(r, g, b, name)
-        return HttpResponse(result, content_type='image/png')
+        form = PictureForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_json(),
+                                          content_type='application/json')
+        size = service.image_pattern_size(form.cleaned_data['size'])
+        media_type = service.choose_image_media_type(
+            request.headers.get('Accept')
+        )
+
+        # the image depends on the url and the media type only
+        etag = quote_etag(f'{name}-{size or "full"}-{rgb.lower()}-'
+                          + media_type.rsplit('/', 1)[-1])
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            result = service.generate_image_bytes(r, g, b, name, size,
+                                                  media_type)
+            response = HttpResponse(result, content_type=media_type)
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=31536000,
+                            immutable=True)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class GameBoardPictureView(View):
+    def get(self, request, pk):
+        form = PictureForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_json(),
+                                          content_type='application/json')
+        size = form.cleaned_data['size']
+        media_type = service.choose_image_media_type(
+            request.headers.get('Accept')
+        )
+
+        game = Game.objects.filter(id=pk) \
+            .only('width', 'height', 'colors', 'started', 'version') \
+            .first()
+        if game is None:
+            return HttpResponseNotFound()
+
+        etag = quote_etag(f'{pk}-{game.version}-{size or "full"}-'
+                          + media_type.rsplit('/', 1)[-1])
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            result = service.generate_board_bytes(game, size, media_type)
+            response = HttpResponse(result, content_type=media_type)
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class MetricsView(View):
+    @staticmethod
+    def allowed(request):
+        if request.user.is_staff:
+            return True
+        token = settings.TIC_TAC_TOE_METRICS_TOKEN
+        if token and constant_time_compare(
+                request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return True
+        return request.META.get('REMOTE_ADDR') \
+            in settings.TIC_TAC_TOE_METRICS_ALLOWED_IPS
+
+    def get(self, request):
+        if not settings.TIC_TAC_TOE_PROFILING:
+            return HttpResponseNotFound()
+        if not self.allowed(request):
+            return HttpResponseForbidden()
+        return HttpResponse(profiling.metrics.render(),
+                            content_type='text/plain; version=0.0.4')